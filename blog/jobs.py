@@ -0,0 +1,10 @@
+from django.db.models import F
+from jobs.handlers import register
+from notifications.models import Notification, NotificationType
+from .models import Comment
+
+@register('blog.notify_post_author', batch=True)
+def notify_post_author(payloads):
+    comments = Comment.objects.filter(pk__in=[payload['comment_id'] for payload in payloads]).exclude(commenter=F('post__author__user')).select_related('post__author').order_by('id')
+    notification_type = NotificationType.get(name='new_comment_on_post')
+    Notification.create_many([Notification(content=comment, user_id=comment.post.author.user_id, actor_id=comment.commenter_id, type=notification_type) for comment in comments])
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand, CommandError
+from blog.models import Post, Comment
+from blog.rendering import BACKENDS, get_available_backends, get_renderer
+from time import perf_counter
+from random import Random
+
+SAMPLE_PARAGRAPHS = [
+    'Lorem ipsum dolor sit amet, **consectetur** adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.',
+    'Ut enim ad minim veniam, quis nostrud [exercitation](https://example.com) ullamco laboris nisi ut aliquip ex ea commodo consequat.',
+    '## Duis aute irure\n\nDolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur.',
+    '* Excepteur sint occaecat\n* cupidatat non proident\n* sunt in culpa qui officia',
+    '> Deserunt mollit anim id est laborum. <b>Not allowed</b> <script>alert(1)</script>',
+    '    def example():\n        return `code`\n',
+]
+
+class Command(BaseCommand):
+    help = 'Benchmark the markdown rendering backends against the posts and comments in the database'
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', action='append', choices=list(BACKENDS), help='Backend to benchmark (may be repeated, defaults to every installed backend)')
+        parser.add_argument('--posts', type=int, default=200, help='Maximum number of posts in the corpus')
+        parser.add_argument('--comments', type=int, default=2000, help='Maximum number of comments in the corpus')
+        parser.add_argument('--rounds', type=int, default=3, help='Number of times to render the corpus with each backend')
+
+    def get_corpus(self, options):
+        corpus = list(Post.objects.order_by('-id').values_list('content', flat=True)[:options['posts']])
+        corpus += list(Comment.objects.order_by('-id').values_list('text', flat=True)[:options['comments']])
+        if corpus:
+            return corpus
+
+        #Nothing in the database (see createtestdata), fall back to generated posts and comments
+        self.stdout.write('No posts or comments found, using a generated corpus')
+        random = Random(0)
+        corpus = ['\n\n'.join(random.choices(SAMPLE_PARAGRAPHS, k=random.randrange(5, 40))) for i in range(options['posts'])]
+        corpus += ['\n\n'.join(random.choices(SAMPLE_PARAGRAPHS, k=random.randrange(1, 3))) for i in range(options['comments'])]
+        return corpus
+
+    def handle(self, *args, **options):
+        backends = options['backend'] or get_available_backends()
+        missing = [backend for backend in backends if backend not in get_available_backends()]
+        if missing:
+            raise CommandError(f'Backend(s) not installed: {", ".join(missing)}')
+
+        corpus = self.get_corpus(options)
+        total_chars = sum(len(document) for document in corpus)
+        self.stdout.write(f'Corpus: {len(corpus)} document(s), {total_chars} characters, {options["rounds"]} round(s)')
+        self.stdout.write(f'{"backend":<14}{"docs/sec":>12}{"p50 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+        for backend in backends:
+            renderer = get_renderer(backend)
+            renderer.render(corpus[0])
+            timings = []
+            for i in range(options['rounds']):
+                for document in corpus:
+                    start = perf_counter()
+                    renderer.render(document)
+                    timings.append(perf_counter() - start)
+            timings.sort()
+            p50 = timings[int(len(timings) * 0.50)]
+            p99 = timings[min(int(len(timings) * 0.99), len(timings) - 1)]
+            self.stdout.write(f'{backend:<14}{len(timings) / sum(timings):>12.1f}{p50 * 1000:>10.3f}{p99 * 1000:>10.3f}{timings[-1] * 1000:>10.3f}')
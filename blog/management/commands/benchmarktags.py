@@ -0,0 +1,74 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.template.defaultfilters import slugify
+from blog.models import Post, Tag
+from time import perf_counter
+
+#How post_edit_view assigned tags before Post.set_tags, kept for comparison
+def set_tags_one_by_one(post, text):
+    post.tags.clear()
+    for tag_name in text.lower().split(','):
+        if tag_name.strip():
+            try:
+                tag = Tag.objects.get(slug=slugify(tag_name.strip()))
+            except Tag.DoesNotExist:
+                tag = Tag()
+            tag.name = tag_name.strip()
+            tag.save()
+            post.tags.add(tag)
+
+METHODS = {
+    'set_tags': lambda post, text: post.set_tags(text),
+    'one_by_one': set_tags_one_by_one,
+}
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+class Command(BaseCommand):
+    help = 'Benchmark assigning tags to posts with many tags. Everything it creates is rolled back'
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tags', type=int, default=300, help='Number of tags on the post')
+        parser.add_argument('--rounds', type=int, default=5, help='Number of times the tags are changed')
+        parser.add_argument('--changed', type=float, default=0.1, help='Fraction of the tags replaced each round')
+
+    def run(self, method, options):
+        user = User.objects.create(username='benchmarktags_user')
+        post = Post.objects.create(author=user.author, title='benchmarktags', content='benchmarktags')
+        step = max(int(options['tags'] * options['changed']), 1)
+        timings, queries = [], []
+        for i in range(options['rounds'] + 1):
+            #The first round creates every tag, the others replace a slice of them with new ones
+            text = ', '.join(f'benchmark tag {j}' for j in range(i * step, i * step + options['tags']))
+            counter = QueryCounter()
+            with connection.execute_wrapper(counter):
+                start = perf_counter()
+                METHODS[method](post, text)
+                timings.append(perf_counter() - start)
+            queries.append(counter.count)
+        if post.tags.count() != options['tags']:
+            raise CommandError(f'{method} left the post with {post.tags.count()} tag(s), expected {options["tags"]}')
+        return timings, queries
+
+    def handle(self, *args, **options):
+        if options['tags'] < 1 or options['rounds'] < 1:
+            raise CommandError('--tags and --rounds must be at least 1')
+        self.stdout.write(f'{options["tags"]} tag(s), {options["rounds"]} round(s) replacing {options["changed"]:.0%} of them')
+        self.stdout.write(f'{"method":<14}{"create ms":>12}{"queries":>10}{"update ms":>12}{"queries":>10}')
+        for method in METHODS:
+            with transaction.atomic():
+                timings, queries = self.run(method, options)
+                transaction.set_rollback(True)
+            updates = len(timings) - 1
+            self.stdout.write(
+                f'{method:<14}{timings[0] * 1000:>12.1f}{queries[0]:>10}'
+                f'{sum(timings[1:]) / updates * 1000:>12.1f}{sum(queries[1:]) / updates:>10.0f}'
+            )
@@ -1,10 +1,10 @@
 from django.core.management.base import BaseCommand, CommandError
 import os
 
-from blog.models import Post, Comment, Tag
+from blog.models import Post, Comment, CommentVote, Tag
 from django.contrib.auth.models import User
 from lorem_text import lorem
-from random import randrange
+from random import randrange, sample
 from math import floor
 from django.conf import settings
 
@@ -81,15 +81,13 @@ class Command(BaseCommand):
                 for j in range(tc):
                     comment = Comment(post=post, commenter=users[randrange(0, len(users)-1)], text=lorem.paragraph())
                     comment.save()
-                    total = randrange(0, 2000)
-                    p, lp = 0, -1
-                    for k in range(total):
-                        p = floor(100.0/(total*tc)*(k+(total*j)))
-                        if p != lp:
-                            print(f'\rGenerating posts... ({i+1}/{len(files)}) {p}%',end='')
-                            lp = p
-                        comment.commentvote_set.create(user=users[randrange(0, len(users)-1)], type='u' if randrange(0,2)==0 else 'd')
-                    comment.votes = comment.get_computed_votes()
+                    #Each user votes on a comment at most once
+                    votes = [CommentVote(comment=comment, user=user, type='u' if randrange(0,2)==0 else 'd') for user in sample(users, randrange(0, 2000))]
+                    CommentVote.objects.bulk_create(votes)
+                    print(f'\rGenerating posts... ({i+1}/{len(files)}) {floor(100.0*(j+1)/tc)}%',end='')
+                    comment.upvotes = sum(1 for vote in votes if vote.type == 'u')
+                    comment.downvotes = len(votes) - comment.upvotes
+                    comment.votes = comment.upvotes - comment.downvotes
                     comment.save()
 
 
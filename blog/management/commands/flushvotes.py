@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from blog.votes import flush_vote_deltas
+from time import sleep
+
+class Command(BaseCommand):
+    help = 'Apply buffered vote changes to the comment vote totals (see BLOG_VOTE_BUFFER)'
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of buffered votes to apply per transaction')
+        parser.add_argument('--loop', action='store_true', help='Keep running and flush every --interval seconds')
+        parser.add_argument('--interval', type=float, default=5)
+
+    def handle(self, *args, **options):
+        while True:
+            comments, deltas = flush_vote_deltas(batch_size=options['batch_size'])
+            if deltas or not options['loop']:
+                self.stdout.write(f'Applied {deltas} buffered vote(s) to {comments} comment(s)')
+            if not options['loop']:
+                break
+            sleep(options['interval'])
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from blog.models import Post
+from blog.rendering import get_renderer_version
+
+class Command(BaseCommand):
+    help = 'Re-render the stored html for posts rendered with an older markdown renderer'
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Re-render every post even if its stored html is current')
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        posts = Post.objects.all()
+        if not options['force']:
+            posts = posts.exclude(content_html_version=get_renderer_version())
+        posts = posts.only('id', 'content', 'content_html', 'excerpt', 'content_hash', 'content_html_version').order_by('id')
+        total, rendered = posts.count(), 0
+        self.stdout.write('Rendering posts...')
+        for i, post in enumerate(posts.iterator(chunk_size=options['chunk_size'])):
+            self.stdout.write(f'\r{i+1}/{total}', ending='')
+            if post.render_content(force=options['force']):
+                post.save(update_fields=['content_html', 'excerpt', 'content_hash', 'content_html_version'])
+                rendered += 1
+
+        self.stdout.write(f'\n{rendered} of {total} post(s) re-rendered')
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from blog.models import Post, Comment, Tag
+
+def count_by(queryset, field):
+    return Coalesce(Subquery(queryset.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(count=Count('id')).values('count')), 0)
+
+class Command(BaseCommand):
+    help = 'Recompute the stored post comment counts and tag post counts'
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Number of rows recounted per query')
+
+    def repair(self, model, field, actual, chunk_size):
+        #Only rows whose stored count differs from the recount are written
+        last_id, checked, fixed = 0, 0, 0
+        while True:
+            ids = list(model.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+            if not ids:
+                return checked, fixed
+            #Lock the rows so a comment or tag change landing mid-recount is applied on top of the fixed value
+            with transaction.atomic():
+                wrong = list(model.objects.select_for_update().filter(id__in=ids).annotate(actual=actual).exclude(**{field: F('actual')}).values_list('id', 'actual'))
+                model.objects.bulk_update([model(id=id, **{field: count}) for id, count in wrong], [field])
+            checked, fixed, last_id = checked + len(ids), fixed + len(wrong), ids[-1]
+
+    def handle(self, *args, **options):
+        chunk_size = max(options['chunk_size'], 1)
+        checked, fixed = self.repair(Post, 'comment_count', count_by(Comment.objects, 'post'), chunk_size)
+        self.stdout.write(f'Fixed {fixed} of {checked} post comment count(s)')
+        checked, fixed = self.repair(Tag, 'post_count', count_by(Post.tags.through.objects, 'tag'), chunk_size)
+        self.stdout.write(f'Fixed {fixed} of {checked} tag post count(s)')
@@ -1,20 +1,74 @@
 from django.core.management.base import BaseCommand, CommandError
-from blog.models import Comment
+from django.db import connection, connections
+from django.db.models import Min, Max
+from django.utils import timezone
+from blog.models import Comment, Watermark
+from blog.votes import validate_vote_totals
+from multiprocessing import get_context
+from datetime import timedelta
+
+WATERMARK_NAME = 'validatevotescache'
+
+def format_counts(counts):
+    return f'{counts[0]} (+{counts[1]}/-{counts[2]})'
+
+def validate_range(start, end, chunk_size, since):
+    checked, mismatches = 0, []
+    for chunk_start in range(start, end, chunk_size):
+        chunk_checked, chunk_mismatches = validate_vote_totals(chunk_start, min(chunk_start + chunk_size, end), since=since)
+        checked += chunk_checked
+        mismatches += chunk_mismatches
+    return checked, mismatches
+
+def validate_range_in_worker(args):
+    try:
+        return validate_range(*args)
+    finally:
+        connections.close_all()
 
 class Command(BaseCommand):
     help = 'Validate cached vote totals match actual vote counts'
     requires_migrations_checks = True
 
+    def add_arguments(self, parser):
+        parser.add_argument('--since-last-run', action='store_true', help='Only check comments created, voted on or whose voters were deleted since the last successful run')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Number of comment ids validated per query')
+        parser.add_argument('--workers', type=int, default=1, help='Number of processes to split the comment id range between')
+
     def handle(self, *args, **options):
-        comments = Comment.objects.all()
-        total, failed = comments.count(), 0
-        self.stdout.write('Validating comments...')
-        for i, comment in enumerate(comments):
-            self.stdout.write(f'\r{i+1}/{total}', ending='')
-            if comment.votes != comment.get_computed_votes():
-                self.stdout.write(f'\r{i+1}/{total} Missmatch found on comment id {comment.id} expected {comment.get_computed_votes()} got {comment.votes}')
-                comment.votes = comment.get_computed_votes()
-                failed += 1
-                comment.save()
-        
-        self.stdout.write(f'\n{failed} of {total} comment(s) failed to validate')
\ No newline at end of file
+        started_on = timezone.now()
+        since = Watermark.get(WATERMARK_NAME) if options['since_last_run'] else None
+        if options['since_last_run'] and not since:
+            self.stdout.write('No previous run recorded, validating every comment')
+
+        bounds = Comment.objects.aggregate(start=Min('id'), end=Max('id'))
+        if bounds['start'] is None:
+            self.stdout.write('No comments to validate')
+            return
+        start, end = bounds['start'], bounds['end'] + 1
+        workers, chunk_size = max(options['workers'], 1), max(options['chunk_size'], 1)
+        if workers > 1 and connection.vendor == 'sqlite':
+            self.stdout.write('SQLite only allows one writer at a time, ignoring --workers')
+            workers = 1
+
+        self.stdout.write('Validating comments...' if not since else f'Validating comments changed since {since}...')
+        if workers == 1:
+            results = [validate_range(start, end, chunk_size, since)]
+        else:
+            #Each worker gets an equal slice of the id range. Connections can't be shared with forked processes
+            step = -(-(end - start) // workers)
+            ranges = [(range_start, min(range_start + step, end), chunk_size, since) for range_start in range(start, end, step)]
+            connections.close_all()
+            with get_context('fork').Pool(workers) as pool:
+                results = pool.map(validate_range_in_worker, ranges)
+
+        total, failed = 0, 0
+        for checked, mismatches in results:
+            total += checked
+            failed += len(mismatches)
+            for comment_id, expected, found in mismatches:
+                self.stdout.write(f'Missmatch found on comment id {comment_id} expected {format_counts(expected)} got {format_counts(found)}')
+
+        #Overlap runs slightly so votes from transactions still in flight when this run started are checked next time
+        Watermark.set(WATERMARK_NAME, started_on - timedelta(minutes=1))
+        self.stdout.write(f'{failed} of {total} comment(s) failed to validate')
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:20
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Q
+
+
+def remove_duplicate_votes(apps, schema_editor):
+    # Keep only the most recent vote of each user on a comment and recount the affected comments
+    CommentVote = apps.get_model('blog', 'CommentVote')
+    Comment = apps.get_model('blog', 'Comment')
+    duplicates = CommentVote.objects.values('comment_id', 'user_id').annotate(count=Count('id'), keep=Max('id')).filter(count__gt=1)
+    affected_comments = set()
+    for duplicate in duplicates.iterator():
+        CommentVote.objects.filter(comment_id=duplicate['comment_id'], user_id=duplicate['user_id']).exclude(id=duplicate['keep']).delete()
+        affected_comments.add(duplicate['comment_id'])
+    affected_comments = sorted(affected_comments)
+    for i in range(0, len(affected_comments), 500):
+        totals = Comment.objects.filter(id__in=affected_comments[i:i+500]).annotate(
+            upvotes=Count('commentvote', filter=Q(commentvote__type='u')),
+            downvotes=Count('commentvote', filter=Q(commentvote__type='d')),
+        )
+        for comment in totals:
+            Comment.objects.filter(id=comment.id).update(votes=comment.upvotes - comment.downvotes)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0002_post_content_html'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_votes, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='commentvote',
+            constraint=models.UniqueConstraint(fields=('comment', 'user'), name='unique_comment_vote_per_user'),
+        ),
+    ]
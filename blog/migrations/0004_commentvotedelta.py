@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0003_unique_comment_vote_per_user'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommentVoteDelta',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('delta', models.SmallIntegerField()),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('comment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='blog.comment')),
+            ],
+        ),
+    ]
@@ -0,0 +1,90 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:29
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+from blog import ranking
+
+
+def backfill_vote_counts(apps, schema_editor):
+    # Count the existing votes of every comment and compute its ranking scores, 500 comments at a time
+    Comment = apps.get_model('blog', 'Comment')
+    last_id = 0
+    while True:
+        comments = list(Comment.objects.filter(id__gt=last_id).order_by('id').annotate(
+            upvote_count=Count('commentvote', filter=Q(commentvote__type='u')),
+            downvote_count=Count('commentvote', filter=Q(commentvote__type='d')),
+        ).only('id', 'created_on')[:500])
+        if not comments:
+            return
+        for comment in comments:
+            comment.upvotes, comment.downvotes = comment.upvote_count, comment.downvote_count
+            for field, score in ranking.get_scores(comment.upvotes, comment.downvotes, comment.created_on).items():
+                setattr(comment, field, score)
+        Comment.objects.bulk_update(comments, ['upvotes', 'downvotes'] + ranking.SCORE_FIELDS)
+        last_id = comments[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0005_comment_votes_updated_on_watermark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='downvotes',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='score_best',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='score_controversial',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='score_hot',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='upvotes',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='commentvotedelta',
+            name='downvotes_delta',
+            field=models.SmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='commentvotedelta',
+            name='upvotes_delta',
+            field=models.SmallIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_vote_counts, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', '-votes', '-id'], name='comment_post_top_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', '-score_best', '-id'], name='comment_post_best_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', '-score_hot', '-id'], name='comment_post_hot_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', '-score_controversial', '-id'], name='comment_post_controversial_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', '-created_on', '-id'], name='comment_post_recent_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:35
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_counts(apps, schema_editor):
+    Post = apps.get_model('blog', 'Post')
+    Comment = apps.get_model('blog', 'Comment')
+    Tag = apps.get_model('blog', 'Tag')
+    comments = Comment.objects.filter(post=OuterRef('pk')).order_by().values('post').annotate(count=Count('id')).values('count')
+    Post.objects.update(comment_count=Coalesce(Subquery(comments), 0))
+    posts = Post.tags.through.objects.filter(tag=OuterRef('pk')).order_by().values('tag').annotate(count=Count('id')).values('count')
+    Tag.objects.update(post_count=Coalesce(Subquery(posts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0007_list_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='comment_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='post_count',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(backfill_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:37
+
+from django.db import migrations, models
+from blog import rendering
+
+
+def backfill_excerpts(apps, schema_editor):
+    # content_html was added empty in 0002, so render it here too instead of building excerpts from nothing
+    Post = apps.get_model('blog', 'Post')
+    version = rendering.get_renderer_version()
+    posts = []
+    for post in Post.objects.only('id', 'content').iterator(chunk_size=500):
+        post.content_html = rendering.render_markdown(post.content)
+        post.excerpt = rendering.make_excerpt(post.content_html)
+        post.content_hash = rendering.content_hash(post.content)
+        post.content_html_version = version
+        posts.append(post)
+        if len(posts) >= 500:
+            Post.objects.bulk_update(posts, ['content_html', 'excerpt', 'content_hash', 'content_html_version'])
+            posts = []
+    Post.objects.bulk_update(posts, ['content_html', 'excerpt', 'content_hash', 'content_html_version'])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0008_post_comment_count_tag_post_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='excerpt',
+            field=models.CharField(blank=True, default='', max_length=300),
+        ),
+        migrations.RunPython(backfill_excerpts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+from django.db import migrations
+from blog import rendering
+
+
+def render_unrendered_posts(apps, schema_editor):
+    # Databases that ran 0009 before it rendered posts have blank html and excerpts for every post older than 0002
+    Post = apps.get_model('blog', 'Post')
+    version = rendering.get_renderer_version()
+    posts = []
+    for post in Post.objects.filter(content_html_version='').only('id', 'content').iterator(chunk_size=500):
+        post.content_html = rendering.render_markdown(post.content)
+        post.excerpt = rendering.make_excerpt(post.content_html)
+        post.content_hash = rendering.content_hash(post.content)
+        post.content_html_version = version
+        posts.append(post)
+        if len(posts) >= 500:
+            Post.objects.bulk_update(posts, ['content_html', 'excerpt', 'content_hash', 'content_html_version'])
+            posts = []
+    Post.objects.bulk_update(posts, ['content_html', 'excerpt', 'content_hash', 'content_html_version'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0009_post_excerpt'),
+    ]
+
+    operations = [
+        migrations.RunPython(render_unrendered_posts, migrations.RunPython.noop),
+    ]
@@ -1,15 +1,29 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import Permission, User, Group
 from django.db.models.deletion import CASCADE
-from django.db.models.signals import post_save, post_init, pre_save
+from django.db.models import F, Q
+from django.db.models.signals import post_save, post_init, pre_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
 from django.template.defaultfilters import slugify, truncatechars
 from django.urls import reverse
 from os.path import basename
 from .util import create_group_if_not_exists
+from notifications.fields import NotificationRelation
 from django.contrib.contenttypes.models import ContentType
-from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.conf import settings
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+from . import rendering, ranking
+from threading import local
+
+#Ids of the posts this thread is in the middle of deleting, so their cascaded comments don't update them
+_deleting_posts = local()
+
+def get_deleting_posts():
+    if not hasattr(_deleting_posts, 'ids'):
+        _deleting_posts.ids = set()
+    return _deleting_posts.ids
 
 class Post(models.Model):
     
@@ -17,13 +31,22 @@ class Post(models.Model):
     header_image = models.ImageField(null=True, blank=True, upload_to='blog_post_header_images/')
     header_image_name = models.CharField(null=True, blank=True, max_length=header_image.max_length)
     content = models.TextField(max_length=50000)
+    content_html = models.TextField(blank=True, default='')
+    content_hash = models.CharField(max_length=40, blank=True, default='')
+    content_html_version = models.CharField(max_length=16, blank=True, default='')
+    excerpt = models.CharField(max_length=rendering.EXCERPT_LENGTH, blank=True, default='')
     tags = models.ManyToManyField('Tag')
     author = models.ForeignKey('Author', on_delete=models.CASCADE)
+    comment_count = models.IntegerField(default=0)
     created_on = models.DateTimeField(auto_now_add=True)
     updated_on = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['-created_on']
+        indexes = [
+            models.Index(fields=['-created_on', '-id'], name='post_recent_idx'),
+            models.Index(fields=['author', '-created_on', '-id'], name='post_author_recent_idx'),
+        ]
         permissions = [
             ("create_own_post", "Can create a new post with themselves as the author"),
         ]
@@ -32,6 +55,11 @@ class Post(models.Model):
     def can_user_create(user):
         return (user.has_perm('blog.create_own_post') and user.author.visible)
 
+    #Just what post_list_base.html shows: the author and their user joined in and the post body left out
+    @staticmethod
+    def for_cards(queryset):
+        return queryset.select_related('author__user').defer('content', 'content_html')
+
     def get_absolute_url(self):
         return reverse('blog:post_detail', kwargs={'pk': self.pk})
 
@@ -47,6 +75,69 @@ class Post(models.Model):
     def tags_str(self):
         return ', '.join([tag.__str__() for tag in self.tags.all()])
 
+    #Set the posts tags from a comma separated list of names, only adding and removing the rows that changed
+    def set_tags(self, text):
+        with transaction.atomic():
+            tag_ids = set(Tag.get_or_create_all(Tag.parse_names(text)).values())
+            current = set(self.tags.values_list('id', flat=True))
+            if current - tag_ids:
+                self.tags.remove(*(current - tag_ids))
+            if tag_ids - current:
+                self.tags.add(*(tag_ids - current))
+
+    def render_content(self, force=False):
+        new_hash = rendering.content_hash(self.content)
+        version = rendering.get_renderer_version()
+        if force or new_hash != self.content_hash or version != self.content_html_version:
+            self.content_html = rendering.render_markdown(self.content)
+            self.excerpt = rendering.make_excerpt(self.content_html)
+            self.content_hash = new_hash
+            self.content_html_version = version
+            return True
+        return False
+
+    def get_content_html(self):
+        #Falls back to rendering on the fly if the stored html predates the current renderer (see the rendermarkdown command)
+        if self.content_html_version != rendering.get_renderer_version():
+            return mark_safe(rendering.render_markdown(self.content))
+        return mark_safe(self.content_html)
+
+    @receiver(pre_save, sender='blog.Post')
+    def render_post_content(sender, instance, **kwargs):
+        instance.render_content()
+
+    #Deleting a post removes its tag rows without sending m2m_changed
+    @receiver(pre_delete, sender='blog.Post')
+    def update_deleted_post_tag_counts(sender, instance, **kwargs):
+        Tag.objects.filter(post=instance).update(post_count=F('post_count') - 1)
+
+    #The collector sends pre_delete for every post before deleting anything, and deletes comments before their posts
+    @receiver(pre_delete, sender='blog.Post')
+    def mark_post_deleting(sender, instance, **kwargs):
+        get_deleting_posts().add(instance.pk)
+
+    @receiver(post_delete, sender='blog.Post')
+    def unmark_post_deleting(sender, instance, **kwargs):
+        get_deleting_posts().discard(instance.pk)
+
+    #Keeps Tag.post_count in step with post.tags (and tag.post_set). Removing or clearing only counts rows that actually existed
+    @receiver(m2m_changed, sender='blog.Post_tags')
+    def update_tag_post_counts(sender, instance, action, reverse, pk_set, **kwargs):
+        if action in ('pre_remove', 'pre_clear'):
+            rows = sender.objects.filter(tag=instance) if reverse else sender.objects.filter(post=instance)
+            if pk_set is not None:
+                rows = rows.filter(**{'post_id__in' if reverse else 'tag_id__in': pk_set})
+            instance._removed_tag_rows = list(rows.values_list('post_id' if reverse else 'tag_id', flat=True))
+        elif action in ('post_add', 'post_remove', 'post_clear'):
+            ids = pk_set if action == 'post_add' else instance.__dict__.pop('_removed_tag_rows', [])
+            if not ids:
+                return
+            change = 1 if action == 'post_add' else -1
+            if reverse:
+                Tag.objects.filter(pk=instance.pk).update(post_count=F('post_count') + change * len(ids))
+            else:
+                Tag.objects.filter(pk__in=ids).update(post_count=F('post_count') + change)
+
     def get_header_image_file_name(self):
         if self.header_image_name and self.header_image:
             return basename(self.header_image_name)
@@ -63,15 +154,36 @@ class Comment(models.Model):
     post = models.ForeignKey(Post, on_delete=models.CASCADE)
     text = models.TextField(max_length=5000)
     votes = models.IntegerField(default=0)
+    upvotes = models.IntegerField(default=0)
+    downvotes = models.IntegerField(default=0)
+    #Derived from the vote counts (see ranking.py), kept up to date wherever the counts change
+    score_best = models.FloatField(default=0)
+    score_hot = models.FloatField(default=0)
+    score_controversial = models.FloatField(default=0)
+    votes_updated_on = models.DateTimeField(null=True, blank=True, db_index=True)
     created_on = models.DateTimeField(auto_now_add=True)
     updated_on = models.DateTimeField(auto_now=True)
+    notifications = NotificationRelation()
+    archived_notifications = GenericRelation('notifications.ArchivedNotification')
 
     class Meta:
         permissions = [
             ("delete_comments_on_own_post", "Can delete any comment left on a post they created"),
         ]
+        indexes = [
+            models.Index(fields=['post', '-votes', '-id'], name='comment_post_top_idx'),
+            models.Index(fields=['post', '-score_best', '-id'], name='comment_post_best_idx'),
+            models.Index(fields=['post', '-score_hot', '-id'], name='comment_post_hot_idx'),
+            models.Index(fields=['post', '-score_controversial', '-id'], name='comment_post_controversial_idx'),
+            models.Index(fields=['post', '-created_on', '-id'], name='comment_post_recent_idx'),
+            models.Index(fields=['commenter', '-created_on', '-id'], name='comment_commenter_recent_idx'),
+        ]
         
     class NotificationsMeta:
+        notification_select_related = ['commenter__author', 'post']
+        notification_defer = ['post__content', 'post__content_html']
+        notification_target = 'post'
+        notification_actor = 'commenter'
         notifications = [
             ('new_comment_on_post', 'New reply to post', 'When someone submits a comment one of your posts')
         ]
@@ -89,9 +201,43 @@ class Comment(models.Model):
         return self.cached_votes
         #return -1234
 
+    def update_scores(self):
+        for field, score in ranking.get_scores(self.upvotes, self.downvotes, self.created_on or timezone.now()).items():
+            setattr(self, field, score)
+
+    #Partial saves (update_fields) are left alone, they'd skip writing the scores anyway
+    @receiver(pre_save, sender='blog.Comment')
+    def update_comment_scores(sender, instance, update_fields=None, **kwargs):
+        if update_fields is None:
+            instance.update_scores()
+
+    @receiver(post_save, sender='blog.Comment')
+    def increment_post_comment_count(sender, instance, created, **kwargs):
+        if created:
+            Post.objects.filter(pk=instance.post_id).update(comment_count=F('comment_count') + 1)
+
+    @receiver(post_delete, sender='blog.Comment')
+    def decrement_post_comment_count(sender, instance, **kwargs):
+        if instance.post_id not in get_deleting_posts():
+            Post.objects.filter(pk=instance.post_id).update(comment_count=F('comment_count') - 1)
+
     def has_voted(self, user, type):
+        preloaded_votes = getattr(self, 'preloaded_votes', None)
+        if preloaded_votes is not None and user.pk in preloaded_votes:
+            return preloaded_votes[user.pk] == type
         return self.commentvote_set.filter(user=user, type=type).exists()
 
+    #Fetch the users votes on all of the comments in one query so has_voted doesn't need a query per comment
+    @staticmethod
+    def preload_votes(comments, user):
+        comments = list(comments)
+        if not user.is_authenticated or not comments:
+            return comments
+        votes = dict(CommentVote.objects.filter(user=user, comment__in=comments).values_list('comment_id', 'type'))
+        for comment in comments:
+            comment.preloaded_votes = {user.pk: votes.get(comment.pk)}
+        return comments
+
     def __str__(self):
         return f'{self.commenter}: {truncatechars(self.text, 100)}'
 
@@ -105,6 +251,38 @@ class CommentVote(models.Model):
     comment = models.ForeignKey(Comment, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['comment', 'user'], name='unique_comment_vote_per_user'),
+        ]
+
+    #The votes of a deleted user are cascaded without touching the comment totals, mark the comments so
+    #validatevotescache --since-last-run picks up the drift
+    @receiver(pre_delete, sender=User)
+    def mark_deleted_user_votes(sender, instance, **kwargs):
+        Comment.objects.filter(commentvote__user=instance).update(votes_updated_on=timezone.now())
+
+#Append-only log of vote changes not yet applied to comment.votes (only used when BLOG_VOTE_BUFFER is enabled, see flushvotes)
+class CommentVoteDelta(models.Model):
+    comment = models.ForeignKey(Comment, on_delete=models.CASCADE)
+    delta = models.SmallIntegerField()
+    upvotes_delta = models.SmallIntegerField(default=0)
+    downvotes_delta = models.SmallIntegerField(default=0)
+    created_on = models.DateTimeField(auto_now_add=True)
+
+#Named timestamps used by maintenance commands to only process rows changed since their last run
+class Watermark(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    value = models.DateTimeField()
+
+    @staticmethod
+    def get(name):
+        return Watermark.objects.filter(name=name).values_list('value', flat=True).first()
+
+    @staticmethod
+    def set(name, value):
+        Watermark.objects.update_or_create(name=name, defaults={'value': value})
+
 class Author(models.Model):
     AUTHOR_PERMS = ['modify_own_author', 'create_own_post', 'delete_comments_on_own_post']
     MOD_PERMS = ['delete_comment', 'delete_post', 'change_author', 'delete_user']
@@ -160,11 +338,41 @@ class Author(models.Model):
 class Tag(models.Model):
     slug = models.SlugField(unique=True, null=True, blank=True)
     name = models.CharField(max_length=50, unique=True)
+    post_count = models.IntegerField(default=0, db_index=True)
 
     @receiver(pre_save, sender='blog.Tag')
     def save_tag(sender, instance, **kwargs):
         instance.slug = slugify(instance.name)
 
+    #Returns {slug: name} for a comma separated list of tag names, the first name given for a slug wins
+    @staticmethod
+    def parse_names(text):
+        names = {}
+        for name in text.lower().split(','):
+            name = name.strip()[:Tag._meta.get_field('name').max_length].strip()
+            slug = slugify(name)
+            if slug and slug not in names:
+                names[slug] = name
+        return names
+
+    #Returns {slug: id} for the {slug: name} tags, creating the missing ones in one query
+    @staticmethod
+    def get_or_create_all(names):
+        tags = dict(Tag.objects.filter(slug__in=names).values_list('slug', 'id'))
+        missing = [Tag(slug=slug, name=name) for slug, name in names.items() if slug not in tags]
+        if missing:
+            #bulk_create skips the pre_save slug receiver, hence the explicit slugs. Tags created by
+            #another request in the meantime are ignored here and picked up by the second lookup, as are
+            #existing tags with the same name whose slug is missing or different
+            Tag.objects.bulk_create(missing, ignore_conflicts=True)
+            slugs = {tag.name: tag.slug for tag in missing}
+            found = Tag.objects.filter(Q(slug__in=slugs.values()) | Q(name__in=slugs)).values_list('slug', 'name', 'id')
+            tags.update((slug, id) for slug, name, id in found if slug in names)
+            for slug, name, id in found:
+                if name in slugs:
+                    tags.setdefault(slugs[name], id)
+        return tags
+
     def __str__(self):
         return self.name
         
\ No newline at end of file
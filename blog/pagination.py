@@ -0,0 +1,132 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from datetime import datetime
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.http import Http404
+from django.utils.functional import cached_property
+
+def get_offset_pages():
+    return getattr(settings, 'BLOG_OFFSET_PAGES', 5)
+
+#Offset paginator that stops counting after max_pages worth of rows so the COUNT(*) stays cheap on large tables
+class BoundedPaginator(Paginator):
+
+    def __init__(self, object_list, per_page, max_pages, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.max_pages = max_pages
+        self.has_more = False
+
+    @cached_property
+    def count(self):
+        limit = self.max_pages * self.per_page
+        count = self.object_list[:limit + 1].count()
+        self.has_more = count > limit
+        return min(count, limit)
+
+#Page of a cursor paginated list. There is no page number or total, only links to the pages either side
+class CursorPage:
+    number = None
+    paginator = None
+
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+def flip(ordering):
+    return ordering[1:] if ordering.startswith('-') else f'-{ordering}'
+
+#Cursors are the ordering values of the first or last row of a page and which way to read from it, as urlsafe base64 json
+def encode_cursor(obj, ordering, direction):
+    values = [getattr(obj, field.lstrip('-')) for field in ordering]
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return urlsafe_b64encode(json.dumps([direction] + values).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, model, ordering):
+    try:
+        direction, *values = json.loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if direction not in ('n', 'p') or len(values) != len(ordering):
+            raise ValueError
+        return direction, [model._meta.get_field(field.lstrip('-')).to_python(value) for field, value in zip(ordering, values)]
+    except (ValueError, TypeError, Base64Error, ValidationError):
+        raise Http404('Invalid cursor')
+
+#Rows after values in the given ordering: (a > x) or (a = x and b > y) or ... with each comparison following its fields direction
+def get_keyset_filter(ordering, values):
+    condition, equal = Q(), {}
+    for field, value in zip(ordering, values):
+        name = field.lstrip('-')
+        condition |= Q(**equal, **{f'{name}__{"lt" if field.startswith("-") else "gt"}': value})
+        equal[name] = value
+    return condition
+
+#ListView mixin serving the first BLOG_OFFSET_PAGES pages with ?page= (counting at most that many pages of rows) and
+#every page after that with an opaque ?cursor=, which filters on the ordering columns instead of using an OFFSET.
+#The ordering has to be made of non null columns on the model, id is appended to it to make it unique
+class CursorPaginationMixin:
+    cursor_param = 'cursor'
+
+    def get_pagination_ordering(self, queryset):
+        ordering = list(queryset.query.order_by or queryset.model._meta.ordering)
+        ordering = [field.replace('pk', 'id') if field.lstrip('-') == 'pk' else field for field in ordering]
+        if not ordering or ordering[-1].lstrip('-') != 'id':
+            ordering.append('-id' if ordering and ordering[-1].startswith('-') else 'id')
+        return ordering
+
+    def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True, **kwargs):
+        return BoundedPaginator(queryset, per_page, get_offset_pages(), orphans=orphans, allow_empty_first_page=allow_empty_first_page, **kwargs)
+
+    def paginate_queryset(self, queryset, page_size):
+        ordering = self.get_pagination_ordering(queryset)
+        queryset = queryset.order_by(*ordering)
+        cursor = self.request.GET.get(self.cursor_param)
+        if cursor:
+            page = self.get_cursor_page(queryset, page_size, ordering, cursor)
+            return page.paginator, page, page.object_list, True
+
+        paginator, page, object_list, is_paginated = super().paginate_queryset(queryset, page_size)
+        page.object_list = list(page.object_list)
+        page.next_cursor = None
+        if page.number == paginator.num_pages and paginator.has_more and page.object_list:
+            page.next_cursor = encode_cursor(page.object_list[-1], ordering, 'n')
+        return paginator, page, page.object_list, is_paginated or page.next_cursor is not None
+
+    def get_cursor_page(self, queryset, page_size, ordering, cursor):
+        direction, values = decode_cursor(cursor, queryset.model, ordering)
+        if direction == 'p':
+            #Read backwards from the cursor and put the rows back in display order
+            ordering = [flip(field) for field in ordering]
+            queryset = queryset.order_by(*ordering)
+        rows = list(queryset.filter(get_keyset_filter(ordering, values))[:page_size + 1])
+        more, rows = len(rows) > page_size, rows[:page_size]
+        if direction == 'p':
+            ordering = [flip(field) for field in ordering]
+            rows.reverse()
+        has_next, has_previous = (more, True) if direction == 'n' else (True, more)
+        return CursorPage(
+            rows,
+            encode_cursor(rows[-1], ordering, 'n') if has_next and rows else None,
+            encode_cursor(rows[0], ordering, 'p') if has_previous and rows else None,
+        )
@@ -0,0 +1,46 @@
+from math import log10, sqrt
+
+#z score for the 80% confidence interval used by the "best" sort
+WILSON_Z = 1.281551565545
+#Hot scores are relative to this date, every HOT_DECAY_SECONDS newer is worth the same as 10x the net votes
+HOT_EPOCH = 1134028003
+HOT_DECAY_SECONDS = 45000
+
+SCORE_FIELDS = ['score_best', 'score_hot', 'score_controversial']
+
+#Comment orderings for the sort parameter, each backed by a (post, ...) index on Comment
+COMMENT_ORDERINGS = {
+    'top': ['-votes', '-id'],
+    'best': ['-score_best', '-id'],
+    'hot': ['-score_hot', '-id'],
+    'controversial': ['-score_controversial', '-id'],
+    'recent': ['-created_on', '-id'],
+}
+
+#Lower bound of the Wilson score interval for the fraction of upvotes, so a few votes don't outrank many
+def best_score(upvotes, downvotes):
+    total = upvotes + downvotes
+    if total <= 0:
+        return 0.0
+    positive = upvotes / total
+    z2 = WILSON_Z * WILSON_Z
+    return (positive + z2 / (2 * total) - WILSON_Z * sqrt((positive * (1 - positive) + z2 / (4 * total)) / total)) / (1 + z2 / total)
+
+def hot_score(upvotes, downvotes, created_on):
+    net = upvotes - downvotes
+    sign = (net > 0) - (net < 0)
+    return round(sign * log10(max(abs(net), 1)) + (created_on.timestamp() - HOT_EPOCH) / HOT_DECAY_SECONDS, 7)
+
+#Many votes split close to evenly rank highest
+def controversial_score(upvotes, downvotes):
+    if upvotes <= 0 or downvotes <= 0:
+        return 0.0
+    balance = downvotes / upvotes if upvotes > downvotes else upvotes / downvotes
+    return float((upvotes + downvotes) ** balance)
+
+def get_scores(upvotes, downvotes, created_on):
+    return {
+        'score_best': best_score(upvotes, downvotes),
+        'score_hot': hot_score(upvotes, downvotes, created_on),
+        'score_controversial': controversial_score(upvotes, downvotes),
+    }
@@ -0,0 +1,192 @@
+from collections import OrderedDict
+from hashlib import sha1
+from threading import Lock, local
+from bleach.sanitizer import ALLOWED_TAGS as BLEACH_ALLOWED_TAGS, Cleaner
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.template.defaultfilters import escape
+from django.utils.html import strip_tags
+from django.utils.text import Truncator
+from html import unescape
+from markdown import Markdown
+
+ALLOWED_TAGS = ['p', 'pre', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'br'] + BLEACH_ALLOWED_TAGS
+MARKDOWN_EXTENSIONS = []
+DEFAULT_BACKEND = 'markdown'
+
+#Bump this when the output of render_markdown changes in a way the tag/extension lists don't capture
+RENDERER_REVISION = 1
+
+#Markdown backends. Each thread builds its own instance (none of the parsers are thread safe) and reuses it for every document
+class PythonMarkdownBackend:
+    name = 'markdown'
+
+    def __init__(self):
+        self.parser = Markdown(extensions=MARKDOWN_EXTENSIONS)
+
+    def convert(self, text):
+        #Markdown instances keep state (footnotes, references etc.) from the previous document until reset
+        return self.parser.reset().convert(text)
+
+class MarkdownItBackend:
+    name = 'markdown-it'
+
+    def __init__(self):
+        from markdown_it import MarkdownIt
+        self.parser = MarkdownIt('commonmark', {'html': False})
+
+    def convert(self, text):
+        return self.parser.render(text)
+
+class CMarkGFMBackend:
+    name = 'cmarkgfm'
+
+    def __init__(self):
+        import cmarkgfm
+        self.markdown_to_html = cmarkgfm.markdown_to_html
+
+    def convert(self, text):
+        return self.markdown_to_html(text)
+
+BACKENDS = {backend.name: backend for backend in [PythonMarkdownBackend, MarkdownItBackend, CMarkGFMBackend]}
+
+def get_backend_name():
+    return getattr(settings, 'BLOG_MARKDOWN_BACKEND', DEFAULT_BACKEND)
+
+def get_available_backends():
+    available = []
+    for name, backend in BACKENDS.items():
+        try:
+            backend()
+            available.append(name)
+        except ImportError:
+            pass
+    return available
+
+class Renderer:
+    def __init__(self, backend_name):
+        if backend_name not in BACKENDS:
+            raise ImproperlyConfigured(f'Unknown BLOG_MARKDOWN_BACKEND {backend_name!r}, expected one of {", ".join(BACKENDS)}')
+        try:
+            self.backend = BACKENDS[backend_name]()
+        except ImportError as e:
+            raise ImproperlyConfigured(f'BLOG_MARKDOWN_BACKEND {backend_name!r} is not installed ({e})')
+        self.cleaner = Cleaner(tags=ALLOWED_TAGS)
+
+    def render(self, text):
+        return self.cleaner.clean(self.backend.convert(escape(text)))
+
+_thread_renderers = local()
+
+def get_renderer(backend_name=None):
+    backend_name = backend_name or get_backend_name()
+    renderers = getattr(_thread_renderers, 'renderers', None)
+    if renderers is None:
+        renderers = _thread_renderers.renderers = {}
+    if backend_name not in renderers:
+        renderers[backend_name] = Renderer(backend_name)
+    return renderers[backend_name]
+
+_renderer_versions = {}
+
+def get_renderer_version(backend_name=None):
+    #Stored alongside pre-rendered html so changing the backend, allowed tags or extensions invalidates it
+    backend_name = backend_name or get_backend_name()
+    if backend_name not in _renderer_versions:
+        fingerprint = repr((RENDERER_REVISION, backend_name, ALLOWED_TAGS, MARKDOWN_EXTENSIONS))
+        _renderer_versions[backend_name] = sha1(fingerprint.encode('utf-8')).hexdigest()[:16]
+    return _renderer_versions[backend_name]
+
+def content_hash(text):
+    return sha1((text or '').encode('utf-8')).hexdigest()
+
+def render_markdown(text, backend_name=None):
+    return get_renderer(backend_name).render(text)
+
+EXCERPT_LENGTH = 300
+
+#Plain text start of rendered html with the markup and extra whitespace removed, for post cards
+def make_excerpt(html, length=EXCERPT_LENGTH):
+    return Truncator(' '.join(unescape(strip_tags(html)).split())).chars(length)
+
+#Rendered comment html keyed by (comment id, updated_on, renderer version). Keeps a bounded in-process LRU
+#and, if BLOG_COMMENT_CACHE_ALIAS names one of the configured CACHES, a shared tier other workers can reuse
+class CommentHTMLCache:
+
+    def __init__(self, max_size=None, cache_alias=None):
+        self.max_size = max_size
+        self.cache_alias = cache_alias
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits, self.shared_hits, self.misses = 0, 0, 0
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        self.reset_stats()
+
+    def get_max_size(self):
+        if self.max_size is None:
+            return getattr(settings, 'BLOG_COMMENT_CACHE_SIZE', 1000)
+        return self.max_size
+
+    def get_shared_cache(self):
+        alias = self.cache_alias or getattr(settings, 'BLOG_COMMENT_CACHE_ALIAS', None)
+        return caches[alias] if alias else None
+
+    def get_shared_key(self, comment, version):
+        return f'blog:comment_html:{comment.pk}:{comment.updated_on.timestamp()}:{version}'
+
+    def get_html(self, comment):
+        version = get_renderer_version()
+        stamp = (comment.updated_on, version)
+        with self.lock:
+            entry = self.entries.get(comment.pk)
+            if entry and entry[0] == stamp:
+                self.entries.move_to_end(comment.pk)
+                self.hits += 1
+                return entry[1]
+
+        shared_cache = self.get_shared_cache()
+        html = shared_cache.get(self.get_shared_key(comment, version)) if shared_cache else None
+        shared_hit = html is not None
+        if not shared_hit:
+            html = render_markdown(comment.text)
+            if shared_cache:
+                shared_cache.set(self.get_shared_key(comment, version), html)
+
+        with self.lock:
+            if shared_hit:
+                self.shared_hits += 1
+            else:
+                self.misses += 1
+            self.entries[comment.pk] = (stamp, html)
+            self.entries.move_to_end(comment.pk)
+            while len(self.entries) > self.get_max_size():
+                self.entries.popitem(last=False)
+        return html
+
+    #Must be called with the comment as it was before the edit so the shared entry can be found
+    def invalidate(self, comment):
+        with self.lock:
+            self.entries.pop(comment.pk, None)
+        shared_cache = self.get_shared_cache()
+        if shared_cache and comment.updated_on:
+            shared_cache.delete(self.get_shared_key(comment, get_renderer_version()))
+
+    def get_stats(self):
+        lookups = self.hits + self.shared_hits + self.misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.get_max_size(),
+            'hits': self.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.shared_hits) / lookups if lookups else 0,
+        }
+
+comment_html_cache = CommentHTMLCache()
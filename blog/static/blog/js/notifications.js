@@ -0,0 +1,21 @@
+
+//Long-polls the live notification endpoint, keeping the unread badges and the notification list (if on the page) current
+function pollNotifications(url, since, count){
+    var params = {count: count};
+    if (since !== null)
+        params.since = since;
+    $.getJSON(url, params)
+        .done(function(data){
+            $('.unread-notification-count').text(data.count).toggleClass('d-none', data.count == 0);
+            var list = $('#notification-list');
+            for (var i = data.notifications.length - 1; i >= 0; i--){
+                //Folded notifications come back with the same id, move them to the top
+                list.children('[data-id="' + data.notifications[i].id + '"]').remove();
+                list.prepend($('<li class="list-group-item"></li>').attr('data-id', data.notifications[i].id).html(data.notifications[i].html));
+            }
+            pollNotifications(url, data.since, data.count);
+        })
+        .fail(function(){
+            setTimeout(function(){ pollNotifications(url, since, count); }, 30000);
+        });
+}
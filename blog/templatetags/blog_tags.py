@@ -1,12 +1,8 @@
-from bleach.sanitizer import ALLOWED_TAGS
 from django import template
 from django.db.models import query
-from math import floor
 from os.path import join
 from django.utils.safestring import mark_safe
-from django.template.defaultfilters import escape
-from markdown import Markdown
-from bleach import clean
+from blog.rendering import render_markdown, comment_html_cache
 
 register = template.Library()
 
@@ -14,6 +10,9 @@ register = template.Library()
 def format_pages(context, num_entries):
     page_obj = context.get('page_obj', None)
     pages = []
+    if page_obj and page_obj.number is None:
+        #Cursor pages don't know their position, only offer a way back to the start
+        return [1, '...']
     if page_obj:
         if page_obj.number - num_entries > 1:
             pages.append(1)
@@ -24,16 +23,26 @@ def format_pages(context, num_entries):
         if page_obj.number + num_entries < page_obj.paginator.num_pages:
             pages.append('...')
             pages.append(page_obj.paginator.num_pages)
+        if getattr(page_obj.paginator, 'has_more', False):
+            pages.append('...')
     return pages
 
 @register.simple_tag(takes_context=True)
 def current_url(context, *args):
     params = context['request'].GET.copy()
-    for i in range(floor(len(args)/2)):
-        params[args[i]] = args[i+1] if len(args) > i+1 else ''
+    for i in range(0, len(args) - 1, 2):
+        #Passing None removes the parameter
+        if args[i+1] is None:
+            params.pop(args[i], None)
+        else:
+            params[args[i]] = args[i+1]
     query_str = '&'.join(f'{k}={v}' for k, v in params.items())
     return f"{context['request'].path}?{query_str}"
 
 @register.simple_tag
 def markdown(text):
-    return mark_safe(clean(Markdown().convert(escape(text)), tags=['p', 'pre', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'br'] + ALLOWED_TAGS))
+    return mark_safe(render_markdown(text))
+
+@register.simple_tag
+def comment_markdown(comment):
+    return mark_safe(comment_html_cache.get_html(comment))
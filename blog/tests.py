@@ -1,9 +1,13 @@
 from datetime import timedelta
-from django.test import TestCase, override_settings
+from django.test import TestCase, TransactionTestCase, override_settings
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
 from django.urls import reverse
 from django.contrib.auth.models import Permission, User, Group
 from django.contrib.auth import authenticate
-from .models import Author, Tag, Post, Comment
+from .models import Author, Tag, Post, Comment, CommentVote, CommentVoteDelta, Watermark
+from . import ranking
+from .votes import toggle_vote, flush_vote_deltas
 from django.db.utils import IntegrityError
 from django.utils import timezone
 from django.conf import settings
@@ -12,6 +16,17 @@ from os import makedirs, copy_file_range, stat
 from PIL import Image
 from shutil import copyfile
 from .util import user_in_group
+from .rendering import get_renderer_version, get_renderer, render_markdown, CommentHTMLCache, comment_html_cache
+from django.core.exceptions import ImproperlyConfigured
+from threading import Thread, Lock
+from contextlib import nullcontext
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.db.models.query import QuerySet
+from django.core.management import call_command
+from io import StringIO
+from jobs.models import Job
+from jobs.worker import run_pending_jobs
 
 TEST_RESOURCES_PATH = getattr(settings, 'TEST_RESOURCES_PATH', 'test_resources')
 TEST_MEDIA_ROOT = join(settings.BASE_DIR, 'test_resources/test_uploads_dir/')
@@ -51,12 +66,18 @@ def create_post(author, title, content, header_image=None):
     post.save()
     return post
 
+#Users are limited to one vote per comment so votes are spread over a pool of voter accounts
+def get_voters(count):
+    voters = list(User.objects.filter(username__startswith='test_voter_').order_by('id')[:count])
+    if len(voters) < count:
+        User.objects.bulk_create([User(username=f'test_voter_{i}') for i in range(len(voters), count)])
+        voters = list(User.objects.filter(username__startswith='test_voter_').order_by('id')[:count])
+    return voters
+
 def create_comment(post, commenter, text, upvotes, downvotes):
-    comment = post.comment_set.create(commenter=commenter, text=text, votes = upvotes - downvotes)
-    for i in range(upvotes):
-        comment.commentvote_set.create(type='u', user=commenter)
-    for i in range(downvotes):
-        comment.commentvote_set.create(type='d', user=commenter)
+    comment = post.comment_set.create(commenter=commenter, text=text, votes = upvotes - downvotes, upvotes=upvotes, downvotes=downvotes)
+    voters = get_voters(upvotes + downvotes)
+    CommentVote.objects.bulk_create([CommentVote(comment=comment, user=voter, type='u' if i < upvotes else 'd') for i, voter in enumerate(voters)])
     return comment
 
 def reload_user(user):
@@ -143,11 +164,118 @@ class TagModelTest(TestCase):
         tag.save()
         self.assertEqual(tag.slug, 'test-tag')
 
+    def post_counts(self, *tags):
+        return [Tag.objects.get(pk=tag.pk).post_count for tag in tags]
+
+    def test_tag_post_count_follows_post_tags(self):
+        user = create_user('test_user', 'test_pass')
+        posts = [create_post(user, f'post_{i}', 'content') for i in range(3)]
+        tags = [Tag.objects.create(name=f'tag_{i}') for i in range(2)]
+        posts[0].tags.add(*tags)
+        posts[0].tags.add(tags[0])
+        posts[1].tags.add(tags[0])
+        tags[1].post_set.add(posts[1], posts[2])
+        self.assertEqual(self.post_counts(*tags), [2, 3])
+        posts[1].tags.remove(*tags)
+        posts[1].tags.remove(*tags)
+        self.assertEqual(self.post_counts(*tags), [1, 2])
+        posts[0].tags.clear()
+        self.assertEqual(self.post_counts(*tags), [0, 1])
+        tags[1].post_set.clear()
+        posts[2].tags.add(tags[0])
+        posts[2].delete()
+        self.assertEqual(self.post_counts(*tags), [0, 0])
+
+    def test_tag_index_only_lists_tags_with_posts_sorted_by_post_count(self):
+        user = create_user('test_user', 'test_pass')
+        posts = [create_post(user, f'post_{i}', 'content') for i in range(3)]
+        tags = [Tag.objects.create(name=f'tag_{i}') for i in range(4)]
+        for i, tag in enumerate(tags[:3]):
+            tag.post_set.add(*posts[:i + 1])
+        resp = self.client.get(reverse('blog:tag_index'))
+        self.assertEqual(list(resp.context['tag_list']), [tags[2], tags[1], tags[0]])
+        self.assertContains(resp, '(3)')
+        resp = self.client.get(reverse('blog:tag_index'), data={'sort': 'least_posts'})
+        self.assertEqual(list(resp.context['tag_list']), [tags[0], tags[1], tags[2]])
+
+    def test_set_tags_only_changes_added_and_removed_tags(self):
+        post = create_post(create_user('test_user', 'test_pass'), 'post', 'content')
+        post.set_tags('One, two, ,TWO!, three')
+        self.assertEqual(sorted(post.tags.values_list('slug', flat=True)), ['one', 'three', 'two'])
+        kept = post.tags.through.objects.get(post=post, tag__slug='two').pk
+        post.set_tags('two, four')
+        self.assertEqual(sorted(post.tags.values_list('slug', flat=True)), ['four', 'two'])
+        self.assertEqual(post.tags.through.objects.get(post=post, tag__slug='two').pk, kept)
+        self.assertEqual(Tag.objects.get(slug='one').post_count, 0)
+        self.assertEqual(Tag.objects.get(slug='four').post_count, 1)
+
+    def test_set_tags_uses_existing_tags_with_the_same_name_and_another_slug(self):
+        post = create_post(create_user('test_user', 'test_pass'), 'post', 'content')
+        unslugged, renamed = Tag.objects.create(name='one'), Tag.objects.create(name='two')
+        Tag.objects.filter(pk=unslugged.pk).update(slug=None)
+        Tag.objects.filter(pk=renamed.pk).update(slug='old-two')
+        post.set_tags('one, two, three')
+        self.assertEqual(sorted(post.tags.values_list('name', flat=True)), ['one', 'three', 'two'])
+        self.assertEqual(Tag.objects.count(), 3)
+
+    def test_set_tags_query_count_does_not_depend_on_number_of_tags(self):
+        user = create_user('test_user', 'test_pass')
+        small_post, large_post = create_post(user, 'small', 'content'), create_post(user, 'large', 'content')
+        Tag.objects.create(name='existing')
+        with CaptureQueriesContext(connection) as small:
+            small_post.set_tags('existing, new')
+        with CaptureQueriesContext(connection) as large:
+            large_post.set_tags(', '.join(f'tag {i}' for i in range(200)) + ', existing')
+        self.assertEqual(len(small), len(large))
+        self.assertEqual(large_post.tags.count(), 201)
+
+    def test_benchmarktags_command_leaves_no_rows_behind(self):
+        out = StringIO()
+        call_command('benchmarktags', '--tags', '20', '--rounds', '2', stdout=out)
+        self.assertIn('set_tags', out.getvalue())
+        self.assertFalse(Tag.objects.exists())
+        self.assertFalse(Post.objects.exists())
+
+    def test_repaircounts_command_fixes_stored_counts(self):
+        user = create_user('test_user', 'test_pass')
+        post = create_post(user, 'post', 'content')
+        post.comment_set.create(commenter=user, text='comment')
+        tag = Tag.objects.create(name='tag')
+        post.tags.add(tag)
+        Post.objects.update(comment_count=10)
+        Tag.objects.update(post_count=0)
+        out = StringIO()
+        call_command('repaircounts', stdout=out)
+        self.assertIn('Fixed 1 of 1 post comment count(s)', out.getvalue())
+        self.assertIn('Fixed 1 of 1 tag post count(s)', out.getvalue())
+        self.assertEqual(Post.objects.get(pk=post.pk).comment_count, 1)
+        self.assertEqual(Tag.objects.get(pk=tag.pk).post_count, 1)
+
 class PostModelTest(TestCase):
 
     def setUp(self):
         self.user = create_user('test_user', 'test_pass')
 
+    def test_comment_count_follows_comments(self):
+        post = create_post(self.user, 'post', 'content')
+        comments = [post.comment_set.create(commenter=self.user, text=f'comment_{i}') for i in range(3)]
+        comments[0].save()
+        comments[1].delete()
+        self.assertEqual(Post.objects.get(pk=post.pk).comment_count, 2)
+
+    def test_deleting_a_post_doesnt_update_it_for_each_comment(self):
+        post = create_post(self.user, 'post', 'content')
+        other_post = create_post(self.user, 'other_post', 'content')
+        for i in range(5):
+            post.comment_set.create(commenter=self.user, text=f'comment_{i}')
+        other_post.comment_set.create(commenter=self.user, text='other_comment')
+        with CaptureQueriesContext(connection) as queries:
+            post.delete()
+        self.assertFalse([query for query in queries.captured_queries if 'comment_count' in query['sql']])
+        #Comments of posts that aren't being deleted still count down
+        other_post.comment_set.get().delete()
+        self.assertEqual(Post.objects.get(pk=other_post.pk).comment_count, 0)
+
     def test_has_been_edited_returns_false_for_new_posts(self):
         post = Post(author=self.user.author, title='test', content='test', updated_on=timezone.now() + timedelta(seconds=59))
         post.save()
@@ -159,13 +287,224 @@ class PostModelTest(TestCase):
         post.updated_on=timezone.now() + timedelta(seconds=60)
         self.assertTrue(post.has_been_edited())
 
+    def test_saving_post_stores_rendered_content_html(self):
+        post = Post(author=self.user.author, title='test', content='# heading\n\n<script>alert(1)</script>')
+        post.save()
+        post = Post.objects.get(pk=post.pk)
+        self.assertIn('<h1>heading</h1>', post.content_html)
+        self.assertNotIn('<script>', post.content_html)
+        self.assertEqual(post.content_html_version, get_renderer_version())
+
+    def test_saving_post_stores_plain_text_excerpt(self):
+        post = create_post(self.user, 'test', '# Heading\n\nSome **bold** &amp; <b>text</b>\n\n' + 'word ' * 200)
+        self.assertTrue(post.excerpt.startswith('Heading Some bold &amp; <b>text</b> word word'))
+        self.assertLessEqual(len(post.excerpt), Post._meta.get_field('excerpt').max_length)
+
+    def test_saving_post_without_content_changes_does_not_rerender(self):
+        post = Post(author=self.user.author, title='test', content='test')
+        post.save()
+        Post.objects.filter(pk=post.pk).update(content_html='cached_html')
+        post = Post.objects.get(pk=post.pk)
+        post.title = 'new title'
+        post.save()
+        self.assertEqual(Post.objects.get(pk=post.pk).content_html, 'cached_html')
+        post.content = 'new content'
+        post.save()
+        self.assertIn('new content', Post.objects.get(pk=post.pk).content_html)
+
+    def test_get_content_html_renders_posts_with_outdated_renderer_version(self):
+        post = Post(author=self.user.author, title='test', content='test')
+        post.save()
+        Post.objects.filter(pk=post.pk).update(content_html='stale_html', content_html_version='old')
+        post = Post.objects.get(pk=post.pk)
+        self.assertIn('test', post.get_content_html())
+        self.assertNotIn('stale_html', post.get_content_html())
+
+    def test_rendermarkdown_command_rerenders_outdated_posts(self):
+        post = Post(author=self.user.author, title='test', content='test')
+        post.save()
+        Post.objects.filter(pk=post.pk).update(content_html='stale_html', content_html_version='old')
+        call_command('rendermarkdown', stdout=StringIO())
+        post = Post.objects.get(pk=post.pk)
+        self.assertEqual(post.content_html_version, get_renderer_version())
+        self.assertNotIn('stale_html', post.content_html)
+
+class RankingTest(TestCase):
+
+    def test_best_score_prefers_more_evidence(self):
+        self.assertGreater(ranking.best_score(100, 5), ranking.best_score(2, 0))
+        self.assertGreater(ranking.best_score(2, 0), ranking.best_score(0, 2))
+        self.assertEqual(ranking.best_score(0, 0), 0)
+
+    def test_hot_score_decays_with_age(self):
+        now = timezone.now()
+        self.assertGreater(ranking.hot_score(10, 0, now), ranking.hot_score(100, 0, now - timedelta(days=1)))
+        self.assertGreater(ranking.hot_score(10, 0, now), ranking.hot_score(0, 10, now))
+
+    def test_controversial_score_prefers_even_splits(self):
+        self.assertGreater(ranking.controversial_score(50, 50), ranking.controversial_score(90, 10))
+        self.assertEqual(ranking.controversial_score(100, 0), 0)
+
+    def test_saving_a_comment_computes_its_scores(self):
+        user = create_user('test_user', 'test_pass')
+        comment = create_post(user, 'post', 'content').comment_set.create(commenter=user, text='comment', upvotes=3, downvotes=1)
+        self.assertEqual(comment.score_best, ranking.best_score(3, 1))
+        self.assertEqual(comment.score_controversial, ranking.controversial_score(3, 1))
+        self.assertGreater(comment.score_hot, 0)
+
+class RenderingTest(TestCase):
+
+    def test_renderer_is_reused_within_a_thread(self):
+        self.assertIs(get_renderer('markdown'), get_renderer('markdown'))
+        other_thread_renderers = []
+        thread = Thread(target=lambda: other_thread_renderers.append(get_renderer('markdown')))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other_thread_renderers[0], get_renderer('markdown'))
+
+    def test_renderer_does_not_leak_state_between_documents(self):
+        render_markdown('[link]: https://example.com\n\ntext', 'markdown')
+        self.assertNotIn('href', render_markdown('[link]', 'markdown'))
+
+    def test_render_markdown_escapes_html(self):
+        self.assertNotIn('<script>', render_markdown('<script>alert(1)</script>'))
+
+    @override_settings(BLOG_MARKDOWN_BACKEND='not_a_backend')
+    def test_unknown_backend_is_rejected(self):
+        self.assertRaises(ImproperlyConfigured, render_markdown, 'text')
+
+    def test_renderer_version_depends_on_backend(self):
+        self.assertNotEqual(get_renderer_version('markdown'), get_renderer_version('markdown-it'))
+
+class CommentHTMLCacheTest(TestCase):
+
+    def setUp(self):
+        self.user = create_user('test_user', 'test_pass')
+        self.post = create_post(self.user, 'post', 'content')
+        self.comments = [self.post.comment_set.create(commenter=self.user, text=f'**comment_{i}**') for i in range(3)]
+
+    def test_cache_renders_once_per_comment(self):
+        cache = CommentHTMLCache(max_size=10)
+        self.assertIn('<strong>comment_0</strong>', cache.get_html(self.comments[0]))
+        cache.get_html(self.comments[0])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_cache_rerenders_edited_comments(self):
+        cache = CommentHTMLCache(max_size=10)
+        cache.get_html(self.comments[0])
+        self.comments[0].text = 'edited'
+        self.comments[0].save()
+        self.assertIn('edited', cache.get_html(self.comments[0]))
+        self.assertEqual(cache.misses, 2)
+
+    def test_cache_evicts_least_recently_used_comments(self):
+        cache = CommentHTMLCache(max_size=2)
+        cache.get_html(self.comments[0])
+        cache.get_html(self.comments[1])
+        cache.get_html(self.comments[0])
+        cache.get_html(self.comments[2])
+        self.assertEqual(list(cache.entries.keys()), [self.comments[0].pk, self.comments[2].pk])
+
+    def test_cache_uses_shared_tier_between_instances(self):
+        first, second = CommentHTMLCache(max_size=10, cache_alias='default'), CommentHTMLCache(max_size=10, cache_alias='default')
+        first.get_html(self.comments[0])
+        self.assertIn('comment_0', second.get_html(self.comments[0]))
+        self.assertEqual((second.shared_hits, second.misses), (1, 0))
+        first.invalidate(self.comments[0])
+        third = CommentHTMLCache(max_size=10, cache_alias='default')
+        third.get_html(self.comments[0])
+        self.assertEqual((third.shared_hits, third.misses), (0, 1))
+
+    def test_comment_edit_invalidates_cached_html(self):
+        comment_html_cache.get_html(self.comments[0])
+        self.client.force_login(self.user)
+        self.client.post(reverse('blog:comment_edit', kwargs={'pk': self.comments[0].pk}), {'text': 'new text'})
+        self.assertNotIn(self.comments[0].pk, comment_html_cache.entries)
+        self.assertIn('new text', comment_html_cache.get_html(Comment.objects.get(pk=self.comments[0].pk)))
+
 #View tests
 @override_settings(AUTHOR_DEFAULT=False)
+@override_settings(BLOG_OFFSET_PAGES=2)
+class CursorPaginationTest(TestCase):
+
+    def setUp(self):
+        self.user = create_user('test_user', 'test_pass', author_visible=True)
+        self.post = create_post(self.user, 'post', 'content')
+        #Lots of equal scores so pages have to be split on id
+        self.comments = [create_comment(self.post, self.user, f'comment_{i}', i % 3, 0) for i in range(65)]
+
+    def get_page(self, **data):
+        return self.client.get(reverse('blog:post_comment_index', kwargs={'pk': self.post.pk}), data={'sort': 'best', **data})
+
+    def test_cursor_pages_continue_after_the_offset_pages(self):
+        expected = list(Comment.objects.filter(post=self.post).order_by('-score_best', '-id'))
+        seen = list(self.get_page().context['comments']) + list(self.get_page(page=2).context['comments'])
+        resp = self.get_page(page=2)
+        self.assertFalse(resp.context['page_obj'].has_next())
+        cursor = resp.context['page_obj'].next_cursor
+        while cursor:
+            resp = self.get_page(cursor=cursor)
+            self.assertIsNone(resp.context['page_obj'].number)
+            seen += resp.context['comments']
+            cursor = resp.context['page_obj'].next_cursor
+        self.assertEqual([comment.pk for comment in seen], [comment.pk for comment in expected])
+
+    def test_previous_cursor_returns_the_page_before(self):
+        first_cursor_page = self.get_page(cursor=self.get_page(page=2).context['page_obj'].next_cursor)
+        last_page = self.get_page(cursor=first_cursor_page.context['page_obj'].next_cursor)
+        self.assertIsNone(last_page.context['page_obj'].next_cursor)
+        resp = self.get_page(cursor=last_page.context['page_obj'].previous_cursor)
+        self.assertEqual(list(resp.context['comments']), list(first_cursor_page.context['comments']))
+        resp = self.get_page(cursor=resp.context['page_obj'].previous_cursor)
+        self.assertEqual(list(resp.context['comments']), list(self.get_page(page=2).context['comments']))
+
+    def test_cursor_pages_do_not_count_rows(self):
+        cursor = self.get_page(page=2).context['page_obj'].next_cursor
+        with CaptureQueriesContext(connection) as queries:
+            self.get_page(cursor=cursor)
+        self.assertFalse([query for query in queries if 'COUNT(' in query['sql'].upper()])
+
+    def test_offset_count_is_bounded(self):
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.get_page()
+        self.assertEqual(resp.context['paginator'].num_pages, 2)
+        self.assertTrue(resp.context['paginator'].has_more)
+        self.assertTrue([query for query in queries if 'LIMIT 41' in query['sql'].upper()])
+        self.assertEqual(self.get_page(page=3).status_code, 404)
+
+    def test_invalid_cursor_returns_not_found(self):
+        self.assertEqual(self.get_page(cursor='not-a-cursor').status_code, 404)
+
+    def test_pagination_links_switch_to_cursors(self):
+        resp = self.get_page(page=2)
+        self.assertContains(resp, f'cursor={resp.context["page_obj"].next_cursor}')
+        resp = self.get_page(cursor=resp.context['page_obj'].next_cursor)
+        self.assertContains(resp, 'sort=best&amp;page=1"')
+
 class PostIndexViewTest(TestCase):
 
     def setUp(self):
         self.user = create_user('test_user', 'test_pass', author_visible=True)
 
+    def count_post_card_queries(self, url, posts):
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(url)
+        self.assertEqual(len(resp.context['post_list']), posts)
+        for query in queries:
+            self.assertNotIn('"content"', query['sql'])
+        return len(queries)
+
+    def test_post_card_lists_use_a_constant_number_of_queries_without_post_bodies(self):
+        tag = Tag.objects.create(name='tag')
+        create_post(self.user, 'post', 'content').tags.add(tag)
+        urls = [reverse('blog:post_index'), reverse('blog:author_detail', kwargs={'slug': self.user.author.slug}), reverse('blog:tag_detail', kwargs={'slug': tag.slug})]
+        small = [self.count_post_card_queries(url, 1) for url in urls]
+        for i in range(10):
+            user = create_user(f'test_user_{i}', 'test_pass', author_visible=True)
+            create_post(user, f'post_{i}', 'content').tags.add(tag)
+            create_post(self.user, f'post_{i}', 'content')
+        self.assertEqual([self.count_post_card_queries(url, posts) for url, posts in zip(urls, [20, 11, 11])], small)
+
     def test_post_index_responds_with_posts_ordered_by_creation_date(self):
         day_deltas = [10, -2, 5, 100, 1]
         posts = [Post(title=f'test_title_{i}', content=f'test_content_{i}', author=self.user.author) for i in range(len(day_deltas))]
@@ -379,6 +718,30 @@ class PostCommentsViewTest(TestCase):
             self.assertContains(resp, comment.text)
         self.assertQuerysetEqual(resp.context['comments'], comments)
 
+    def test_post_comments_index_sorts_by_ranking_scores(self):
+        post = create_post(self.user, 'post', 'content')
+        many_up = create_comment(post, self.user, 'many_up', 40, 2)
+        few_up = create_comment(post, self.user, 'few_up', 2, 0)
+        split = create_comment(post, self.user, 'split', 20, 20)
+        down = create_comment(post, self.user, 'down', 0, 5)
+        old_up = create_comment(post, self.user, 'old_up', 45, 0)
+        old_up.created_on = timezone.now() - timedelta(days=30)
+        old_up.save()
+        expected = {
+            'best': [old_up, many_up, few_up, split, down],
+            'hot': [many_up, few_up, split, down, old_up],
+            'controversial': [split, many_up, old_up, down, few_up],
+        }
+        for sort, comments in expected.items():
+            resp = self.client.get(reverse('blog:post_comment_index', kwargs={'pk': post.pk}), data={'sort': sort})
+            self.assertEqual(resp.context['sort_by'], sort)
+            self.assertEqual([comment.pk for comment in resp.context['comments']], [comment.pk for comment in comments], msg=sort)
+
+    def test_post_comments_index_falls_back_to_top_for_unknown_sorts(self):
+        post = create_post(self.user, 'post', 'content')
+        resp = self.client.get(reverse('blog:post_comment_index', kwargs={'pk': post.pk}), data={'sort': 'score_best'})
+        self.assertEqual(resp.context['sort_by'], 'top')
+
 @override_settings(AUTHOR_DEFAULT=False)
 class UserEditViewTest(TestCase):
     
@@ -702,6 +1065,17 @@ class CommentCreateViewTest(TestCase):
         self.assertEqual(comment.commenter, self.no_perms_user)
         self.assertEqual(comment.post, self.post)
 
+    def test_comment_create_notifies_the_post_author_from_a_job(self):
+        self.client.force_login(self.no_perms_user)
+        self.client.post(reverse('blog:comment_create', kwargs={'pk': self.post.pk}), {'text': 'Comment text!'})
+        self.client.force_login(self.author_perms_user)
+        self.client.post(reverse('blog:comment_create', kwargs={'pk': self.post.pk}), {'text': 'Own comment'})
+        notifications = self.author_perms_user.notification_set.filter(type__name='new_comment_on_post')
+        self.assertFalse(notifications.exists())
+        self.assertEqual(Job.objects.filter(name='blog.notify_post_author').count(), 1)
+        run_pending_jobs()
+        self.assertEqual([notification.content.text for notification in notifications], ['Comment text!'])
+
 class CommentEditViewTest(TestCase):
 
     def setUp(self):
@@ -780,6 +1154,257 @@ class CommentDeleteViewTest(TestCase):
         resp = self.client.post(reverse('blog:comment_delete', kwargs={'pk': self.comment_other.pk}))
         self.assertTrue(Comment.objects.filter(pk=self.comment_other.pk).exists())
 
+@override_settings(AUTHOR_DEFAULT=False)
+class CommentVotePreloadTest(TestCase):
+
+    def setUp(self):
+        self.author = create_user('test_author', 'test_pass', author_visible=True)
+        self.viewer = create_user('test_viewer', 'test_pass', author_visible=True)
+        self.small_post = create_post(self.author, 'small', 'small post')
+        self.large_post = create_post(self.author, 'large', 'large post')
+        self.small_comments = [self.small_post.comment_set.create(commenter=self.author, text=f'small_{i}') for i in range(2)]
+        self.large_comments = [self.large_post.comment_set.create(commenter=self.author, text=f'large_{i}') for i in range(20)]
+        for i, comment in enumerate(self.small_comments + self.large_comments):
+            comment.commentvote_set.create(user=self.viewer, type='u' if i % 2 else 'd')
+        self.client.force_login(self.viewer)
+
+    def count_queries(self, url):
+        #Warm up per user caches (unread notification count) so both measurements see the same state
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        return len(queries)
+
+    def test_post_comment_index_query_count_does_not_depend_on_page_size(self):
+        small = self.count_queries(reverse('blog:post_comment_index', kwargs={'pk': self.small_post.pk}))
+        large = self.count_queries(reverse('blog:post_comment_index', kwargs={'pk': self.large_post.pk}))
+        self.assertEqual(small, large)
+
+    def test_post_detail_query_count_does_not_depend_on_number_of_comments(self):
+        small = self.count_queries(reverse('blog:post_detail', kwargs={'pk': self.small_post.pk}))
+        large = self.count_queries(reverse('blog:post_detail', kwargs={'pk': self.large_post.pk}))
+        self.assertEqual(small, large)
+
+    def test_user_detail_query_count_does_not_depend_on_number_of_comments(self):
+        small = self.count_queries(reverse('blog:user_detail', kwargs={'slug': self.author.author.slug}))
+        for comment in self.large_comments[:10]:
+            comment.delete()
+        large = self.count_queries(reverse('blog:user_detail', kwargs={'slug': self.author.author.slug}))
+        self.assertEqual(small, large)
+
+    def test_preloaded_votes_mark_the_viewers_votes(self):
+        resp = self.client.get(reverse('blog:post_comment_index', kwargs={'pk': self.small_post.pk}))
+        self.assertContains(resp, f'id="{self.small_comments[0].pk}-icon-d" class="bi bi-arrow-down-square-fill"')
+        self.assertContains(resp, f'id="{self.small_comments[0].pk}-icon-u" class="bi bi-arrow-up-square"')
+        self.assertContains(resp, f'id="{self.small_comments[1].pk}-icon-u" class="bi bi-arrow-up-square-fill"')
+
+class CommentVoteViewTest(TestCase):
+
+    def setUp(self):
+        self.author = create_user('test_author', 'test_pass', author_visible=True)
+        self.voter = create_user('test_voter', 'test_pass', author_visible=True)
+        self.post = create_post(self.author, 'post', 'content')
+        self.comment = self.post.comment_set.create(commenter=self.author, text='comment')
+
+    def vote(self, type):
+        return self.client.post(reverse('blog:comment_vote', kwargs={'pk': self.comment.pk}), {'type': type}).json()
+
+    def test_comment_vote_upvotes_and_toggles_off(self):
+        self.client.force_login(self.voter)
+        self.assertEqual(self.vote('upvote')['votes'], 1)
+        self.assertTrue(self.comment.has_voted(self.voter, 'u'))
+        self.assertEqual(self.vote('upvote')['votes'], 0)
+        self.assertFalse(self.comment.commentvote_set.exists())
+        self.assertEqual(Comment.objects.get(pk=self.comment.pk).votes, 0)
+
+    def test_comment_vote_flips_existing_vote(self):
+        self.client.force_login(self.voter)
+        self.assertEqual(self.vote('upvote')['votes'], 1)
+        self.assertEqual(self.vote('downvote')['votes'], -1)
+        self.assertEqual(self.comment.commentvote_set.get().type, 'd')
+        self.assertEqual(Comment.objects.get(pk=self.comment.pk).votes, -1)
+
+    def test_comment_vote_updates_vote_counts_and_scores(self):
+        for voter in get_voters(3):
+            toggle_vote(self.comment.pk, voter, 'u')
+        toggle_vote(self.comment.pk, get_voters(3)[2], 'd')
+        comment = Comment.objects.get(pk=self.comment.pk)
+        self.assertEqual((comment.votes, comment.upvotes, comment.downvotes), (1, 2, 1))
+        self.assertEqual(comment.score_best, ranking.best_score(2, 1))
+        self.assertEqual(comment.score_hot, ranking.hot_score(2, 1, comment.created_on))
+        self.assertEqual(comment.score_controversial, ranking.controversial_score(2, 1))
+
+    def test_comment_edit_does_not_overwrite_vote_counts(self):
+        self.client.force_login(self.author)
+        Comment.objects.filter(pk=self.comment.pk).update(votes=5, upvotes=5)
+        self.client.post(reverse('blog:comment_edit', kwargs={'pk': self.comment.pk}), {'text': 'edited'})
+        comment = Comment.objects.get(pk=self.comment.pk)
+        self.assertEqual((comment.text, comment.votes, comment.upvotes), ('edited', 5, 5))
+
+    def test_comment_vote_does_not_let_users_vote_on_their_own_comments(self):
+        self.client.force_login(self.author)
+        resp = self.client.post(reverse('blog:comment_vote', kwargs={'pk': self.comment.pk}), {'type': 'u'})
+        self.assertEqual(resp.status_code, 403)
+        self.assertFalse(self.comment.commentvote_set.exists())
+
+    def test_comment_vote_requires_login(self):
+        resp = self.client.post(reverse('blog:comment_vote', kwargs={'pk': self.comment.pk}), {'type': 'u'})
+        self.assertEqual(resp.status_code, 403)
+
+    def test_users_can_only_have_one_vote_per_comment(self):
+        self.comment.commentvote_set.create(user=self.voter, type='u')
+        self.assertRaises(IntegrityError, self.comment.commentvote_set.create, user=self.voter, type='d')
+
+@override_settings(BLOG_VOTE_BUFFER=True)
+class CommentVoteBufferTest(TestCase):
+
+    def setUp(self):
+        self.author = create_user('test_author', 'test_pass', author_visible=True)
+        self.post = create_post(self.author, 'post', 'content')
+        self.comment = self.post.comment_set.create(commenter=self.author, text='comment')
+        self.voters = get_voters(5)
+
+    def test_buffered_votes_are_returned_without_updating_the_comment(self):
+        self.client.force_login(create_user('test_voter', 'test_pass'))
+        resp = self.client.post(reverse('blog:comment_vote', kwargs={'pk': self.comment.pk}), {'type': 'u'})
+        self.assertEqual(resp.json()['votes'], 1)
+        self.assertEqual(Comment.objects.get(pk=self.comment.pk).votes, 0)
+        self.assertEqual(CommentVoteDelta.objects.count(), 1)
+
+    def test_comment_lists_include_buffered_votes(self):
+        toggle_vote(self.comment.pk, self.voters[0], 'u')
+        resp = self.client.get(reverse('blog:post_comment_index', kwargs={'pk': self.post.pk}))
+        self.assertEqual(resp.context['comments'][0].votes, 1)
+
+    def test_flush_coalesces_buffered_votes(self):
+        for voter in self.voters:
+            toggle_vote(self.comment.pk, voter, 'u')
+        toggle_vote(self.comment.pk, self.voters[0], 'd')
+        toggle_vote(self.comment.pk, self.voters[1], 'u')
+        self.assertEqual(flush_vote_deltas(batch_size=3)[1], 7)
+        comment = Comment.objects.get(pk=self.comment.pk)
+        self.assertEqual((comment.votes, comment.upvotes, comment.downvotes), (2, 3, 1))
+        self.assertEqual(comment.score_best, ranking.best_score(3, 1))
+        self.assertFalse(CommentVoteDelta.objects.exists())
+
+class ValidateVotesCacheCommandTest(TestCase):
+
+    def setUp(self):
+        self.author = create_user('test_author', 'test_pass')
+        self.post = create_post(self.author, 'post', 'content')
+        self.comments = [create_comment(self.post, self.author, f'comment_{i}', i, 1) for i in range(5)]
+        Comment.objects.update(created_on=timezone.now() - timedelta(days=1))
+
+    def validate(self, *args):
+        out = StringIO()
+        call_command('validatevotescache', *args, '--chunk-size', '2', stdout=out)
+        return out.getvalue()
+
+    def test_validate_votes_cache_fixes_mismatched_totals(self):
+        Comment.objects.filter(pk__in=[self.comments[1].pk, self.comments[4].pk]).update(votes=100)
+        out = self.validate()
+        self.assertIn('2 of 5 comment(s) failed to validate', out)
+        for comment in self.comments:
+            self.assertEqual(Comment.objects.get(pk=comment.pk).votes, comment.votes)
+
+    def test_validate_votes_cache_fixes_mismatched_vote_counts_and_scores(self):
+        Comment.objects.filter(pk=self.comments[3].pk).update(upvotes=0, score_best=0)
+        out = self.validate()
+        self.assertIn(f'Missmatch found on comment id {self.comments[3].pk} expected 2 (+3/-1) got 2 (+0/-1)', out)
+        comment = Comment.objects.get(pk=self.comments[3].pk)
+        self.assertEqual(comment.upvotes, 3)
+        self.assertEqual(comment.score_best, ranking.best_score(3, 1))
+
+    def test_validate_votes_cache_since_last_run_only_checks_changed_comments(self):
+        Watermark.set('validatevotescache', timezone.now() - timedelta(hours=1))
+        Comment.objects.filter(pk=self.comments[1].pk).update(votes=100)
+        Comment.objects.filter(pk=self.comments[2].pk).update(votes=100, votes_updated_on=timezone.now())
+        out = self.validate('--since-last-run')
+        self.assertIn('1 of 1 comment(s) failed to validate', out)
+        self.assertEqual(Comment.objects.get(pk=self.comments[1].pk).votes, 100)
+        self.assertEqual(Comment.objects.get(pk=self.comments[2].pk).votes, self.comments[2].votes)
+        self.assertGreater(Watermark.get('validatevotescache'), timezone.now() - timedelta(minutes=5))
+
+    def test_validate_votes_cache_since_last_run_checks_comments_of_deleted_voters(self):
+        Watermark.set('validatevotescache', timezone.now() - timedelta(hours=1))
+        get_voters(1)[0].delete()
+        out = self.validate('--since-last-run')
+        self.assertIn('5 of 5 comment(s) failed to validate', out)
+        self.assertEqual(Comment.objects.get(pk=self.comments[4].pk).upvotes, 3)
+
+    def test_validate_votes_cache_accounts_for_buffered_votes(self):
+        with self.settings(BLOG_VOTE_BUFFER=True):
+            toggle_vote(self.comments[0].pk, create_user('test_voter', 'test_pass'), 'u')
+        self.assertIn('0 of 5 comment(s) failed to validate', self.validate())
+        flush_vote_deltas()
+        self.assertEqual(Comment.objects.get(pk=self.comments[0].pk).votes, self.comments[0].votes + 1)
+
+#SQLite locks the whole database for a write (and the in-memory test database reports that as an error rather than
+#waiting), so there the threads take turns a vote at a time, still in whatever order they get to them
+class CommentVoteConcurrencyTest(TransactionTestCase):
+
+    def setUp(self):
+        self.author = create_user('test_author', 'test_pass')
+        self.post = create_post(self.author, 'post', 'content')
+        self.comments = [self.post.comment_set.create(commenter=self.author, text=f'comment_{i}') for i in range(5)]
+        self.voters = get_voters(100)
+        self.turns = Lock() if connection.vendor == 'sqlite' else nullcontext()
+
+    def vote(self, comment, voter, type):
+        try:
+            with self.turns:
+                return toggle_vote(comment.pk, voter, type)
+        finally:
+            connection.close()
+
+    def test_parallel_votes_keep_totals_consistent(self):
+        jobs = []
+        for comment in self.comments:
+            for voter in self.voters:
+                #Every voter upvotes, most flip to a downvote and some toggle it off again while racing the others
+                jobs += [(comment, voter, 'u'), (comment, voter, 'd'), (comment, voter, 'd' if voter.pk % 3 == 0 else 'u'), (comment, voter, 'u')]
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(lambda job: self.vote(*job), jobs))
+
+        for comment in self.comments:
+            expected = CommentVote.objects.filter(comment=comment, type='u').count() - CommentVote.objects.filter(comment=comment, type='d').count()
+            self.assertEqual(Comment.objects.get(pk=comment.pk).votes, expected)
+            self.assertLessEqual(CommentVote.objects.filter(comment=comment).count(), len(self.voters))
+
+#Runs the retry in toggle_vote on any database by hiding the user's existing vote from the first lookup, as if
+#another request had inserted it between the lookup and the insert
+class CommentVoteRetryTest(TestCase):
+
+    def setUp(self):
+        self.author = create_user('test_author', 'test_pass')
+        self.post = create_post(self.author, 'post', 'content')
+        self.comment = self.post.comment_set.create(commenter=self.author, text='comment')
+        self.voter = get_voters(1)[0]
+        toggle_vote(self.comment.pk, self.voter, 'u')
+
+    def hide_existing_vote(self, times):
+        first = QuerySet.first
+        calls = []
+        def first_after_race(queryset):
+            calls.append(queryset)
+            return None if len(calls) <= times else first(queryset)
+        return mock.patch.object(QuerySet, 'first', first_after_race)
+
+    def test_conflicting_insert_is_retried_against_the_existing_vote(self):
+        with self.hide_existing_vote(1):
+            self.assertEqual(toggle_vote(self.comment.pk, self.voter, 'd'), (-1, 'd'))
+        self.assertEqual(list(CommentVote.objects.filter(comment=self.comment).values_list('user', 'type')), [(self.voter.pk, 'd')])
+        comment = Comment.objects.get(pk=self.comment.pk)
+        self.assertEqual((comment.votes, comment.upvotes, comment.downvotes), (-1, 0, 1))
+
+    def test_second_conflict_is_raised(self):
+        with self.hide_existing_vote(2):
+            with self.assertRaises(IntegrityError):
+                toggle_vote(self.comment.pk, self.voter, 'd')
+        comment = Comment.objects.get(pk=self.comment.pk)
+        self.assertEqual((comment.votes, comment.upvotes, comment.downvotes), (1, 1, 0))
+
 class UserDetailViewTest(TestCase):
 
     def setUp(self):
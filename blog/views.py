@@ -1,5 +1,5 @@
 from django.contrib.auth.models import User
-from notifications.models import NotificationType
+from jobs.models import Job
 from django.http.response import HttpResponseRedirect, JsonResponse
 from django.http import Http404
 from django.urls.base import reverse
@@ -18,22 +18,33 @@ from os.path import join, exists
 from os import remove
 from django.db.models import Count, F, Q
 from .templatetags.blog_filters import compact_int
+from .rendering import comment_html_cache
+from .ranking import COMMENT_ORDERINGS
+from .pagination import CursorPaginationMixin
+from .votes import toggle_vote, get_comment_votes, merge_pending_votes, VOTE_VALUES
 from django.contrib.auth.password_validation import password_changed
 from django.conf import settings
+from django.db import transaction
 # Create your views here.
 
-class PostIndexView(ListView):
+class CommentListMixin:
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context[self.context_object_name] = merge_pending_votes(Comment.preload_votes(context[self.context_object_name], self.request.user))
+        return context
+
+class PostIndexView(CursorPaginationMixin, ListView):
     model = Post
     paginate_by = 20
-    queryset = Post.objects.filter(author__visible=True)
+    queryset = Post.for_cards(Post.objects.filter(author__visible=True))
 
 class PostDetailView(View):
     def get(self, request, pk):
         post = get_object_or_404(Post, pk=pk, author__visible=True)
-        comments = post.comment_set.order_by('-votes')[:5]
-        return render(request, 'blog/post_detail.html', {'post': post, 'comments': comments, 'comment_count': post.comment_set.count()})
+        comments = merge_pending_votes(Comment.preload_votes(post.comment_set.select_related('commenter__author', 'post__author').order_by(*COMMENT_ORDERINGS['top'])[:5], request.user))
+        return render(request, 'blog/post_detail.html', {'post': post, 'comments': comments, 'comment_count': post.comment_count})
 
-class PostCommentIndexView(ListView):
+class PostCommentIndexView(CommentListMixin, CursorPaginationMixin, ListView):
     paginate_by = 20
     template_name = 'blog/post_comment_index.html'
     context_object_name = 'comments'
@@ -46,21 +57,18 @@ class PostCommentIndexView(ListView):
 
     def get_queryset(self):
         self.post = get_object_or_404(Post, pk=self.kwargs['pk'], author__visible=True)
-        self.sort_by = 'top'
-        if 'sort' in self.request.GET:
-            sort = self.request.GET['sort']
-            if sort == 'recent':
-                self.sort_by = 'recent'
-                return self.post.comment_set.order_by('-created_on').all()
-        return self.post.comment_set.order_by('-votes')
-
-class AuthorDetailView(ListView):
+        self.sort_by = self.request.GET.get('sort', 'top')
+        if self.sort_by not in COMMENT_ORDERINGS:
+            self.sort_by = 'top'
+        return self.post.comment_set.select_related('commenter__author', 'post__author').order_by(*COMMENT_ORDERINGS[self.sort_by])
+
+class AuthorDetailView(CursorPaginationMixin, ListView):
     paginate_by = 20
     template_name = 'blog/author_detail.html'
 
     def get_queryset(self):
         self.author = get_object_or_404(Author.objects.filter(visible=True), slug=self.kwargs['slug'])
-        return self.author.post_set.all()
+        return Post.for_cards(self.author.post_set.all())
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -148,16 +156,7 @@ def post_edit_view(request, pk=None):
                 post.header_image_name = None
                 post.save()
 
-            post.tags.clear()
-            for tag_name in form.cleaned_data.get('tags', '').lower().split(','):
-                if tag_name.strip():
-                    try:
-                        tag = Tag.objects.get(slug=slugify(tag_name.strip()))
-                    except Tag.DoesNotExist:
-                        tag = Tag()
-                    tag.name = tag_name.strip()
-                    tag.save()
-                    post.tags.add(tag)
+            post.set_tags(form.cleaned_data.get('tags', ''))
             post.save()
             return HttpResponseRedirect(reverse('blog:post_detail', kwargs={'pk': post.pk}))
     else:
@@ -186,9 +185,11 @@ class CommentCreateView(LoginRequiredMixin, CreateView):
     def form_valid(self, form):
         post = get_object_or_404(Post, pk=self.kwargs['pk'])
         comment = Comment(post=post, commenter=self.request.user, text=form.cleaned_data['text'])
-        comment.save()
-        if post.author.user != self.request.user:
-            post.author.user.notification_set.create(content=comment, type=NotificationType.get(name='new_comment_on_post'))
+        #Saving also bumps post.comment_count. The post author is notified by a background job queued in the same transaction
+        with transaction.atomic():
+            comment.save()
+            if post.author.user_id != self.request.user.pk:
+                Job.enqueue('blog.notify_post_author', {'comment_id': comment.pk}, key=f'blog.notify_post_author:{comment.pk}')
         next = self.request.POST.get('next', None)
         return HttpResponseRedirect(next if next else '/')
 
@@ -207,8 +208,10 @@ class CommentEditView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
 
     def form_valid(self, form):
         comment = self.get_object()
+        comment_html_cache.invalidate(comment)
         comment.text=form.cleaned_data['text']
-        comment.save()
+        #Only write the text, the vote counts on the loaded row may already be stale
+        comment.save(update_fields=['text', 'updated_on'])
         next = self.request.POST.get('next', None)
         return HttpResponseRedirect(next if next else '/')
 
@@ -227,7 +230,7 @@ class CommentDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
         next = self.request.POST.get('next', None)
         return next if next else '/'
 
-class UserDetailView(ListView):
+class UserDetailView(CommentListMixin, CursorPaginationMixin, ListView):
     paginate_by = 20
     template_name = 'blog/user_detail.html'
     context_object_name = 'comments'
@@ -240,7 +243,7 @@ class UserDetailView(ListView):
     def get_queryset(self):
         self.user = get_object_or_404(Author, slug=self.kwargs['slug']).user
         
-        return self.user.comment_set.order_by('-created_on').all()
+        return self.user.comment_set.select_related('commenter__author', 'post__author').order_by('-created_on').all()
 
 class UserDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
     model = Author
@@ -273,23 +276,23 @@ class TagIndexView(ListView):
         return context
 
     def get_queryset(self):
-        query = Tag.objects.all().annotate(num_posts=Count('post')).filter(num_posts__gt=0)
+        query = Tag.objects.filter(post_count__gt=0)
         self.sort_by = self.request.GET.get('sort')
         if self.sort_by == 'least_posts':
-            return query.order_by('num_posts')
+            return query.order_by('post_count', 'id')
         elif self.sort_by == 'name':
             return query.order_by('name')
         else:
             self.sort_by = 'most_posts'
-            return query.order_by('-num_posts')
+            return query.order_by('-post_count', '-id')
 
-class TagDetailView(ListView):
+class TagDetailView(CursorPaginationMixin, ListView):
     paginate_by = 20
     template_name = 'blog/tag_detail.html'
 
     def get_queryset(self):
         self.tag = get_object_or_404(Tag.objects, slug=self.kwargs['slug'])
-        return self.tag.post_set.all()
+        return Post.for_cards(self.tag.post_set.all())
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -299,35 +302,24 @@ class TagDetailView(ListView):
 def comment_vote(request, pk):
     if request.method != 'POST':
         raise Http404()
-    comment = get_object_or_404(Comment, pk=pk)
-    if comment.commenter == request.user:
+    commenter_id = Comment.objects.filter(pk=pk).values_list('commenter_id', flat=True).first()
+    if commenter_id is None:
+        raise Http404()
+    if not request.user.is_authenticated or commenter_id == request.user.pk:
         raise PermissionDenied
     type = request.POST.get('type', None)
     next = request.POST.get('next', None)
-    if type=='upvote' or type=='u':
-        if comment.has_voted(request.user, 'u'):
-            comment.commentvote_set.filter(user=request.user, type='u').delete()
-            comment.votes -= 1
-        else:
-            deleted, deleted_list = comment.commentvote_set.filter(user=request.user, type='d').delete()
-            comment.commentvote_set.create(user=request.user, type='u')
-            comment.votes += 2 if deleted > 0 else 1
-    if type=='downvote' or type=='d':
-        if comment.has_voted(request.user, 'd'):
-            comment.commentvote_set.filter(user=request.user, type='d').delete()
-            comment.votes += 1
-        else:
-            deleted, deleted_list = comment.commentvote_set.filter(user=request.user, type='u').delete()
-            comment.commentvote_set.create(user=request.user, type='d')
-            comment.votes -= 2 if deleted > 0 else 1
-
-    comment.save()
+    type = {'upvote': 'u', 'downvote': 'd'}.get(type, type)
+    if type in VOTE_VALUES:
+        votes, vote_type = toggle_vote(pk, request.user, type)
+    else:
+        votes = get_comment_votes(pk)
 
     if next:
         return HttpResponseRedirect(next if next else '/')
     else:
         return JsonResponse({
-            'comment_id': comment.id,
-            'votes': comment.votes,
-            'votes_formatted': compact_int(comment.votes),
+            'comment_id': pk,
+            'votes': votes,
+            'votes_formatted': compact_int(votes),
         })
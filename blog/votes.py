@@ -0,0 +1,189 @@
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F, Q, Sum, Count, Case, When, Value, IntegerField
+from django.utils import timezone
+from .models import Comment, CommentVote, CommentVoteDelta
+from . import ranking
+
+VOTE_VALUES = {'u': 1, 'd': -1}
+NO_VOTES = (0, 0, 0)
+
+def supports_update_returning():
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        from sqlite3 import sqlite_version_info
+        return sqlite_version_info >= (3, 35)
+    return False
+
+#Returns the (votes, upvotes, downvotes) change for a users vote going from old_type to new_type (None being no vote)
+def get_vote_change(old_type, new_type):
+    return (
+        VOTE_VALUES.get(new_type, 0) - VOTE_VALUES.get(old_type, 0),
+        (new_type == 'u') - (old_type == 'u'),
+        (new_type == 'd') - (old_type == 'd'),
+    )
+
+def get_comment_scores(upvotes, downvotes, created_on):
+    #Raw cursors return whatever the driver does, SQLite gives back naive or string datetimes
+    convert = getattr(connection.ops, 'convert_datetimefield_value', None)
+    if convert:
+        created_on = convert(created_on, None, connection)
+    return ranking.get_scores(upvotes, downvotes, created_on)
+
+#Adds the change to the comments vote counts in the database (no read-modify-write), updates its ranking scores and returns the new total
+def apply_vote_delta(comment_id, delta, upvotes_delta=0, downvotes_delta=0):
+    if supports_update_returning():
+        table = connection.ops.quote_name(Comment._meta.db_table)
+        votes, upvotes, downvotes = [connection.ops.quote_name(column) for column in ['votes', 'upvotes', 'downvotes']]
+        updated_on, created_on = connection.ops.quote_name('votes_updated_on'), connection.ops.quote_name('created_on')
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {table} SET {votes} = {votes} + %s, {upvotes} = {upvotes} + %s, {downvotes} = {downvotes} + %s, {updated_on} = %s '
+                f'WHERE id = %s RETURNING {votes}, {upvotes}, {downvotes}, {created_on}',
+                [delta, upvotes_delta, downvotes_delta, timezone.now(), comment_id]
+            )
+            row = cursor.fetchone()
+    else:
+        Comment.objects.filter(pk=comment_id).update(
+            votes=F('votes') + delta, upvotes=F('upvotes') + upvotes_delta, downvotes=F('downvotes') + downvotes_delta, votes_updated_on=timezone.now()
+        )
+        row = Comment.objects.filter(pk=comment_id).values_list('votes', 'upvotes', 'downvotes', 'created_on').first()
+    if row is None:
+        return None
+    Comment.objects.filter(pk=comment_id).update(**get_comment_scores(*row[1:]))
+    return row[0]
+
+#Recompute the ranking scores of comments whose vote counts were changed in bulk
+def refresh_comment_scores(comment_ids):
+    comments = list(Comment.objects.filter(pk__in=comment_ids).only('id', 'upvotes', 'downvotes', 'created_on'))
+    for comment in comments:
+        comment.update_scores()
+    Comment.objects.bulk_update(comments, ranking.SCORE_FIELDS)
+
+def is_vote_buffer_enabled():
+    return getattr(settings, 'BLOG_VOTE_BUFFER', False)
+
+#Returns {comment id: (votes, upvotes, downvotes)} summed over the given vote log entries
+def sum_vote_deltas(deltas):
+    deltas = deltas.values('comment_id').annotate(votes=Sum('delta'), upvotes=Sum('upvotes_delta'), downvotes=Sum('downvotes_delta'))
+    return {row[0]: row[1:] for row in deltas.values_list('comment_id', 'votes', 'upvotes', 'downvotes')}
+
+def get_pending_vote_deltas(comment_ids):
+    return sum_vote_deltas(CommentVoteDelta.objects.filter(comment_id__in=comment_ids))
+
+def get_comment_votes(comment_id):
+    votes = Comment.objects.filter(pk=comment_id).values_list('votes', flat=True).first()
+    if votes is not None and is_vote_buffer_enabled():
+        votes += get_pending_vote_deltas([comment_id]).get(comment_id, NO_VOTES)[0]
+    return votes
+
+#Append the change to the vote log instead of updating the (possibly very busy) comment row, see flush_vote_deltas
+def buffer_vote_delta(comment_id, delta, upvotes_delta=0, downvotes_delta=0):
+    CommentVoteDelta.objects.create(comment_id=comment_id, delta=delta, upvotes_delta=upvotes_delta, downvotes_delta=downvotes_delta)
+    return get_comment_votes(comment_id)
+
+#Add the votes that haven't been flushed yet to comments loaded for display so users see their own votes right away
+def merge_pending_votes(comments):
+    comments = list(comments)
+    if is_vote_buffer_enabled() and comments:
+        pending = get_pending_vote_deltas([comment.pk for comment in comments])
+        for comment in comments:
+            comment.votes += pending.get(comment.pk, NO_VOTES)[0]
+    return comments
+
+def sum_by_comment(changed, index):
+    return Case(
+        *[When(pk=comment_id, then=Value(counts[index])) for comment_id, counts in changed.items() if counts[index]],
+        default=Value(0), output_field=IntegerField(),
+    )
+
+#Coalesce the vote log into one delta per comment and apply it, oldest entries first, batch_size log entries at a time
+def flush_vote_deltas(batch_size=1000):
+    flushed_comments, flushed_deltas = 0, 0
+    while True:
+        with transaction.atomic():
+            ids = list(CommentVoteDelta.objects.order_by('id').values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return flushed_comments, flushed_deltas
+            changed = {comment_id: counts for comment_id, counts in sum_vote_deltas(CommentVoteDelta.objects.filter(id__in=ids)).items() if any(counts)}
+            if changed:
+                Comment.objects.filter(pk__in=changed).update(
+                    votes=F('votes') + sum_by_comment(changed, 0),
+                    upvotes=F('upvotes') + sum_by_comment(changed, 1),
+                    downvotes=F('downvotes') + sum_by_comment(changed, 2),
+                    votes_updated_on=timezone.now(),
+                )
+                refresh_comment_scores(list(changed))
+            CommentVoteDelta.objects.filter(id__in=ids).delete()
+            flushed_comments += len(changed)
+            flushed_deltas += len(ids)
+
+#Voting the same way twice removes the vote and voting the other way flips it. The vote row and comment.votes
+#change in one transaction and the (comment, user) unique constraint guarantees one vote per user per comment.
+#Returns (new total, the users vote type or None)
+def toggle_vote(comment_id, user, type):
+    for attempt in range(2):
+        try:
+            with transaction.atomic():
+                existing = CommentVote.objects.select_for_update().filter(comment_id=comment_id, user=user).values_list('id', 'type').first()
+                if existing is None:
+                    CommentVote.objects.create(comment_id=comment_id, user=user, type=type)
+                    old_type, new_type = None, type
+                elif existing[1] == type:
+                    CommentVote.objects.filter(id=existing[0]).delete()
+                    old_type, new_type = type, None
+                else:
+                    CommentVote.objects.filter(id=existing[0]).update(type=type)
+                    old_type, new_type = existing[1], type
+                change = get_vote_change(old_type, new_type)
+                if is_vote_buffer_enabled():
+                    return buffer_vote_delta(comment_id, *change), new_type
+                return apply_vote_delta(comment_id, *change), new_type
+        except IntegrityError:
+            #Another request inserted this users vote between our select and insert, retry against their row
+            if attempt:
+                raise
+
+VOTE_TOTAL = Sum(Case(When(type='u', then=Value(1)), When(type='d', then=Value(-1)), default=Value(0), output_field=IntegerField()))
+
+#Returns {comment id: (votes, upvotes, downvotes)} counted from the CommentVote rows
+def get_vote_totals(comment_filter):
+    totals = CommentVote.objects.filter(comment_filter).values('comment_id').annotate(
+        total=VOTE_TOTAL, upvotes=Count('id', filter=Q(type='u')), downvotes=Count('id', filter=Q(type='d'))
+    )
+    return {row[0]: row[1:] for row in totals.values_list('comment_id', 'total', 'upvotes', 'downvotes')}
+
+def find_mismatches(cached, totals, pending):
+    mismatches = []
+    for comment_id, counts in cached.items():
+        expected = tuple(total - waiting for total, waiting in zip(totals.get(comment_id, NO_VOTES), pending.get(comment_id, NO_VOTES)))
+        if counts != expected:
+            mismatches.append((comment_id, expected, counts))
+    return mismatches
+
+#Compare the vote counts of comments with ids in [start, end) against their CommentVote rows and correct any that differ.
+#Votes still waiting in the vote buffer are expected to be missing from the counts.
+#Returns (checked, [(id, expected, found)]) with expected and found as (votes, upvotes, downvotes)
+def validate_vote_totals(start, end, since=None):
+    comments = Comment.objects.filter(id__gte=start, id__lt=end)
+    if since:
+        comments = comments.filter(Q(votes_updated_on__gte=since) | Q(created_on__gte=since))
+    cached = {row[0]: row[1:] for row in comments.values_list('id', 'votes', 'upvotes', 'downvotes')}
+    checked = len(cached)
+    if not checked:
+        return 0, []
+    comment_filter = Q(comment_id__in=list(cached)) if since else Q(comment_id__gte=start, comment_id__lt=end)
+    suspects = [comment_id for comment_id, expected, found in find_mismatches(cached, get_vote_totals(comment_filter), get_pending_vote_deltas(list(cached)))]
+    if not suspects:
+        return checked, []
+
+    #Recheck the suspects with their rows locked so a vote landing between the two queries isn't "fixed" away
+    with transaction.atomic():
+        cached = {row[0]: row[1:] for row in Comment.objects.select_for_update().filter(id__in=suspects).values_list('id', 'votes', 'upvotes', 'downvotes')}
+        mismatches = find_mismatches(cached, get_vote_totals(Q(comment_id__in=suspects)), get_pending_vote_deltas(suspects))
+        Comment.objects.bulk_update([
+            Comment(id=comment_id, votes=expected[0], upvotes=expected[1], downvotes=expected[2]) for comment_id, expected, found in mismatches
+        ], ['votes', 'upvotes', 'downvotes'])
+        refresh_comment_scores([comment_id for comment_id, expected, found in mismatches])
+    return checked, mismatches
@@ -46,6 +46,7 @@ INSTALLED_APPS = [
     'notifications',
     'blog',
     'accounts',
+    'jobs',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -0,0 +1,31 @@
+from django.conf import settings
+
+handlers = {}
+
+class JobHandler:
+
+    def __init__(self, name, function, batch, max_attempts):
+        self.name = name
+        self.function = function
+        self.batch = batch
+        self.max_attempts = max_attempts
+
+    def get_max_attempts(self):
+        return self.max_attempts or getattr(settings, 'JOBS_MAX_ATTEMPTS', 5)
+
+    #Batch handlers get a list with the payload of every job claimed together, others get one payload
+    def run(self, payloads):
+        if self.batch:
+            return self.function(payloads)
+        for payload in payloads:
+            self.function(payload)
+
+#Decorator registering a function as the handler of jobs with the given name
+def register(name, batch=False, max_attempts=None):
+    def decorator(function):
+        handlers[name] = JobHandler(name, function, batch, max_attempts)
+        return function
+    return decorator
+
+def get_handler(name):
+    return handlers.get(name)
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from jobs.worker import run_pending_jobs, delete_finished_jobs
+from time import sleep, monotonic
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs'
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Number of jobs claimed at a time')
+        parser.add_argument('--loop', action='store_true', help='Keep running and check for new jobs every --interval seconds')
+        parser.add_argument('--interval', type=float, default=1)
+
+    def handle(self, *args, **options):
+        batch_size = max(options['batch_size'], 1)
+        last_cleanup = None
+        while True:
+            succeeded, failed = run_pending_jobs(batch_size=batch_size)
+            if succeeded or failed or not options['loop']:
+                self.stdout.write(f'Ran {succeeded + failed} job(s), {failed} failed')
+            if not options['loop']:
+                break
+            if not succeeded and not failed:
+                if last_cleanup is None or monotonic() - last_cleanup > 3600:
+                    delete_finished_jobs()
+                    last_cleanup = monotonic()
+                sleep(options['interval'])
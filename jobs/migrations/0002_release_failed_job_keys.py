@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+def release_failed_job_keys(apps, schema_editor):
+    # Jobs that failed before the worker released their keys still hold them, dropping every job enqueued with the same key
+    Job = apps.get_model('jobs', 'Job')
+    Job.objects.filter(status='failed').exclude(key=None).update(key=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(release_failed_job_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+from django.db import models
+from django.utils import timezone
+from .handlers import get_handler
+
+#Work deferred until after the response, run by the runworker command (see jobs/worker.py). Enqueue jobs in the same
+#transaction as the write they belong to so they are only queued if it commits
+class Job(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    #Jobs enqueued with a key already used by another job are dropped. Failed jobs give theirs up
+    key = models.CharField(max_length=200, unique=True, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    claimed_by = models.CharField(max_length=32, blank=True)
+    claimed_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+    finished_on = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after', 'id'], name='job_ready_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.name} ({self.status})'
+
+    @staticmethod
+    def enqueue(name, payload=None, key=None, delay=None):
+        if get_handler(name) is None:
+            raise ValueError(f'No job handler registered as {name}')
+        job = Job(name=name, payload=payload or {}, key=key, run_after=timezone.now() + delay if delay else timezone.now())
+        if key is None:
+            job.save()
+        else:
+            Job.objects.bulk_create([job], ignore_conflicts=True)
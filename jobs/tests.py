@@ -0,0 +1,114 @@
+from datetime import timedelta
+from django.test import TestCase, override_settings
+from django.core.management import call_command
+from django.utils import timezone
+from io import StringIO
+from .handlers import register
+from .models import Job
+from .worker import claim_jobs, run_pending_jobs, delete_finished_jobs
+
+calls = []
+
+@register('jobs_test.single')
+def single_job(payload):
+    calls.append(payload)
+
+@register('jobs_test.batch', batch=True)
+def batch_job(payloads):
+    if any(payload.get('fail') for payload in payloads):
+        raise ValueError('Bad payload')
+    calls.append(payloads)
+
+@register('jobs_test.failing', max_attempts=2)
+def failing_job(payload):
+    Job.objects.create(name='jobs_test.single', payload={'rolled_back': True})
+    raise ValueError('Always fails')
+
+# Create your tests here.
+class JobTest(TestCase):
+
+    def setUp(self):
+        calls.clear()
+
+    def test_enqueue_rejects_unknown_job_names(self):
+        self.assertRaises(ValueError, Job.enqueue, 'jobs_test.unknown')
+
+    def test_enqueue_drops_jobs_with_a_used_key(self):
+        Job.enqueue('jobs_test.single', {'n': 1}, key='same_key')
+        Job.enqueue('jobs_test.single', {'n': 2}, key='same_key')
+        Job.enqueue('jobs_test.single', {'n': 3})
+        self.assertEqual(sorted(job.payload['n'] for job in Job.objects.all()), [1, 3])
+
+    def test_run_pending_jobs_runs_each_job_once(self):
+        for i in range(3):
+            Job.enqueue('jobs_test.single', {'n': i})
+        Job.enqueue('jobs_test.single', {'n': 'later'}, delay=timedelta(hours=1))
+        self.assertEqual(run_pending_jobs(batch_size=2), (3, 0))
+        self.assertEqual(calls, [{'n': 0}, {'n': 1}, {'n': 2}])
+        self.assertEqual(run_pending_jobs(), (0, 0))
+        self.assertEqual(Job.objects.filter(status=Job.DONE).count(), 3)
+        self.assertEqual(Job.objects.get(status=Job.QUEUED).payload, {'n': 'later'})
+
+    def test_batch_handlers_get_every_claimed_payload(self):
+        for i in range(3):
+            Job.enqueue('jobs_test.batch', {'n': i})
+        run_pending_jobs()
+        self.assertEqual(calls, [[{'n': 0}, {'n': 1}, {'n': 2}]])
+
+    def test_failed_batch_is_retried_one_job_at_a_time(self):
+        Job.enqueue('jobs_test.batch', {'n': 0})
+        Job.enqueue('jobs_test.batch', {'fail': True})
+        Job.enqueue('jobs_test.batch', {'n': 2})
+        self.assertEqual(run_pending_jobs(), (2, 1))
+        self.assertEqual(calls, [[{'n': 0}], [{'n': 2}]])
+        job = Job.objects.get(status=Job.QUEUED)
+        self.assertEqual(job.payload, {'fail': True})
+        self.assertIn('Bad payload', job.last_error)
+
+    @override_settings(JOBS_RETRY_DELAY=60)
+    def test_failing_jobs_are_retried_with_backoff_then_failed(self):
+        Job.enqueue('jobs_test.failing')
+        self.assertEqual(run_pending_jobs(), (0, 1))
+        job = Job.objects.get(name='jobs_test.failing')
+        self.assertEqual((job.status, job.attempts), (Job.QUEUED, 1))
+        self.assertGreater(job.run_after, timezone.now() + timedelta(seconds=50))
+        #The writes of a failed attempt are rolled back
+        self.assertFalse(Job.objects.filter(name='jobs_test.single').exists())
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        self.assertEqual(run_pending_jobs(), (0, 1))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 2))
+        self.assertIn('Always fails', job.last_error)
+
+    def test_failed_jobs_give_up_their_key(self):
+        Job.enqueue('jobs_test.failing', key='failing_key')
+        Job.objects.update(attempts=1)
+        self.assertEqual(run_pending_jobs(), (0, 1))
+        self.assertEqual(Job.objects.get().key, None)
+        Job.enqueue('jobs_test.failing', key='failing_key')
+        self.assertEqual(Job.objects.get(status=Job.QUEUED).key, 'failing_key')
+
+    def test_jobs_of_a_worker_that_stopped_are_claimed_again(self):
+        Job.enqueue('jobs_test.single', {'n': 0})
+        claimed = claim_jobs(10)
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual(claim_jobs(10), [])
+        Job.objects.filter(pk=claimed[0].pk).update(claimed_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(run_pending_jobs(), (1, 0))
+        self.assertEqual(Job.objects.get().attempts, 2)
+
+    def test_delete_finished_jobs_keeps_recent_and_unfinished_jobs(self):
+        Job.enqueue('jobs_test.single', {'n': 0})
+        Job.enqueue('jobs_test.single', {'n': 1})
+        run_pending_jobs()
+        Job.objects.filter(payload__n=0).update(finished_on=timezone.now() - timedelta(days=30))
+        Job.enqueue('jobs_test.single', {'n': 2})
+        self.assertEqual(delete_finished_jobs(), 1)
+        self.assertEqual(sorted(job.payload['n'] for job in Job.objects.all()), [1, 2])
+
+    def test_runworker_command_runs_pending_jobs(self):
+        Job.enqueue('jobs_test.single', {'n': 0})
+        out = StringIO()
+        call_command('runworker', stdout=out)
+        self.assertIn('Ran 1 job(s), 0 failed', out.getvalue())
+        self.assertEqual(calls, [{'n': 0}])
@@ -0,0 +1,92 @@
+import traceback
+from datetime import timedelta
+from uuid import uuid4
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from .handlers import get_handler
+from .models import Job
+
+def get_lease():
+    return timedelta(seconds=getattr(settings, 'JOBS_LEASE_SECONDS', 300))
+
+#Failed jobs wait JOBS_RETRY_DELAY seconds before their second attempt, doubling after every attempt after that
+def get_retry_delay(attempts):
+    return timedelta(seconds=getattr(settings, 'JOBS_RETRY_DELAY', 30) * 2 ** max(attempts - 1, 0))
+
+#Queued jobs that are due and running jobs whose worker stopped renewing its claim (most likely because it died)
+def get_ready_filter(now):
+    return Q(status=Job.QUEUED, run_after__lte=now) | Q(status=Job.RUNNING, claimed_until__lt=now)
+
+#Mark up to batch_size ready jobs as running under a new claim. The UPDATE rechecks the filter so two workers can't
+#both claim a job, whichever writes second updates nothing for it
+def claim_jobs(batch_size):
+    now, claim = timezone.now(), uuid4().hex
+    with transaction.atomic():
+        ids = list(Job.objects.select_for_update(skip_locked=True).filter(get_ready_filter(now)).order_by('run_after', 'id').values_list('id', flat=True)[:batch_size])
+        Job.objects.filter(get_ready_filter(now), id__in=ids).update(status=Job.RUNNING, claimed_by=claim, claimed_until=now + get_lease(), attempts=F('attempts') + 1)
+    return list(Job.objects.filter(claimed_by=claim, status=Job.RUNNING).order_by('id'))
+
+#The handlers writes and marking the jobs done commit together, so a job is never half applied and then retried
+def run_group(handler, jobs):
+    try:
+        with transaction.atomic():
+            handler.run([job.payload for job in jobs])
+            Job.objects.filter(id__in=[job.id for job in jobs], claimed_by=jobs[0].claimed_by).update(status=Job.DONE, finished_on=timezone.now(), last_error='')
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+def retry_or_fail(job, max_attempts, error):
+    now = timezone.now()
+    claimed = Job.objects.filter(pk=job.pk, claimed_by=job.claimed_by)
+    if job.attempts < max_attempts:
+        claimed.update(status=Job.QUEUED, run_after=now + get_retry_delay(job.attempts), claimed_by='', claimed_until=None, last_error=error)
+    else:
+        #Gives up its key so the same work can be enqueued again
+        claimed.update(status=Job.FAILED, finished_on=now, last_error=error, key=None)
+
+#Returns the number of jobs that succeeded and failed
+def run_jobs(jobs):
+    by_name = {}
+    for job in jobs:
+        by_name.setdefault(job.name, []).append(job)
+    succeeded, failed = 0, 0
+    for name, named_jobs in by_name.items():
+        handler = get_handler(name)
+        if handler is None:
+            for job in named_jobs:
+                retry_or_fail(job, 1, f'No job handler registered as {name}')
+            failed += len(named_jobs)
+            continue
+        groups = [named_jobs] if handler.batch else [[job] for job in named_jobs]
+        for group in groups:
+            error = run_group(handler, group)
+            if error is None:
+                succeeded += len(group)
+                continue
+            #Run a failed batch one job at a time so one bad payload doesn't hold back the rest
+            for job in group:
+                error = run_group(handler, [job]) if len(group) > 1 else error
+                if error is None:
+                    succeeded += 1
+                else:
+                    retry_or_fail(job, handler.get_max_attempts(), error)
+                    failed += 1
+    return succeeded, failed
+
+#Run batches of jobs until none are ready, returns the number that succeeded and failed
+def run_pending_jobs(batch_size=100):
+    succeeded, failed = 0, 0
+    while True:
+        jobs = claim_jobs(batch_size)
+        if not jobs:
+            return succeeded, failed
+        batch_succeeded, batch_failed = run_jobs(jobs)
+        succeeded, failed = succeeded + batch_succeeded, failed + batch_failed
+
+#Finished jobs are kept JOBS_KEEP_DONE_DAYS so their keys still stop the same job being enqueued again
+def delete_finished_jobs():
+    cutoff = timezone.now() - timedelta(days=getattr(settings, 'JOBS_KEEP_DONE_DAYS', 7))
+    return Job.objects.filter(status=Job.DONE, finished_on__lt=cutoff).delete()[0]
@@ -1,3 +1,22 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from jobs.models import Job
+from .models import SystemBroadcast
 
-# Register your models here.
+class SystemBroadcastAdmin(admin.ModelAdmin):
+    list_display = ['text', 'sent_to', 'created_on', 'started_on', 'finished_on']
+    readonly_fields = ['key', 'recipients_up_to', 'last_user_id', 'sent_to', 'started_on', 'finished_on']
+    actions = ['send_to_all_users']
+
+    #Sending happens in the job queue, a chunk at a time, see the notifications.send_broadcast job. Welcome messages
+    #(broadcasts with a key) only go to new users
+    @admin.action(description='Send to all users')
+    def send_to_all_users(self, request, queryset):
+        welcome_messages = queryset.filter(key__isnull=False).count()
+        if welcome_messages:
+            self.message_user(request, f'Skipped {welcome_messages} welcome message(s), they are only sent to new users', messages.WARNING)
+        for broadcast in queryset.filter(key__isnull=True, finished_on__isnull=True):
+            broadcast.start()
+            Job.enqueue('notifications.send_broadcast', {'broadcast_id': broadcast.pk}, key=f'notifications.send_broadcast:{broadcast.pk}:{broadcast.last_user_id}')
+        self.message_user(request, 'Sending will carry on in the background, refresh to see how far it got')
+
+admin.site.register(SystemBroadcast, SystemBroadcastAdmin)
@@ -1,6 +1,7 @@
 from django.apps import AppConfig
 from django.db import connection
-from .utils import create_notification_types
+from django.db.models.signals import post_migrate
+from .utils import check_live_updates, create_notification_types, sync_notification_types, connect_notification_cleanup
 
 class NotificationsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
@@ -8,6 +9,9 @@ class NotificationsConfig(AppConfig):
 
     def ready(self):
         from .models import NotificationType
+        check_live_updates()
+        connect_notification_cleanup()
+        post_migrate.connect(sync_notification_types, sender=self)
         if NotificationType._meta.db_table in connection.introspection.table_names():
             # Create notification types only if the table exists in the database
             create_notification_types()
\ No newline at end of file
@@ -0,0 +1,46 @@
+import asyncio
+from collections import defaultdict
+from threading import Lock
+
+#In-process pub/sub waking the long-poll requests (see views.notification_poll_view) of a user when their notifications
+#change. Waiting costs a future per open request, no thread. publish is called from sync code in other threads, so
+#futures are resolved on their own event loop
+class NotificationBroker:
+
+    def __init__(self):
+        self.lock = Lock()
+        self.waiters = defaultdict(set)
+
+    def publish(self, user_id):
+        with self.lock:
+            waiters = list(self.waiters.get(user_id, ()))
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(self.wake, future)
+
+    @staticmethod
+    def wake(future):
+        if not future.done():
+            future.set_result(True)
+
+    #True if woken by a publish, False if the timeout ran out first
+    async def wait(self, user_id, timeout):
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future())
+        with self.lock:
+            self.waiters[user_id].add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self.lock:
+                self.waiters[user_id].discard(waiter)
+                if not self.waiters[user_id]:
+                    del self.waiters[user_id]
+
+    def waiting(self, user_id=None):
+        with self.lock:
+            return len(self.waiters.get(user_id, ())) if user_id is not None else sum(len(waiters) for waiters in self.waiters.values())
+
+broker = NotificationBroker()
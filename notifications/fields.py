@@ -0,0 +1,49 @@
+from collections import Counter
+from django.contrib.contenttypes.fields import GenericRelation
+from django.contrib.contenttypes.models import ContentType
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Count, Q
+from threading import local
+
+#What's left to do for the notifications about content being deleted by this thread, {(model, pk): cleanup}. Every pk
+#of a delete batch shares one cleanup, which Notification.finish_content_delete applies and empties once the first of
+#them is gone
+_pending_cleanups = local()
+
+def get_pending_cleanups():
+    if not hasattr(_pending_cleanups, 'by_content'):
+        _pending_cleanups.by_content = {}
+    return _pending_cleanups.by_content
+
+#GenericRelation to Notification for every model that can be the content of one. Cascaded notifications are deleted
+#with one query, the unread counts of their users are adjusted once per batch rather than per notification.
+#For content whose notifications get folded by target (NotificationsMeta.notification_target) a folded notification
+#(count above 1) is about more than the deleted content, so it isn't cascaded but recounted once the content is gone
+class NotificationRelation(GenericRelation):
+    def __init__(self, **kwargs):
+        super().__init__('notifications.Notification', **kwargs)
+
+    def bulk_related_objects(self, objs, using=DEFAULT_DB_ALIAS):
+        cascaded = super().bulk_related_objects(objs, using)
+        pks = {obj.pk for obj in objs}
+        cleanup = {'unread': Counter(), 'folded': {}}
+        target_attribute = getattr(getattr(self.model, 'NotificationsMeta', None), 'notification_target', None)
+        if target_attribute:
+            target_field = self.model._meta.get_field(target_attribute)
+            folded = Q(count__gt=1, target_content_type=ContentType.objects.db_manager(using).get_for_model(target_field.related_model),
+                target_id__in={getattr(obj, target_field.attname) for obj in objs}, first_object_id__lte=max(pks), object_id__gte=min(pks))
+            notifications = self.remote_field.model._base_manager.db_manager(using).filter(Q(object_id__in=pks) | folded,
+                content_type=ContentType.objects.db_manager(using).get_for_model(self.model, for_concrete_model=self.for_concrete_model))
+            for notification in notifications.order_by():
+                if notification.count > 1:
+                    if any(notification.first_object_id <= pk <= notification.object_id for pk in pks):
+                        cleanup['folded'][notification.pk] = notification
+                elif not notification.seen:
+                    cleanup['unread'][notification.user_id] += 1
+            cascaded = cascaded.exclude(count__gt=1)
+        else:
+            cleanup['unread'].update(dict(cascaded.filter(seen=False).order_by().values_list('user_id').annotate(count=Count('id'))))
+        by_content = get_pending_cleanups()
+        for pk in pks:
+            by_content[self.model, pk] = cleanup
+        return cascaded
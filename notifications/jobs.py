@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from datetime import timedelta
+from jobs.handlers import register
+from jobs.models import Job
+from .models import Notification, NotificationType, PrivateMessage, SystemBroadcast, WelcomeMessage
+
+@register('notifications.notify_receiver', batch=True)
+def notify_receiver(payloads):
+    messages = PrivateMessage.objects.filter(pk__in=[payload['message_id'] for payload in payloads])
+    notification_type = NotificationType.get('private_message')
+    Notification.create_many([Notification(content=message, user_id=message.receiver_id, actor_id=message.sender_id, type=notification_type) for message in messages])
+
+#The text is stored once in a SystemBroadcast, the users message is created when they first open their messages
+@register('notifications.send_welcome_message')
+def send_welcome_message(payload):
+    welcome_message = getattr(settings, 'NOTIFICATIONS_WELCOME_MESSAGE', None)
+    if welcome_message and User.objects.filter(pk=payload['user_id']).exists():
+        broadcast = SystemBroadcast.get_welcome_message(welcome_message)
+        WelcomeMessage.objects.get_or_create(user_id=payload['user_id'], defaults={'broadcast': broadcast})
+        Notification.objects.create(content=broadcast, user_id=payload['user_id'], type=NotificationType.get('private_message'))
+
+#Sends one chunk then queues the next one, spaced out to NOTIFICATIONS_BROADCAST_RATE users a second
+@register('notifications.send_broadcast')
+def send_broadcast(payload):
+    broadcast = SystemBroadcast.objects.get(pk=payload['broadcast_id'])
+    sent = broadcast.send_chunk(getattr(settings, 'NOTIFICATIONS_BROADCAST_CHUNK_SIZE', 1000))
+    if sent:
+        delay = timedelta(seconds=sent / getattr(settings, 'NOTIFICATIONS_BROADCAST_RATE', 1000))
+        Job.enqueue('notifications.send_broadcast', payload, key=f'notifications.send_broadcast:{broadcast.pk}:{broadcast.last_user_id}', delay=delay)
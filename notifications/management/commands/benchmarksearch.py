@@ -0,0 +1,74 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import transaction
+from notifications.models import Conversation, PrivateMessage
+from notifications.search import BACKENDS, get_available_backends, get_terms
+from random import Random
+from time import perf_counter
+
+WORDS = [
+    'lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do', 'eiusmod', 'tempor',
+    'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua', 'enim', 'ad', 'minim', 'veniam', 'quis', 'nostrud',
+    'exercitation', 'ullamco', 'laboris', 'nisi', 'aliquip', 'ex', 'ea', 'commodo', 'consequat', 'duis', 'aute', 'irure',
+    'reprehenderit', 'voluptate', 'velit', 'esse', 'cillum', 'fugiat', 'nulla', 'pariatur', 'excepteur', 'sint',
+]
+#A word in most messages, a word in few, a prefix and two words
+QUERIES = ['dolor', 'benchmarkrare', 'exerc', 'magna aliq']
+
+class Command(BaseCommand):
+    help = 'Benchmark the private message search backends against a generated inbox. Everything it creates is rolled back'
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', action='append', choices=list(BACKENDS), help='Backend to benchmark (may be repeated, defaults to every available backend)')
+        parser.add_argument('--messages', type=int, default=1000000, help='Number of messages in the inbox')
+        parser.add_argument('--conversations', type=int, default=100, help='Number of conversations the messages are spread over')
+        parser.add_argument('--rounds', type=int, default=5, help='Number of times each query is run')
+        parser.add_argument('--query', action='append', help='Search to time (may be repeated, defaults to a few built in ones)')
+
+    def create_inbox(self, options):
+        random = Random(0)
+        user = User.objects.create(username='benchmarksearch_user')
+        User.objects.bulk_create([User(username=f'benchmarksearch_user_{i}') for i in range(options['conversations'])])
+        others = list(User.objects.filter(username__startswith='benchmarksearch_user_'))
+        conversations = [Conversation.get_or_create(user.pk, other.pk) for other in others]
+        #bulk_create skips the signals that put messages into their conversation, so that is done here
+        for start in range(0, options['messages'], 5000):
+            messages = []
+            for i in range(start, min(start + 5000, options['messages'])):
+                conversation = conversations[i % len(conversations)]
+                sender_id, receiver_id = (conversation.user_low_id, conversation.user_high_id)[::random.choice((1, -1))]
+                words = random.choices(WORDS, k=random.randrange(5, 30)) + (['benchmarkrare'] if i % 1000 == 0 else [])
+                messages.append(PrivateMessage(sender_id=sender_id, receiver_id=receiver_id, conversation=conversation, text=' '.join(words)))
+            PrivateMessage.objects.bulk_create(messages)
+            self.stdout.write(f'Created {start + len(messages)} of {options["messages"]} message(s)')
+        return user
+
+    def time(self, function, rounds):
+        timings = []
+        for i in range(rounds):
+            start = perf_counter()
+            result = function()
+            timings.append(perf_counter() - start)
+        return sorted(timings)[len(timings) // 2], result
+
+    def handle(self, *args, **options):
+        if options['messages'] < 1 or options['conversations'] < 1 or options['rounds'] < 1:
+            raise CommandError('--messages, --conversations and --rounds must be at least 1')
+        backends = options['backend'] or get_available_backends()
+        missing = [backend for backend in backends if backend not in get_available_backends()]
+        if missing:
+            raise CommandError(f'Backend(s) not available on this database: {", ".join(missing)}')
+
+        with transaction.atomic():
+            user = self.create_inbox(options)
+            self.stdout.write(f'{options["messages"]} message(s) in {options["conversations"]} conversation(s), median of {options["rounds"]} round(s)')
+            self.stdout.write(f'{"backend":<12}{"query":<16}{"matches":>10}{"count ms":>12}{"top 10 ms":>12}')
+            for name in backends:
+                backend = BACKENDS[name]()
+                for query in options['query'] or QUERIES:
+                    terms = get_terms(query)
+                    count_time, count = self.time(lambda: backend.get_messages(user, terms).count(), options['rounds'])
+                    ranked_time = self.time(lambda: backend.get_ranked(user, terms, 10), options['rounds'])[0]
+                    self.stdout.write(f'{name:<12}{query:<16}{count:>10}{count_time * 1000:>12.1f}{ranked_time * 1000:>12.1f}')
+            transaction.set_rollback(True)
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from notifications.models import SystemBroadcast
+from time import monotonic, sleep
+
+class Command(BaseCommand):
+    help = 'Send a system message to every user, in chunks. An interrupted broadcast can be finished with --resume'
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--text', help='Text of the message')
+        parser.add_argument('--file', help='Read the text of the message from this file')
+        parser.add_argument('--resume', type=int, help='Id of a broadcast to carry on sending')
+        parser.add_argument('--chunk-size', type=int, help='Number of users notified per transaction instead of NOTIFICATIONS_BROADCAST_CHUNK_SIZE')
+        parser.add_argument('--rate', type=float, help='Users notified per second at most instead of NOTIFICATIONS_BROADCAST_RATE')
+
+    def get_broadcast(self, options):
+        if options['resume'] is not None:
+            try:
+                broadcast = SystemBroadcast.objects.get(pk=options['resume'])
+            except SystemBroadcast.DoesNotExist:
+                raise CommandError(f'Broadcast {options["resume"]} does not exist')
+            if broadcast.key:
+                raise CommandError(f'Broadcast {broadcast.pk} is a welcome message, which is only sent to new users')
+            return broadcast
+        if options['file']:
+            with open(options['file'], encoding='utf-8') as file:
+                text = file.read()
+        else:
+            text = options['text']
+        if not text or not text.strip():
+            raise CommandError('Pass --text, --file or --resume')
+        return SystemBroadcast.objects.create(text=text.strip())
+
+    def handle(self, *args, **options):
+        chunk_size = max(options['chunk_size'] or getattr(settings, 'NOTIFICATIONS_BROADCAST_CHUNK_SIZE', 1000), 1)
+        rate = options['rate'] or getattr(settings, 'NOTIFICATIONS_BROADCAST_RATE', 1000)
+        broadcast = self.get_broadcast(options)
+        broadcast.start()
+        if broadcast.finished_on:
+            self.stdout.write(f'Broadcast {broadcast.pk} was already sent to {broadcast.sent_to} user(s)')
+            return
+        self.stdout.write(f'Sending broadcast {broadcast.pk}, resume with --resume {broadcast.pk} if interrupted')
+        started = monotonic()
+        sent_now = 0
+        while True:
+            sent = broadcast.send_chunk(chunk_size)
+            if not sent:
+                break
+            sent_now += sent
+            self.stdout.write(f'Sent to {broadcast.sent_to} user(s), up to user id {broadcast.last_user_id} of {broadcast.recipients_up_to}')
+            #Keep to the rate on average so the notification table and unread counts aren't written to flat out
+            sleep(max(sent_now / rate - (monotonic() - started), 0))
+        self.stdout.write(f'Broadcast {broadcast.pk} sent to {broadcast.sent_to} user(s)')
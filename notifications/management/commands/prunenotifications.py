@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from notifications.models import Notification, ArchivedNotification
+from datetime import timedelta
+from time import sleep
+
+class Command(BaseCommand):
+    help = 'Delete (or archive) seen notifications older than NOTIFICATIONS_RETENTION_DAYS. Unseen notifications are always kept'
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Keep seen notifications this many days instead of NOTIFICATIONS_RETENTION_DAYS')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Number of notifications removed per transaction')
+        parser.add_argument('--pause', type=float, default=0.1, help='Seconds to wait between chunks so other writers get a turn')
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else getattr(settings, 'NOTIFICATIONS_RETENTION_DAYS', None)
+        if days is None:
+            raise CommandError('Set NOTIFICATIONS_RETENTION_DAYS or pass --days')
+        archive = getattr(settings, 'NOTIFICATIONS_ARCHIVE', False)
+        cutoff = timezone.now() - timedelta(days=days)
+        chunk_size, pruned = max(options['chunk_size'], 1), 0
+        while True:
+            #Short transactions over a chunk of the oldest rows, so the notification table is never locked for long
+            with transaction.atomic():
+                notifications = list(Notification.objects.select_for_update(skip_locked=True).filter(seen=True, created_on__lt=cutoff).order_by('created_on', 'id')[:chunk_size])
+                if not notifications:
+                    break
+                if archive:
+                    ArchivedNotification.objects.bulk_create([ArchivedNotification.from_notification(notification) for notification in notifications])
+                Notification.objects.filter(id__in=[notification.id for notification in notifications]).delete()
+            pruned += len(notifications)
+            if len(notifications) < chunk_size:
+                break
+            sleep(options['pause'])
+        self.stdout.write(f'{"Archived" if archive else "Deleted"} {pruned} notification(s) seen and older than {days} day(s)')
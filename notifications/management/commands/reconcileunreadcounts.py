@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count
+from notifications.models import Notification, UnreadNotificationCount
+
+class Command(BaseCommand):
+    help = 'Recount the unread notifications of every user and fix any stored counts that drifted'
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Number of users recounted per query')
+
+    def handle(self, *args, **options):
+        chunk_size = max(options['chunk_size'], 1)
+        last_id, checked, fixed = 0, 0, 0
+        while True:
+            user_ids = list(User.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+            if not user_ids:
+                break
+            #Lock the counters so notifications created or seen during the recount are applied on top of the fixed value
+            with transaction.atomic():
+                stored = dict(UnreadNotificationCount.objects.select_for_update().filter(user_id__in=user_ids).values_list('user_id', 'count'))
+                actual = dict(Notification.objects.filter(user_id__in=user_ids, seen=False).order_by().values('user_id').annotate(count=Count('id')).values_list('user_id', 'count'))
+                wrong = [user_id for user_id in user_ids if stored.get(user_id) != actual.get(user_id, 0)]
+                UnreadNotificationCount.objects.bulk_update([UnreadNotificationCount(user_id=user_id, count=actual.get(user_id, 0)) for user_id in wrong if user_id in stored], ['count'])
+                UnreadNotificationCount.objects.bulk_create([UnreadNotificationCount(user_id=user_id, count=actual.get(user_id, 0)) for user_id in wrong if user_id not in stored], ignore_conflicts=True)
+                for user_id in wrong:
+                    UnreadNotificationCount.invalidate(user_id)
+            checked, fixed, last_id = checked + len(user_ids), fixed + len(wrong), user_ids[-1]
+        self.stdout.write(f'Fixed {fixed} of {checked} unread notification count(s)')
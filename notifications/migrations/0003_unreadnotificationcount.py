@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:44
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+import django.db.models.deletion
+
+
+def create_unread_counts(apps, schema_editor):
+    User = apps.get_model('auth', 'User')
+    UnreadNotificationCount = apps.get_model('notifications', 'UnreadNotificationCount')
+    users = User.objects.order_by('id').annotate(unread=Count('notification', filter=Q(notification__seen=False))).values_list('id', 'unread')
+    counts = []
+    for user_id, unread in users.iterator(chunk_size=1000):
+        counts.append(UnreadNotificationCount(user_id=user_id, count=unread))
+        if len(counts) >= 1000:
+            UnreadNotificationCount.objects.bulk_create(counts)
+            counts = []
+    UnreadNotificationCount.objects.bulk_create(counts)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('notifications', '0002_list_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnreadNotificationCount',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='auth.user')),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_unread_counts, migrations.RunPython.noop),
+    ]
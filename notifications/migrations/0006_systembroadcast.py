@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0005_notification_aggregation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SystemBroadcast',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('text', models.TextField()),
+                ('key', models.CharField(blank=True, max_length=100, null=True, unique=True)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='privatemessage',
+            name='text',
+            field=models.TextField(blank=True, max_length=500),
+        ),
+        migrations.AddField(
+            model_name='privatemessage',
+            name='broadcast',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='notifications.systembroadcast'),
+        ),
+        migrations.AddConstraint(
+            model_name='privatemessage',
+            constraint=models.UniqueConstraint(condition=models.Q(('broadcast__isnull', False)), fields=('receiver', 'broadcast'), name='message_receiver_broadcast_unique'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0006_systembroadcast'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='systembroadcast',
+            name='finished_on',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='systembroadcast',
+            name='last_user_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='systembroadcast',
+            name='recipients_up_to',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='systembroadcast',
+            name='sent_to',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='systembroadcast',
+            name='started_on',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
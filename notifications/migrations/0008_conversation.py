@@ -0,0 +1,117 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:19
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import OuterRef, Subquery
+
+
+def create_conversations(apps, schema_editor):
+    # Put every message between two users into their conversation, 1000 messages at a time. Existing messages count
+    # as read, there was no way of telling before
+    PrivateMessage = apps.get_model('notifications', 'PrivateMessage')
+    Conversation = apps.get_model('notifications', 'Conversation')
+    ConversationMember = apps.get_model('notifications', 'ConversationMember')
+    conversations, last_id = {}, 0
+    while True:
+        messages = list(PrivateMessage.objects.filter(id__gt=last_id, sender__isnull=False).order_by('id').only('id', 'sender_id', 'receiver_id', 'created_on')[:1000])
+        if not messages:
+            break
+        for message in messages:
+            user_ids = tuple(sorted((message.sender_id, message.receiver_id)))
+            if user_ids not in conversations:
+                conversations[user_ids] = Conversation.objects.create(user_low_id=user_ids[0], user_high_id=user_ids[1], updated_on=message.created_on).pk
+                ConversationMember.objects.bulk_create([
+                    ConversationMember(conversation_id=conversations[user_ids], user_id=user_id, other_user_id=user_ids[1] if user_id == user_ids[0] else user_ids[0], updated_on=message.created_on)
+                    for user_id in set(user_ids)
+                ])
+            message.conversation_id = conversations[user_ids]
+        PrivateMessage.objects.bulk_update(messages, ['conversation'])
+        last_id = messages[-1].id
+    latest = PrivateMessage.objects.filter(conversation=OuterRef('pk')).order_by('-created_on', '-id')
+    Conversation.objects.update(last_message=Subquery(latest.values('id')[:1]), updated_on=Subquery(latest.values('created_on')[:1]))
+    updated_on = Subquery(Conversation.objects.filter(pk=OuterRef('conversation')).values('updated_on')[:1])
+    ConversationMember.objects.update(updated_on=updated_on, read_on=updated_on)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('notifications', '0007_broadcast_progress'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('updated_on', models.DateTimeField()),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ConversationMember',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread', models.PositiveIntegerField(default=0)),
+                ('read_on', models.DateTimeField(blank=True, null=True)),
+                ('updated_on', models.DateTimeField()),
+            ],
+            options={
+                'ordering': ['-updated_on'],
+            },
+        ),
+        migrations.AddField(
+            model_name='conversationmember',
+            name='conversation',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='members', to='notifications.conversation'),
+        ),
+        migrations.AddField(
+            model_name='conversationmember',
+            name='other_user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='conversationmember',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversations', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='notifications.privatemessage'),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='user_high',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='user_low',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='privatemessage',
+            name='conversation',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='notifications.conversation'),
+        ),
+        migrations.AddIndex(
+            model_name='conversationmember',
+            index=models.Index(fields=['user', '-updated_on', '-id'], name='conversation_recent_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='conversationmember',
+            constraint=models.UniqueConstraint(fields=('conversation', 'user'), name='conversation_member_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.UniqueConstraint(fields=('user_low', 'user_high'), name='conversation_users_unique'),
+        ),
+        migrations.AddIndex(
+            model_name='privatemessage',
+            index=models.Index(fields=['conversation', '-created_on', '-id'], name='message_thread_recent_idx'),
+        ),
+        migrations.RunPython(create_conversations, migrations.RunPython.noop),
+    ]
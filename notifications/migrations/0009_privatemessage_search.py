@@ -0,0 +1,74 @@
+from django.db import migrations, OperationalError
+
+# Keeps notifications_privatemessage_fts in step with the messages of conversations, see notifications/search.py
+SQLITE_CREATE = [
+    "CREATE VIRTUAL TABLE notifications_privatemessage_fts USING fts5(text, users)",
+    """CREATE TRIGGER notifications_privatemessage_fts_insert AFTER INSERT ON notifications_privatemessage
+    WHEN new.conversation_id IS NOT NULL BEGIN
+        INSERT INTO notifications_privatemessage_fts (rowid, text, users)
+        SELECT new.id, new.text, 'u' || user_low_id || ' u' || user_high_id FROM notifications_conversation WHERE id = new.conversation_id;
+    END""",
+    """CREATE TRIGGER notifications_privatemessage_fts_update AFTER UPDATE OF text, conversation_id ON notifications_privatemessage BEGIN
+        DELETE FROM notifications_privatemessage_fts WHERE rowid = old.id;
+        INSERT INTO notifications_privatemessage_fts (rowid, text, users)
+        SELECT new.id, new.text, 'u' || user_low_id || ' u' || user_high_id FROM notifications_conversation WHERE id = new.conversation_id;
+    END""",
+    """CREATE TRIGGER notifications_privatemessage_fts_delete AFTER DELETE ON notifications_privatemessage
+    WHEN old.conversation_id IS NOT NULL BEGIN
+        DELETE FROM notifications_privatemessage_fts WHERE rowid = old.id;
+    END""",
+    """INSERT INTO notifications_privatemessage_fts (rowid, text, users)
+    SELECT message.id, message.text, 'u' || conversation.user_low_id || ' u' || conversation.user_high_id
+    FROM notifications_privatemessage message JOIN notifications_conversation conversation ON conversation.id = message.conversation_id""",
+]
+SQLITE_DROP = [
+    "DROP TRIGGER IF EXISTS notifications_privatemessage_fts_insert",
+    "DROP TRIGGER IF EXISTS notifications_privatemessage_fts_update",
+    "DROP TRIGGER IF EXISTS notifications_privatemessage_fts_delete",
+    "DROP TABLE IF EXISTS notifications_privatemessage_fts",
+]
+# Must match the expressions PostgresSearchBackend filters on
+POSTGRES_CREATE = [
+    "CREATE INDEX message_search_idx ON notifications_privatemessage USING GIN (to_tsvector('simple'::regconfig, COALESCE(text, '')))",
+]
+POSTGRES_DROP = [
+    "DROP INDEX IF EXISTS message_search_idx",
+]
+
+
+def run(schema_editor, statements):
+    with schema_editor.connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        # Not every SQLite is built with FTS5, searches fall back to icontains without the table
+        try:
+            run(schema_editor, SQLITE_CREATE[:1])
+        except OperationalError:
+            return
+        run(schema_editor, SQLITE_CREATE[1:])
+    elif vendor == 'postgresql':
+        run(schema_editor, POSTGRES_CREATE)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        run(schema_editor, SQLITE_DROP)
+    elif vendor == 'postgresql':
+        run(schema_editor, POSTGRES_DROP)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0008_conversation'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
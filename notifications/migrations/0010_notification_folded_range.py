@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:44
+
+from django.db import migrations, models
+from django.db.models import F
+
+#What was folded before is unknown, so existing notifications only cover their latest content
+def set_first_object_id(apps, schema_editor):
+    Notification = apps.get_model('notifications', 'Notification')
+    Notification.objects.update(first_object_id=F('object_id'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0009_privatemessage_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='first_object_id',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_first_object_id, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('count__gt', 1)), fields=['target_content_type', 'target_id'], name='notification_folded_target_idx'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:49
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+#Undelivered welcome messages used to be found through the users notifications, dated when they were notified
+def record_welcome_messages(apps, schema_editor):
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    SystemBroadcast = apps.get_model('notifications', 'SystemBroadcast')
+    WelcomeMessage = apps.get_model('notifications', 'WelcomeMessage')
+    broadcast_type = ContentType.objects.filter(app_label='notifications', model='systembroadcast').first()
+    if broadcast_type is None:
+        return
+    notified_on = []
+    for model_name in ('ArchivedNotification', 'Notification'):
+        notifications = apps.get_model('notifications', model_name).objects.filter(content_type=broadcast_type, object_id__in=SystemBroadcast.objects.filter(key__isnull=False).values('pk'))
+        batch = []
+        for user_id, broadcast_id in notifications.order_by('created_on').values_list('user_id', 'object_id').iterator():
+            batch.append(WelcomeMessage(user_id=user_id, broadcast_id=broadcast_id))
+            if len(batch) == 1000:
+                WelcomeMessage.objects.bulk_create(batch, ignore_conflicts=True)
+                batch = []
+        WelcomeMessage.objects.bulk_create(batch, ignore_conflicts=True)
+        notified_on.append(Subquery(notifications.filter(user_id=OuterRef('user_id'), object_id=OuterRef('broadcast_id')).order_by('created_on').values('created_on')[:1]))
+    WelcomeMessage.objects.update(created_on=Coalesce(*notified_on))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('notifications', '0010_notification_folded_range'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WelcomeMessage',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='auth.user')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('broadcast', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='notifications.systembroadcast')),
+            ],
+        ),
+        migrations.RunPython(record_welcome_messages, migrations.RunPython.noop),
+    ]
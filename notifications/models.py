@@ -1,12 +1,24 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.utils import timezone
+from django.db.models import F, Q, Count, Case, When, Value, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest, Least
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 from django.contrib.auth.models import Permission, User
-from django.contrib.contenttypes.fields import GenericForeignKey, ContentType
-from .utils import create_notification_types
+from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation, ContentType
+from .utils import create_notification_types, is_process_local_cache
+from .fields import NotificationRelation, get_pending_cleanups
+from . import registry
 from django.db.models.deletion import CASCADE
 from django.urls import reverse
-from django.db.models.signals import pre_delete, post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from django.conf import settings
+from collections import Counter
+from hashlib import sha256
+from time import time
+from .broker import broker
+from jobs.models import Job
 
 # Create your models here.
 
@@ -19,58 +31,452 @@ class Notification(models.Model):
     seen = models.BooleanField(default=False)
     created_on = models.DateTimeField(auto_now_add=True)
     type = models.ForeignKey('NotificationType', on_delete=models.CASCADE)
+    #With NOTIFICATIONS_AGGREGATE on, unseen notifications of the same type about the same target (the post a comment
+    #was left on for example) are folded into one row. content and actor are then those of the latest one, and the
+    #content folded in is that about the target from first_object_id up to object_id
+    count = models.PositiveIntegerField(default=1)
+    first_object_id = models.PositiveIntegerField(null=True, blank=True)
+    actor = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    target_content_type = models.ForeignKey(ContentType, null=True, blank=True, on_delete=models.CASCADE, related_name='+')
+    target_id = models.PositiveIntegerField(null=True, blank=True)
+    target = GenericForeignKey('target_content_type', 'target_id')
 
     class Meta:
         ordering = ['-created_on']
+        indexes = [
+            models.Index(fields=['user', '-created_on', '-id'], name='notification_user_recent_idx'),
+            models.Index(fields=['seen', 'created_on'], name='notification_seen_created_idx'),
+            models.Index(fields=['target_content_type', 'target_id'], condition=models.Q(count__gt=1), name='notification_folded_target_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'type', 'target_content_type', 'target_id'], condition=models.Q(seen=False), name='notification_unseen_target_unique'),
+        ]
 
     def __str__(self):
         return str(self.content)
-    
-    @receiver(pre_delete)
-    def my_callback(sender, instance, **kwargs):
-        instance_type = ContentType.objects.get(app_label=instance._meta.app_label, model=type(instance).__name__.lower())
+
+    #Load the content of every notification (or archived notification) with one query per content type instead of one per notification.
+    #NotificationsMeta.notification_select_related and notification_defer shape the query for each model
+    @staticmethod
+    def prefetch_content(notifications):
+        notifications = list(notifications)
+        by_type = {}
+        for notification in notifications:
+            by_type.setdefault(notification.content_type_id, []).append(notification)
+        for content_type_id, typed_notifications in by_type.items():
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            meta = getattr(model, 'NotificationsMeta', None)
+            queryset = model._base_manager.filter(pk__in={notification.object_id for notification in typed_notifications})
+            if getattr(meta, 'notification_select_related', None):
+                queryset = queryset.select_related(*meta.notification_select_related)
+            if getattr(meta, 'notification_defer', None):
+                queryset = queryset.defer(*meta.notification_defer)
+            objects = queryset.in_bulk()
+            for notification in typed_notifications:
+                notification._meta.get_field('content').set_cached_value(notification, objects.get(notification.object_id))
+        return notifications
+
+    #What notifications about this content are folded by, from the content's NotificationsMeta.notification_target
+    def get_target(self):
+        target_attribute = getattr(getattr(self.content, 'NotificationsMeta', None), 'notification_target', None)
+        return getattr(self.content, target_attribute) if target_attribute else None
+
+    #Fold into the users unseen notification of the same type and target, or save it as a new one if there isn't one.
+    #Returns the number of new rows created (0 or 1)
+    def aggregate(self):
+        unseen = Notification.objects.filter(seen=False, user_id=self.user_id, type_id=self.type_id, target_content_type_id=self.target_content_type_id, target_id=self.target_id)
+        if self.first_object_id is None:
+            self.first_object_id = self.object_id
+        #Jobs can finish out of order, content and actor only move forward
+        later = Q(object_id__lt=self.object_id)
+        def fold():
+            return unseen.update(count=F('count') + self.count, content_type_id=self.content_type_id, object_id=Greatest('object_id', Value(self.object_id), output_field=models.PositiveIntegerField()),
+                first_object_id=Least('first_object_id', Value(self.first_object_id), output_field=models.PositiveIntegerField()),
+                actor_id=Case(When(later, then=Value(self.actor_id)), default=F('actor_id'), output_field=models.IntegerField()), created_on=timezone.now())
+        if fold():
+            Notification.publish_change(self.user_id)
+            return 0
         try:
-            target = Notification.objects.filter(object_id=instance.pk, content_type_id=instance_type.pk)
-            target.delete()
-        except (Notification.DoesNotExist, ValueError):
-            pass
+            with transaction.atomic():
+                self.save()
+            return 1
+        except IntegrityError:
+            #Another worker created it first
+            fold()
+            Notification.publish_change(self.user_id)
+            return 0
+
+    @staticmethod
+    def get_change_key(user_id):
+        return f'notifications:changed:{user_id}'
+
+    #Tell live notification requests the users notifications changed once the change commits. The time is also kept in
+    #the cache for requests held by other processes, which the broker can't reach (notifications created by runworker)
+    @staticmethod
+    def publish_change(user_id):
+        Notification.publish_changes([user_id])
+
+    @staticmethod
+    def publish_changes(user_ids):
+        def publish():
+            now = time()
+            UnreadNotificationCount.get_cache().set_many({Notification.get_change_key(user_id): now for user_id in user_ids}, None)
+            for user_id in user_ids:
+                broker.publish(user_id)
+        transaction.on_commit(publish)
+
+    @staticmethod
+    def get_last_change(user_id):
+        return UnreadNotificationCount.get_cache().get(Notification.get_change_key(user_id))
+
+    #bulk_create skips the post_save receivers, so the unread counts are adjusted here, once per user
+    @staticmethod
+    def create_many(notifications):
+        aggregated = {}
+        if getattr(settings, 'NOTIFICATIONS_AGGREGATE', False):
+            separate = []
+            for notification in notifications:
+                target = notification.get_target()
+                if target is None:
+                    separate.append(notification)
+                    continue
+                notification.target = target
+                key = (notification.user_id, notification.type_id, notification.target_content_type_id, notification.target_id)
+                aggregated.setdefault(key, []).append(notification)
+            notifications = separate
+        with transaction.atomic():
+            notifications = Notification.objects.bulk_create(notifications)
+            UnreadNotificationCount.adjust_counts(Counter(notification.user_id for notification in notifications if not notification.seen))
+            #Only the latest of each group is kept. Its save (if it isn't folded) adjusts the unread count itself
+            for group in aggregated.values():
+                latest = group[-1]
+                latest.count = len(group)
+                latest.first_object_id = min(notification.object_id for notification in group)
+                latest.aggregate()
+                notifications.append(latest)
+        return notifications
+
+    #One UPDATE, so concurrent requests can't both count the same notification as newly seen. Marks all of the users
+    #unseen notifications or only those with the given ids and returns the number marked
+    @staticmethod
+    def mark_seen(user, ids=None):
+        notifications = user.notification_set.filter(seen=False)
+        if ids is not None:
+            notifications = notifications.filter(pk__in=ids)
+        with transaction.atomic():
+            marked = notifications.update(seen=True)
+            if marked:
+                UnreadNotificationCount.adjust(user.pk, -marked)
+        return marked
+
+    @receiver(post_save, sender='notifications.Notification')
+    def increment_unread_count(sender, instance, created, **kwargs):
+        if created and not instance.seen:
+            UnreadNotificationCount.adjust(instance.user_id, 1)
+
+    #Notification has no delete receivers so deleting them stays a single query. Unread counts are adjusted here for a
+    #single notification, by delete_many for a QuerySet and by NotificationRelation for a cascade
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            deleted = super().delete(*args, **kwargs)
+            if not self.seen:
+                UnreadNotificationCount.adjust(self.user_id, -1)
+        return deleted
+
+    @staticmethod
+    def delete_many(notifications):
+        with transaction.atomic():
+            unread = dict(notifications.filter(seen=False).order_by().values_list('user_id').annotate(count=Count('id')))
+            deleted = notifications.delete()
+            UnreadNotificationCount.adjust_counts({user_id: -count for user_id, count in unread.items()})
+        return deleted
+
+    #Models declaring NotificationsMeta should have a NotificationRelation, which lets the delete collector clear their
+    #notifications with one query per batch. Those without one get this receiver connected by NotificationsConfig.ready instead
+    @staticmethod
+    def delete_for_content(sender, instance, **kwargs):
+        Notification.delete_many(Notification.objects.filter(content_type=ContentType.objects.get_for_model(sender), object_id=instance.pk))
+
+    #Connected by NotificationsConfig.ready for models with a NotificationRelation. The whole delete batch is gone by the
+    #time the first of it gets here, so what NotificationRelation found is applied then: the unread counts of the users
+    #whose notifications were cascaded, and folded notifications recounted
+    @staticmethod
+    def finish_content_delete(sender, instance, **kwargs):
+        cleanup = get_pending_cleanups().pop((sender, instance.pk), None)
+        if cleanup is None:
+            return
+        UnreadNotificationCount.adjust_counts({user_id: -count for user_id, count in cleanup['unread'].items()})
+        for notification in cleanup['folded'].values():
+            #Retried if something was folded in meanwhile
+            while not notification.recount_folded(sender):
+                try:
+                    notification.refresh_from_db()
+                except Notification.DoesNotExist:
+                    break
+        cleanup['unread'].clear()
+        cleanup['folded'].clear()
+
+    #Point a folded notification at the latest content still folded into it and count what's left, or delete it when
+    #nothing is. Returns False without changing it if it changed since it was loaded
+    def recount_folded(self, model):
+        meta = model.NotificationsMeta
+        remaining = model._base_manager.filter(**{model._meta.get_field(meta.notification_target).attname: self.target_id}, pk__gte=self.first_object_id, pk__lte=self.object_id)
+        #The users own content is never folded into their notifications
+        actor_field = model._meta.get_field(meta.notification_actor) if getattr(meta, 'notification_actor', None) else None
+        if actor_field:
+            remaining = remaining.exclude(**{actor_field.attname: self.user_id})
+        latest = remaining.order_by('-pk').first()
+        if latest is None:
+            self.delete()
+            return True
+        actor_id = getattr(latest, actor_field.attname) if actor_field else self.actor_id
+        return bool(Notification.objects.filter(pk=self.pk, count=self.count, object_id=self.object_id).update(count=remaining.count(), object_id=latest.pk, actor_id=actor_id))
 
     @receiver(post_save, sender=User)
     def create_user_author(sender, instance, created, **kwargs):
-        welcome_message = getattr(settings, 'NOTIFICATIONS_WELCOME_MESSAGE', None)
-        if welcome_message and created:
-            private_message = PrivateMessage.objects.create(text=welcome_message, receiver=instance)
-            Notification.objects.create(content=private_message, user=instance, type=NotificationType.get('private_message'))
+        if created:
+            UnreadNotificationCount.objects.create(user=instance)
+            UnreadNotificationCount.invalidate(instance.pk)
+        if created and getattr(settings, 'NOTIFICATIONS_WELCOME_MESSAGE', None):
+            Job.enqueue('notifications.send_welcome_message', {'user_id': instance.pk}, key=f'notifications.send_welcome_message:{instance.pk}')
+
+#Seen notifications older than NOTIFICATIONS_RETENTION_DAYS moved out of Notification by prunenotifications when
+#NOTIFICATIONS_ARCHIVE is on. Only what's needed to list them is kept
+class ArchivedNotification(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    content = GenericForeignKey()
+    type = models.ForeignKey('NotificationType', on_delete=models.CASCADE)
+    count = models.PositiveIntegerField(default=1)
+    created_on = models.DateTimeField()
+    #So templates can treat them like notifications that were seen and can't be deleted
+    seen = True
+    archived = True
+
+    class Meta:
+        ordering = ['-created_on']
+        indexes = [
+            models.Index(fields=['user', '-created_on', '-id'], name='archived_user_recent_idx'),
+        ]
+
+    @staticmethod
+    def from_notification(notification):
+        return ArchivedNotification(user_id=notification.user_id, content_type_id=notification.content_type_id, object_id=notification.object_id, type_id=notification.type_id, count=notification.count, created_on=notification.created_on)
+
+#Seconds an unread count is cached for when NOTIFICATIONS_CACHE_ALIAS isn't shared between processes
+LOCAL_CACHE_TIMEOUT = 5
+
+#Number of unseen notifications per user, kept up to date by the Notification receivers and mark_seen and cached in
+#NOTIFICATIONS_CACHE_ALIAS so page_base.html doesn't need to count them on every page (see reconcileunreadcounts)
+class UnreadNotificationCount(models.Model):
+    user = models.OneToOneField(User, primary_key=True, on_delete=CASCADE)
+    count = models.IntegerField(default=0)
+
+    @staticmethod
+    def get_cache():
+        return caches[getattr(settings, 'NOTIFICATIONS_CACHE_ALIAS', 'default')]
+
+    @staticmethod
+    def get_cache_key(user_id):
+        return f'notifications:unread:{user_id}'
+
+    #Invalidations made by other processes don't reach a process local cache, so counts are only kept there briefly
+    @staticmethod
+    def get_cache_timeout(cache):
+        return LOCAL_CACHE_TIMEOUT if is_process_local_cache(cache) else DEFAULT_TIMEOUT
+
+    @staticmethod
+    def count_unread(user_id):
+        return Notification.objects.filter(user_id=user_id, seen=False).count()
+
+    @staticmethod
+    def get(user):
+        cache = UnreadNotificationCount.get_cache()
+        count = cache.get(UnreadNotificationCount.get_cache_key(user.pk))
+        if count is None:
+            count = UnreadNotificationCount.objects.filter(user_id=user.pk).values_list('count', flat=True).first()
+            if count is None:
+                count = UnreadNotificationCount.count_unread(user.pk)
+            cache.set(UnreadNotificationCount.get_cache_key(user.pk), count, UnreadNotificationCount.get_cache_timeout(cache))
+        return count
+
+    #Users without a counter row (only possible if it was deleted by hand) fall back to counting until reconciled.
+    #Creating it here could recreate the row of a user in the middle of being deleted
+    @staticmethod
+    def adjust(user_id, change):
+        UnreadNotificationCount.adjust_many([user_id], change)
+
+    #{user_id: change}, with one UPDATE for every user getting the same change (usually all of them)
+    @staticmethod
+    def adjust_counts(changes):
+        by_change = {}
+        for user_id, change in changes.items():
+            if change:
+                by_change.setdefault(change, []).append(user_id)
+        for change, user_ids in by_change.items():
+            UnreadNotificationCount.adjust_many(user_ids, change)
+
+    @staticmethod
+    def adjust_many(user_ids, change):
+        UnreadNotificationCount.objects.filter(user_id__in=user_ids).update(count=F('count') + change)
+        UnreadNotificationCount.invalidate_many(user_ids)
+        Notification.publish_changes(user_ids)
+
+    #Drop the cached count now and again once the transaction commits, so a read in between can't cache the old value
+    @staticmethod
+    def invalidate(user_id):
+        UnreadNotificationCount.invalidate_many([user_id])
+
+    @staticmethod
+    def invalidate_many(user_ids):
+        keys = [UnreadNotificationCount.get_cache_key(user_id) for user_id in user_ids]
+        UnreadNotificationCount.get_cache().delete_many(keys)
+        transaction.on_commit(lambda: UnreadNotificationCount.get_cache().delete_many(keys))
 
 class NotificationType(models.Model):
     name = models.CharField(max_length=50, unique=True)
     label = models.CharField(max_length=50)
     description = models.CharField(max_length=500)
 
+    #Lookups go through the in-process registry. A name it doesn't know reloads it once, after syncing the declared
+    #types in case this is the first use of a newly declared one
+    @staticmethod
     def get(name):
-        try:
-            return NotificationType.objects.get(name=name)
-        except NotificationType.DoesNotExist:
+        notification_type = registry.get_registry().by_name.get(name)
+        if notification_type is None:
             create_notification_types()
-            return NotificationType.objects.get(name=name)
+            notification_type = registry.get_registry().by_name.get(name)
+        if notification_type is None:
+            raise NotificationType.DoesNotExist(f'No notification type named {name}')
+        return notification_type
+
+    @staticmethod
+    def get_by_id(id):
+        notification_type = registry.get_registry().by_id.get(id)
+        if notification_type is None:
+            registry.invalidate()
+            notification_type = registry.get_registry().by_id.get(id)
+        if notification_type is None:
+            raise NotificationType.DoesNotExist(f'No notification type with id {id}')
+        return notification_type
+
+    @staticmethod
+    def get_all():
+        return registry.get_registry().types
+
+    @receiver(post_save, sender='notifications.NotificationType')
+    @receiver(post_delete, sender='notifications.NotificationType')
+    def invalidate_registry(sender, **kwargs):
+        registry.invalidate()
+        transaction.on_commit(registry.invalidate)
 
     def __str__(self):
         return f'label'
 
+#System message text stored once for every user it's sent to. Users are notified with the broadcast as the content of
+#their notification and get a PrivateMessage referencing it the first time they open their messages (see deliver)
+class SystemBroadcast(models.Model):
+    text = models.TextField()
+    #Identifies broadcasts that are reused, like the welcome message for each version of its text
+    key = models.CharField(max_length=100, unique=True, null=True, blank=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+    #Progress of sending it to every user (see send_chunk). Users who sign up after it was started don't get it
+    recipients_up_to = models.BigIntegerField(null=True, blank=True)
+    last_user_id = models.BigIntegerField(default=0)
+    sent_to = models.PositiveIntegerField(default=0)
+    started_on = models.DateTimeField(null=True, blank=True)
+    finished_on = models.DateTimeField(null=True, blank=True)
+    notifications = NotificationRelation()
+    archived_notifications = GenericRelation('notifications.ArchivedNotification')
+
+    class NotificationsMeta:
+        pass
+
+    def __str__(self):
+        return f'{self.get_text()}'
+
+    @staticmethod
+    def get_welcome_message(text):
+        broadcast, created = SystemBroadcast.objects.get_or_create(key=f'welcome:{sha256(text.encode("utf-8")).hexdigest()}', defaults={'text': text})
+        return broadcast
+
+    #Fix who it goes to. Does nothing if it was already started, so sending can be resumed by starting it again
+    def start(self):
+        SystemBroadcast.objects.filter(pk=self.pk, started_on__isnull=True).update(recipients_up_to=User.objects.aggregate(last=models.Max('id'))['last'] or 0, started_on=timezone.now())
+        self.refresh_from_db()
+
+    #Notify the next chunk_size users (in id order) and record how far it got in the same transaction. Returns the
+    #number notified, 0 once every user has been
+    def send_chunk(self, chunk_size):
+        with transaction.atomic():
+            broadcast = SystemBroadcast.objects.select_for_update().get(pk=self.pk)
+            if broadcast.started_on is None:
+                raise ValueError(f'Broadcast {self.pk} has not been started')
+            user_ids = list(User.objects.filter(id__gt=broadcast.last_user_id, id__lte=broadcast.recipients_up_to).order_by('id').values_list('id', flat=True)[:chunk_size])
+            if user_ids:
+                notification_type = NotificationType.get('private_message')
+                Notification.create_many([Notification(content=broadcast, user_id=user_id, type=notification_type) for user_id in user_ids])
+                SystemBroadcast.objects.filter(pk=self.pk).update(last_user_id=user_ids[-1], sent_to=F('sent_to') + len(user_ids))
+            elif broadcast.finished_on is None:
+                SystemBroadcast.objects.filter(pk=self.pk).update(finished_on=timezone.now())
+        self.refresh_from_db()
+        return len(user_ids)
+
+    #Create the PrivateMessages of the broadcasts sending has got as far as the user with (see send_chunk) and of their
+    #welcome message, dated when those were sent. A single query once everything has been. Returns the number created
+    @staticmethod
+    def deliver(user):
+        welcome_message = WelcomeMessage.objects.filter(user=user, broadcast=OuterRef('pk')).values('created_on')
+        undelivered = SystemBroadcast.objects.annotate(welcome_on=Subquery(welcome_message)).filter(Q(key__isnull=True, last_user_id__gte=user.pk) | Q(welcome_on__isnull=False))
+        undelivered = undelivered.exclude(pk__in=user.user_reciever.filter(broadcast__isnull=False).values('broadcast_id'))
+        sent_on = dict(undelivered.values_list('pk', Coalesce('welcome_on', 'started_on')))
+        if not sent_on:
+            return 0
+        with transaction.atomic():
+            #Two requests delivering at once both try to create the same messages
+            PrivateMessage.objects.bulk_create([PrivateMessage(receiver=user, broadcast_id=broadcast_id) for broadcast_id in sent_on], ignore_conflicts=True)
+            for broadcast_id, created_on in sent_on.items():
+                user.user_reciever.filter(broadcast_id=broadcast_id).update(created_on=created_on)
+        return len(sent_on)
+
+#The welcome message a user is owed, recorded when they sign up. Their PrivateMessage is made by SystemBroadcast.deliver
+class WelcomeMessage(models.Model):
+    user = models.OneToOneField(User, primary_key=True, on_delete=CASCADE)
+    broadcast = models.ForeignKey(SystemBroadcast, on_delete=CASCADE)
+    created_on = models.DateTimeField(auto_now_add=True)
+
 class PrivateMessage(models.Model):
     sender = models.ForeignKey(User, blank=True, null=True, on_delete=CASCADE, related_name='user_sender')
     receiver = models.ForeignKey(User, on_delete=CASCADE, related_name='user_reciever')
-    text = models.TextField(max_length=500)
+    #Empty for messages of a SystemBroadcast, which has the text instead
+    text = models.TextField(max_length=500, blank=True)
+    broadcast = models.ForeignKey(SystemBroadcast, null=True, blank=True, on_delete=CASCADE)
+    #Set on save for every message with a sender, system messages aren't part of a conversation
+    conversation = models.ForeignKey('notifications.Conversation', null=True, blank=True, on_delete=CASCADE, related_name='messages')
     created_on = models.DateTimeField(auto_now_add=True)
+    notifications = NotificationRelation()
+    archived_notifications = GenericRelation('notifications.ArchivedNotification')
 
     class Meta:
         ordering = ['-created_on']
+        indexes = [
+            models.Index(fields=['receiver', '-created_on', '-id'], name='message_receiver_recent_idx'),
+            models.Index(fields=['conversation', '-created_on', '-id'], name='message_thread_recent_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['receiver', 'broadcast'], condition=models.Q(broadcast__isnull=False), name='message_receiver_broadcast_unique'),
+        ]
 
     class NotificationsMeta:
+        notification_select_related = ['sender']
         notifications = [
             ('private_message', 'Private message recieved', 'When a user send you a private messsage')
         ]
 
+    def get_text(self):
+        return self.broadcast.text if self.broadcast_id else self.text
+
     def is_system_message(self):
         return self.sender == None
 
@@ -92,6 +498,107 @@ class PrivateMessage(models.Model):
         return reverse('notifications:privatemessage_user_detail', kwargs={'pk': self.receiver.id})
 
     def __str__(self):
-        return f'{self.text}'
+        return f'{self.get_text()}'
+
+#Messages between two users, keyed by the lower and higher of their ids so either of them finds the same row. Each user
+#also gets a ConversationMember holding their unread count, which is what their inbox lists
+class Conversation(models.Model):
+    user_low = models.ForeignKey(User, on_delete=CASCADE, related_name='+')
+    user_high = models.ForeignKey(User, on_delete=CASCADE, related_name='+')
+    last_message = models.ForeignKey(PrivateMessage, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    updated_on = models.DateTimeField()
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_low', 'user_high'], name='conversation_users_unique'),
+        ]
+
+    @staticmethod
+    def get(user_id, other_user_id):
+        user_low_id, user_high_id = sorted((user_id, other_user_id))
+        return Conversation.objects.filter(user_low_id=user_low_id, user_high_id=user_high_id).first()
+
+    @staticmethod
+    def get_or_create(user_id, other_user_id):
+        conversation = Conversation.get(user_id, other_user_id)
+        if conversation:
+            return conversation
+        user_low_id, user_high_id = sorted((user_id, other_user_id))
+        try:
+            with transaction.atomic():
+                conversation = Conversation.objects.create(user_low_id=user_low_id, user_high_id=user_high_id, updated_on=timezone.now())
+                ConversationMember.objects.bulk_create([
+                    ConversationMember(conversation=conversation, user_id=member_id, other_user_id=user_high_id if member_id == user_low_id else user_low_id, updated_on=conversation.updated_on)
+                    for member_id in {user_low_id, user_high_id}
+                ])
+            return conversation
+        #Both users sent their first message at the same time
+        except IntegrityError:
+            return Conversation.get(user_id, other_user_id)
+
+    @staticmethod
+    def add_message(message):
+        Conversation.objects.filter(pk=message.conversation_id).update(last_message=message, updated_on=message.created_on)
+        unread = F('unread')
+        if message.sender_id != message.receiver_id:
+            unread = Case(When(user_id=message.receiver_id, then=F('unread') + 1), default=F('unread'))
+        ConversationMember.objects.filter(conversation_id=message.conversation_id).update(updated_on=message.created_on, unread=unread)
+
+    #The deleted message was unread if it came after the receiver last read the conversation. The activity time is
+    #left alone so the conversation doesn't move in the inbox
+    @staticmethod
+    def remove_message(message):
+        if message.sender_id != message.receiver_id:
+            ConversationMember.objects.filter(conversation_id=message.conversation_id, user_id=message.receiver_id, unread__gt=0).filter(
+                Q(read_on__isnull=True) | Q(read_on__lt=message.created_on)
+            ).update(unread=F('unread') - 1)
+        latest = PrivateMessage.objects.filter(conversation=OuterRef('pk')).order_by('-created_on', '-id').values('id')[:1]
+        Conversation.objects.filter(pk=message.conversation_id, last_message__isnull=True).update(last_message=Subquery(latest))
+
+    #Only written when there is something unread, so reading a conversation again costs no write
+    def mark_read(self, user):
+        ConversationMember.objects.filter(conversation=self, user=user, unread__gt=0).update(unread=0, read_on=timezone.now())
+
+    @receiver(pre_save, sender='notifications.PrivateMessage')
+    def set_conversation(sender, instance, **kwargs):
+        if instance._state.adding and instance.sender_id and not instance.conversation_id:
+            instance.conversation = Conversation.get_or_create(instance.sender_id, instance.receiver_id)
+
+    @receiver(post_save, sender='notifications.PrivateMessage')
+    def add_to_conversation(sender, instance, created, **kwargs):
+        if created and instance.conversation_id:
+            Conversation.add_message(instance)
+
+    @receiver(post_delete, sender='notifications.PrivateMessage')
+    def remove_from_conversation(sender, instance, **kwargs):
+        if instance.conversation_id:
+            Conversation.remove_message(instance)
+
+
+    def __str__(self):
+        return f'{self.user_low_id} - {self.user_high_id}'
+
+#A user's side of a conversation. updated_on is copied from the conversation so the inbox is one range of the
+#(user, updated_on) index
+class ConversationMember(models.Model):
+    conversation = models.ForeignKey(Conversation, on_delete=CASCADE, related_name='members')
+    user = models.ForeignKey(User, on_delete=CASCADE, related_name='conversations')
+    other_user = models.ForeignKey(User, on_delete=CASCADE, related_name='+')
+    unread = models.PositiveIntegerField(default=0)
+    read_on = models.DateTimeField(null=True, blank=True)
+    updated_on = models.DateTimeField()
+
+    class Meta:
+        ordering = ['-updated_on']
+        indexes = [
+            models.Index(fields=['user', '-updated_on', '-id'], name='conversation_recent_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'user'], name='conversation_member_unique'),
+        ]
+
+    def get_messages_url(self):
+        return reverse('notifications:privatemessage_user_detail', kwargs={'pk': self.other_user_id})
 
     
\ No newline at end of file
@@ -0,0 +1,25 @@
+from types import MappingProxyType
+
+#Every NotificationType row, loaded once per process so looking a type up by name or id doesn't need a query. The
+#instances are shared between requests and must not be modified. Saving or deleting a NotificationType, or syncing the
+#declared types (see utils.create_notification_types), invalidates it and the next lookup reloads it
+class NotificationTypeRegistry:
+
+    def __init__(self, notification_types):
+        self.types = tuple(notification_types)
+        self.by_name = MappingProxyType({notification_type.name: notification_type for notification_type in self.types})
+        self.by_id = MappingProxyType({notification_type.pk: notification_type for notification_type in self.types})
+
+_registry = None
+
+def get_registry():
+    global _registry
+    registry = _registry
+    if registry is None:
+        from notifications.models import NotificationType
+        registry = _registry = NotificationTypeRegistry(NotificationType.objects.order_by('id'))
+    return registry
+
+def invalidate():
+    global _registry
+    _registry = None
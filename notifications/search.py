@@ -0,0 +1,98 @@
+import re
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.db.models.expressions import RawSQL
+from .models import PrivateMessage
+
+FTS_TABLE = 'notifications_privatemessage_fts'
+
+#Words of the search, each matched as a prefix so results show up while the last word is still being typed
+def get_terms(query):
+    return re.findall(r'[^\W_]+', query.lower())[:10]
+
+#Private message search backends. Each searches the messages of the conversations a user is in, messages have to
+#contain every term (as a prefix)
+class IContainsBackend:
+    name = 'icontains'
+
+    @staticmethod
+    def is_available():
+        return True
+
+    def get_messages(self, user, terms):
+        messages = PrivateMessage.objects.filter(conversation__members__user=user)
+        for term in terms:
+            messages = messages.filter(text__icontains=term)
+        return messages
+
+    #No relevance to go on, newest first
+    def get_ranked(self, user, terms, limit):
+        return list(self.get_messages(user, terms).select_related('sender', 'receiver')[:limit])
+
+#SQLite FTS5 table kept in sync by triggers (see migration 0009). Along with the text each row has the ids of the
+#conversation's users as u<id> tokens, so restricting a search to a user's messages happens inside the index
+class SQLiteFTSBackend:
+    name = 'fts5'
+    available = False
+
+    #The table is only there if this SQLite was built with FTS5. Once found it's not looked for again
+    @classmethod
+    def is_available(cls):
+        if not cls.available and connection.vendor == 'sqlite':
+            cls.available = FTS_TABLE in connection.introspection.table_names()
+        return cls.available
+
+    def get_match(self, user, terms):
+        return 'text : ({}) AND users : "u{}"'.format(' '.join(f'"{term}"*' for term in terms), user.pk)
+
+    def get_messages(self, user, terms):
+        return PrivateMessage.objects.filter(id__in=RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [self.get_match(user, terms)]))
+
+    #Best bm25 rank first
+    def get_ranked(self, user, terms, limit):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s ORDER BY rank LIMIT %s', [self.get_match(user, terms), limit])
+            ids = [row[0] for row in cursor.fetchall()]
+        messages = PrivateMessage.objects.select_related('sender', 'receiver').in_bulk(ids)
+        return [messages[id] for id in ids if id in messages]
+
+#Postgres full text search over a GIN index on to_tsvector('simple', text) (see migration 0009). The expressions
+#here have to stay the same as the index's for it to be used
+class PostgresSearchBackend:
+    name = 'postgres'
+    config = 'simple'
+
+    @staticmethod
+    def is_available():
+        return connection.vendor == 'postgresql'
+
+    def get_search(self, terms):
+        from django.contrib.postgres.search import SearchQuery, SearchVector
+        return SearchVector('text', config=self.config), SearchQuery(' & '.join(f'{term}:*' for term in terms), search_type='raw', config=self.config)
+
+    def get_messages(self, user, terms):
+        vector, query = self.get_search(terms)
+        return PrivateMessage.objects.filter(conversation__members__user=user).annotate(search=vector).filter(search=query)
+
+    def get_ranked(self, user, terms, limit):
+        from django.contrib.postgres.search import SearchRank
+        vector, query = self.get_search(terms)
+        messages = self.get_messages(user, terms).annotate(search_rank=SearchRank(vector, query))
+        return list(messages.select_related('sender', 'receiver').order_by('-search_rank', '-created_on')[:limit])
+
+BACKENDS = {backend.name: backend for backend in [SQLiteFTSBackend, PostgresSearchBackend, IContainsBackend]}
+
+def get_available_backends():
+    return [name for name, backend in BACKENDS.items() if backend.is_available()]
+
+#NOTIFICATIONS_SEARCH_BACKEND, or the database's own full text search when it has one
+def get_backend(backend_name=None):
+    backend_name = backend_name or getattr(settings, 'NOTIFICATIONS_SEARCH_BACKEND', None)
+    if backend_name is None:
+        return BACKENDS[get_available_backends()[0]]()
+    if backend_name not in BACKENDS:
+        raise ImproperlyConfigured(f'Unknown NOTIFICATIONS_SEARCH_BACKEND {backend_name!r}, expected one of {", ".join(BACKENDS)}')
+    if not BACKENDS[backend_name].is_available():
+        raise ImproperlyConfigured(f'NOTIFICATIONS_SEARCH_BACKEND {backend_name!r} is not available on this database')
+    return BACKENDS[backend_name]()
@@ -1,16 +1,22 @@
 from django import template
+from django.conf import settings
 from django.db.models import query
 from math import floor
 from os.path import join
-from notifications.models import Notification
+from django.contrib.contenttypes.models import ContentType
+from notifications.models import Notification, ArchivedNotification, UnreadNotificationCount
 
 register = template.Library()
 
+@register.simple_tag
+def get_live_notifications_enabled():
+    return getattr(settings, 'NOTIFICATIONS_LIVE_UPDATES', False)
+
 @register.simple_tag
 def get_unread_notification_count(user):
     if not user.is_authenticated:
         return 0
-    return user.notification_set.filter(seen=False).all().count()
+    return UnreadNotificationCount.get(user)
 
 @register.tag
 def inline_notification(parser, token):
@@ -23,22 +29,28 @@ def inline_notification(parser, token):
 class InlineNotificationNode(template.Node):
     def __init__(self, notification):
         self.notification = template.Variable(notification)
+        #content type id -> (compiled template, context name)
+        self.templates = {}
+
+    def get_template(self, content_type_id):
+        if content_type_id not in self.templates:
+            content_class = ContentType.objects.get_for_id(content_type_id).model_class()
+            meta = getattr(content_class, 'NotificationsMeta', None)
+            content_type_name = content_class.__name__.lower()
+            notifcation_inline_template = getattr(meta, 'notifcation_inline_template', join(content_class._meta.app_label, f'{content_type_name}_notification_inline.html'))
+            notifcation_inline_context_name = getattr(meta, 'notifcation_inline_context_name', content_type_name)
+            self.templates[content_type_id] = (template.loader.get_template(notifcation_inline_template), notifcation_inline_context_name)
+        return self.templates[content_type_id]
 
     def render(self, context):
         try:
             notification = self.notification.resolve(context)
-            if not isinstance(notification, Notification):
+            if not isinstance(notification, (Notification, ArchivedNotification)):
                 raise ValueError(f'Expected Notification got {type(object)}')
-            content = notification.content
-            content_class = notification.content_type.model_class()
-            app_label = content._meta.app_label
-            meta = getattr(content_class, 'NotificationsMeta', None)
-            content_type_name = content_class.__name__.lower()
-            notifcation_inline_template = getattr(meta, 'notifcation_inline_template', join(app_label, f'{content_type_name}_notification_inline.html'))
-            notifcation_inline_context_name = getattr(meta, 'notifcation_inline_context_name', content_type_name)
+            inline_template, context_name = self.get_template(notification.content_type_id)
             new_context = {}
-            new_context[notifcation_inline_context_name] = content
+            new_context[context_name] = notification.content
             new_context['notification'] = notification
-            return template.loader.get_template(notifcation_inline_template).render(new_context, context.get('request'))
+            return inline_template.render(new_context, context.get('request'))
         except template.VariableDoesNotExist:
-            return 'Variable not resolved'
\ No newline at end of file
+            return 'Variable not resolved'
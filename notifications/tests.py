@@ -1,7 +1,34 @@
-from notifications.models import PrivateMessage, Notification, NotificationType
-from django.test import TestCase
+from blog.models import Post, Comment, CommentVote
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sessions.models import Session
+from django.db.models.signals import pre_delete, post_delete
+from notifications.models import ArchivedNotification, Conversation, ConversationMember, SystemBroadcast, PrivateMessage, Notification, NotificationType, UnreadNotificationCount
+from notifications.utils import check_live_updates, create_notification_types, is_process_local_cache
+from notifications.models import LOCAL_CACHE_TIMEOUT
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from notifications import registry
+from notifications.broker import broker
+from notifications.search import BACKENDS, get_backend, get_available_backends, get_terms
+from notifications.views import POLL_CHECK_INTERVAL, POLL_NOTIFICATIONS
+from asgiref.sync import sync_to_async
+from time import time
+import asyncio
+from urllib.parse import urlencode
+from jobs.worker import run_pending_jobs
+from notifications.templatetags.notification_tags import get_unread_notification_count
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils import timezone
+from datetime import timedelta
+from io import StringIO
+from django.test import TestCase, override_settings
+from django.core.exceptions import ImproperlyConfigured
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from django.contrib.auth.models import User
 from django.urls import reverse
+from django.conf import settings
 
 # Create your tests here.
 class PrivateMessageModelTests(TestCase):
@@ -68,6 +95,527 @@ class NotificationIndexViewTests(TestCase):
         for notification in self.sender_notifications:
             self.assertNotIn(notification, resp.context['notification_list'])
 
+    def test_notification_index_marks_only_the_shown_notifications_seen(self):
+        extra = [Notification.objects.create(content=message, user=self.receiver, type=self.notification_type_one) for message in self.messages * 5]
+        self.client.force_login(self.receiver)
+        resp = self.client.get(reverse('notifications:notification_index'))
+        shown = [notification.pk for notification in resp.context['notification_list']]
+        self.assertEqual(len(shown), 20)
+        self.assertEqual(set(self.receiver.notification_set.filter(seen=True).values_list('pk', flat=True)), set(shown))
+
+    @override_settings(NOTIFICATIONS_MARK_ALL_SEEN=True)
+    def test_notification_index_can_mark_every_notification_seen(self):
+        extra = [Notification.objects.create(content=message, user=self.receiver, type=self.notification_type_one) for message in self.messages * 5]
+        self.client.force_login(self.receiver)
+        self.client.get(reverse('notifications:notification_index'))
+        self.assertFalse(self.receiver.notification_set.filter(seen=False).exists())
+
+    def test_notification_index_marks_notifications_seen_in_one_query(self):
+        self.client.force_login(self.receiver)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('notifications:notification_index'))
+        updates = [query for query in queries if query['sql'].startswith('UPDATE "notifications_notification"')]
+        self.assertEqual(len(updates), 1)
+        self.assertFalse(self.receiver.notification_set.filter(seen=False).exists())
+
+    def count_index_queries(self):
+        self.client.get(reverse('notifications:notification_index'))
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(reverse('notifications:notification_index'))
+        return len(queries), resp
+
+    def test_notification_index_queries_do_not_grow_with_notifications(self):
+        post = Post.objects.create(author=self.receiver.author, title='test_post', content='test_content')
+        comment = Comment.objects.create(post=post, commenter=self.sender, text='first_comment')
+        Notification.objects.create(content=comment, user=self.receiver, type=NotificationType.get(name='new_comment_on_post'))
+        self.client.force_login(self.receiver)
+        few, resp = self.count_index_queries()
+        for i in range(5):
+            comment = Comment.objects.create(post=post, commenter=self.sender, text=f'test_comment_{i}')
+            Notification.objects.create(content=comment, user=self.receiver, type=NotificationType.get(name='new_comment_on_post'))
+            message = PrivateMessage.objects.create(text=f'extra_message_{i}', sender=self.sender, receiver=self.receiver)
+            Notification.objects.create(content=message, user=self.receiver, type=NotificationType.get(name='private_message'))
+        many, resp = self.count_index_queries()
+        self.assertEqual(few, many)
+        self.assertContains(resp, 'test_comment_4')
+        self.assertContains(resp, 'extra_message_4')
+
+class UnreadNotificationCountTest(TestCase):
+
+    def setUp(self):
+        self.sender = User.objects.create(username='sender_username', password='test')
+        self.receiver = User.objects.create(username='receiver_username', password='test')
+        self.initial = self.receiver.notification_set.filter(seen=False).count()
+        self.messages = [PrivateMessage.objects.create(text=f'message_{i}', sender=self.sender, receiver=self.receiver) for i in range(5)]
+        self.notifications = [Notification.objects.create(content=message, user=self.receiver, type=NotificationType.get(name='private_message')) for message in self.messages]
+
+    def test_unread_count_follows_notifications(self):
+        self.assertEqual(get_unread_notification_count(self.receiver), self.initial + 5)
+        Notification.mark_seen(self.receiver, [self.notifications[0].pk, self.notifications[1].pk])
+        Notification.mark_seen(self.receiver, [self.notifications[0].pk])
+        self.assertEqual(get_unread_notification_count(self.receiver), self.initial + 3)
+        self.notifications[4].delete()
+        Notification.objects.get(pk=self.notifications[0].pk).delete()
+        self.assertEqual(get_unread_notification_count(self.receiver), self.initial + 2)
+        Notification.mark_seen(self.receiver)
+        self.assertEqual(get_unread_notification_count(self.receiver), 0)
+
+    def test_unread_count_is_cached(self):
+        get_unread_notification_count(self.receiver)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(get_unread_notification_count(self.receiver), self.initial + 5)
+        self.assertEqual(len(queries), 0)
+
+    def test_unread_count_is_cached_briefly_in_a_process_local_cache(self):
+        cache = UnreadNotificationCount.get_cache()
+        self.assertTrue(is_process_local_cache(cache))
+        self.assertEqual(UnreadNotificationCount.get_cache_timeout(cache), LOCAL_CACHE_TIMEOUT)
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}, 'shared': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'cache'}}):
+            self.assertFalse(is_process_local_cache(caches['shared']))
+            self.assertEqual(UnreadNotificationCount.get_cache_timeout(caches['shared']), DEFAULT_TIMEOUT)
+
+    def test_reconcileunreadcounts_command_fixes_drift(self):
+        UnreadNotificationCount.objects.filter(user=self.receiver).update(count=100)
+        UnreadNotificationCount.objects.filter(user=self.sender).delete()
+        out = StringIO()
+        call_command('reconcileunreadcounts', stdout=out)
+        self.assertIn('Fixed 2 of 2 unread notification count(s)', out.getvalue())
+        self.assertEqual(get_unread_notification_count(self.receiver), self.initial + 5)
+        self.assertEqual(UnreadNotificationCount.objects.get(user=self.sender).count, self.sender.notification_set.filter(seen=False).count())
+
+class NotificationTypeRegistryTest(TestCase):
+
+    def setUp(self):
+        #Rows created here are rolled back after each test but the registry is per process
+        self.addCleanup(registry.invalidate)
+
+    def test_declared_types_are_synced_by_migrate(self):
+        names = set(NotificationType.objects.values_list('name', flat=True))
+        self.assertTrue({'private_message', 'new_comment_on_post'} <= names)
+
+    def test_lookups_do_not_query_once_loaded(self):
+        NotificationType.get_all()
+        with CaptureQueriesContext(connection) as queries:
+            notification_type = NotificationType.get('private_message')
+            self.assertEqual(NotificationType.get_by_id(notification_type.pk), notification_type)
+            self.assertIn(notification_type, NotificationType.get_all())
+        self.assertEqual(len(queries), 0)
+
+    def test_saving_a_type_invalidates_the_registry(self):
+        NotificationType.get_all()
+        notification_type = NotificationType.objects.create(name='test_type', label='test_label')
+        self.assertEqual(NotificationType.get('test_type'), notification_type)
+        notification_type.label = 'changed_label'
+        notification_type.save()
+        self.assertEqual(NotificationType.get_by_id(notification_type.pk).label, 'changed_label')
+        notification_type.delete()
+        self.assertRaises(NotificationType.DoesNotExist, NotificationType.get, 'test_type')
+
+    def test_create_notification_types_syncs_declarations(self):
+        NotificationType.objects.filter(name='private_message').update(label='stale_label')
+        NotificationType.objects.filter(name='new_comment_on_post').delete()
+        create_notification_types()
+        self.assertEqual(NotificationType.get('private_message').label, 'Private message recieved')
+        self.assertTrue(NotificationType.objects.filter(name='new_comment_on_post').exists())
+
+class NotificationAggregationTest(TestCase):
+
+    def setUp(self):
+        self.author = User.objects.create(username='author_username', password='test')
+        self.commenters = [User.objects.create(username=f'commenter_{i}', password='test') for i in range(2)]
+        self.post = Post.objects.create(author=self.author.author, title='test_post', content='test_content')
+        self.other_post = Post.objects.create(author=self.author.author, title='other_post', content='test_content')
+        self.notification_type = NotificationType.get(name='new_comment_on_post')
+
+    def notify(self, post, commenter):
+        comment = Comment.objects.create(post=post, commenter=commenter, text=f'comment_by_{commenter.username}')
+        Notification.create_many([Notification(content=comment, user=self.author, actor=commenter, type=self.notification_type)])
+        return comment
+
+    @override_settings(NOTIFICATIONS_AGGREGATE=True)
+    def test_unseen_notifications_about_the_same_target_are_folded(self):
+        self.notify(self.post, self.commenters[0])
+        self.notify(self.other_post, self.commenters[0])
+        latest = self.notify(self.post, self.commenters[1])
+        notifications = self.author.notification_set.filter(type=self.notification_type)
+        self.assertEqual(notifications.count(), 2)
+        aggregate = notifications.get(target_id=self.post.pk)
+        self.assertEqual((aggregate.count, aggregate.content, aggregate.actor, aggregate.target), (2, latest, self.commenters[1], self.post))
+        self.assertEqual(get_unread_notification_count(self.author), 2)
+
+    @override_settings(NOTIFICATIONS_AGGREGATE=True)
+    def test_seen_notifications_are_not_folded_into(self):
+        self.notify(self.post, self.commenters[0])
+        Notification.mark_seen(self.author)
+        self.notify(self.post, self.commenters[1])
+        self.assertEqual(list(self.author.notification_set.filter(type=self.notification_type).values_list('seen', 'count')), [(False, 1), (True, 1)])
+
+    @override_settings(NOTIFICATIONS_AGGREGATE=True)
+    def test_batches_are_folded_before_writing(self):
+        comments = [Comment.objects.create(post=self.post, commenter=self.commenters[i % 2], text=f'comment_{i}') for i in range(4)]
+        with CaptureQueriesContext(connection) as queries:
+            Notification.create_many([Notification(content=comment, user=self.author, type=self.notification_type) for comment in comments])
+        self.assertLess(len(queries), 10)
+        self.assertEqual(self.author.notification_set.get(type=self.notification_type).count, 4)
+
+    @override_settings(NOTIFICATIONS_AGGREGATE=True)
+    def test_deleting_the_latest_folded_comment_repoints_the_notification(self):
+        first = self.notify(self.post, self.commenters[0])
+        latest = self.notify(self.post, self.commenters[1])
+        latest.delete()
+        aggregate = self.author.notification_set.get(type=self.notification_type)
+        self.assertEqual((aggregate.count, aggregate.content, aggregate.actor), (1, first, self.commenters[0]))
+        self.assertEqual(get_unread_notification_count(self.author), 1)
+        first.delete()
+        self.assertFalse(self.author.notification_set.exists())
+        self.assertEqual(get_unread_notification_count(self.author), 0)
+
+    @override_settings(NOTIFICATIONS_AGGREGATE=True)
+    def test_deleting_an_earlier_folded_comment_decrements_the_count(self):
+        first = self.notify(self.post, self.commenters[0])
+        own = Comment.objects.create(post=self.post, commenter=self.author, text='own_comment')
+        self.notify(self.post, self.commenters[1])
+        latest = self.notify(self.post, self.commenters[0])
+        own.delete()
+        self.assertEqual(self.author.notification_set.get(type=self.notification_type).count, 3)
+        first.delete()
+        aggregate = self.author.notification_set.get(type=self.notification_type)
+        self.assertEqual((aggregate.count, aggregate.content), (2, latest))
+
+    @override_settings(NOTIFICATIONS_AGGREGATE=True)
+    def test_deleting_the_target_deletes_the_folded_notification(self):
+        for commenter in self.commenters:
+            self.notify(self.post, commenter)
+        self.notify(self.other_post, self.commenters[0])
+        self.post.delete()
+        self.assertEqual(list(self.author.notification_set.values_list('target_id', flat=True)), [self.other_post.pk])
+        self.assertEqual(get_unread_notification_count(self.author), 1)
+
+    def test_notifications_are_separate_when_aggregation_is_off(self):
+        for commenter in self.commenters:
+            self.notify(self.post, commenter)
+        self.assertEqual(list(self.author.notification_set.filter(type=self.notification_type).values_list('count', flat=True)), [1, 1])
+
+    @override_settings(NOTIFICATIONS_AGGREGATE=True)
+    def test_inline_notification_renders_the_aggregate(self):
+        for commenter in self.commenters * 2:
+            self.notify(self.post, commenter)
+        self.client.force_login(self.author)
+        resp = self.client.get(reverse('notifications:notification_index'))
+        self.assertContains(resp, '4 new comments on your post')
+        self.assertContains(resp, 'comment_by_commenter_1')
+
+#WhiteNoise's middleware is sync only and would hold the thread the view's database calls run on while it waits
+@override_settings(NOTIFICATIONS_LIVE_UPDATES=True, NOTIFICATIONS_POLL_TIMEOUT=10, MIDDLEWARE=[middleware for middleware in settings.MIDDLEWARE if 'whitenoise' not in middleware])
+class NotificationPollViewTest(TestCase):
+
+    def setUp(self):
+        self.sender = User.objects.create(username='sender_username', password='test')
+        self.receiver = User.objects.create(username='receiver_username', password='test')
+        self.async_client.force_login(self.receiver)
+
+    def notify(self, text):
+        with self.captureOnCommitCallbacks(execute=True):
+            message = PrivateMessage.objects.create(text=text, sender=self.sender, receiver=self.receiver)
+            Notification.objects.create(content=message, user=self.receiver, type=NotificationType.get(name='private_message'))
+
+    #The async test client of this Django version doesn't send get data, so it goes in the path
+    async def poll(self, **params):
+        resp = await self.async_client.get(f'{reverse("notifications:notification_poll")}?{urlencode(params)}')
+        return resp.status_code, resp.json()
+
+    async def test_poll_requires_login(self):
+        await sync_to_async(self.async_client.logout)()
+        self.assertEqual((await self.poll())[0], 403)
+
+    def test_live_updates_need_a_shared_cache_and_asgi(self):
+        with self.assertRaisesMessage(ImproperlyConfigured, 'shared between processes'):
+            check_live_updates()
+        with override_settings(NOTIFICATIONS_CACHE_ALIAS='shared', CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}, 'shared': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'cache'}}):
+            check_live_updates()
+            with self.assertRaisesMessage(ImproperlyConfigured, 'ASGI'):
+                check_live_updates(asgi=False)
+        with override_settings(NOTIFICATIONS_LIVE_UPDATES=False):
+            check_live_updates(asgi=False)
+
+    @override_settings(NOTIFICATIONS_LIVE_UPDATES=False)
+    async def test_poll_is_disabled_by_default(self):
+        resp = await self.async_client.get(reverse('notifications:notification_poll'))
+        self.assertEqual(resp.status_code, 404)
+
+    async def test_poll_without_since_returns_the_current_state(self):
+        await sync_to_async(self.notify)('first_message')
+        status, data = await self.poll()
+        self.assertEqual((status, data['count'], data['notifications']), (200, 1, []))
+        self.assertIn('since', data)
+
+    async def test_poll_returns_notifications_after_since(self):
+        status, data = await self.poll()
+        await sync_to_async(self.notify)('new_message')
+        status, data = await self.poll(since=data['since'], count=data['count'])
+        self.assertEqual(data['count'], 1)
+        self.assertEqual(len(data['notifications']), 1)
+        self.assertIn('new_message', data['notifications'][0]['html'])
+
+    async def test_polls_catch_up_on_more_notifications_than_fit_in_one(self):
+        status, data = await self.poll()
+        for i in range(POLL_NOTIFICATIONS + 5):
+            await sync_to_async(self.notify)(f'message_{i}_')
+        status, first = await self.poll(since=data['since'], count=data['count'])
+        self.assertEqual(len(first['notifications']), POLL_NOTIFICATIONS)
+        self.assertIn(f'message_{POLL_NOTIFICATIONS - 1}_', first['notifications'][0]['html'])
+        self.assertIn('message_0_', first['notifications'][-1]['html'])
+        status, second = await self.poll(since=first['since'], count=first['count'])
+        self.assertEqual([f'message_{i}_' in notification['html'] for i, notification in zip(range(POLL_NOTIFICATIONS + 4, POLL_NOTIFICATIONS - 1, -1), second['notifications'])], [True] * 5)
+        self.assertEqual(len(second['notifications']), 5)
+
+    async def test_waiting_poll_is_woken_by_new_notifications(self):
+        status, data = await self.poll()
+        started = time()
+        waiting = asyncio.ensure_future(self.poll(since=data['since'], count=data['count']))
+        while not broker.waiting(self.receiver.pk) and not waiting.done():
+            await asyncio.sleep(0.01)
+        await sync_to_async(self.notify)('live_message')
+        status, data = await asyncio.wait_for(waiting, 5)
+        self.assertLess(time() - started, POLL_CHECK_INTERVAL)
+        self.assertEqual(data['count'], 1)
+        self.assertIn('live_message', data['notifications'][0]['html'])
+
+    @override_settings(NOTIFICATIONS_POLL_TIMEOUT=0.2)
+    async def test_poll_times_out_without_changes(self):
+        status, data = await self.poll()
+        status, timed_out = await self.poll(since=data['since'], count=data['count'])
+        self.assertEqual((timed_out['count'], timed_out['notifications'], timed_out['since']), (0, [], data['since']))
+
+class NotificationCleanupTest(TestCase):
+
+    def setUp(self):
+        self.sender = User.objects.create(username='sender_username', password='test')
+        self.receiver = User.objects.create(username='receiver_username', password='test')
+        self.post = Post.objects.create(author=self.receiver.author, title='test_post', content='test_content')
+        self.comments = [Comment.objects.create(post=self.post, commenter=self.sender, text=f'test_comment_{i}') for i in range(5)]
+        for comment in self.comments:
+            Notification.objects.create(content=comment, user=self.receiver, type=NotificationType.get(name='new_comment_on_post'))
+            CommentVote.objects.create(comment=comment, user=self.receiver, type='u')
+        self.message = PrivateMessage.objects.create(text='test_message', sender=self.sender, receiver=self.receiver)
+        self.message_notification = Notification.objects.create(content=self.message, user=self.receiver, type=NotificationType.get(name='private_message'))
+
+    def test_models_without_notifications_have_no_delete_receivers(self):
+        self.assertFalse(pre_delete.has_listeners(CommentVote))
+        self.assertFalse(pre_delete.has_listeners(Session))
+
+    def test_notifications_are_deleted_without_loading_them(self):
+        self.assertFalse(pre_delete.has_listeners(Notification) or post_delete.has_listeners(Notification))
+        self.message.delete()
+        self.assertEqual(get_unread_notification_count(self.receiver), 5)
+        with CaptureQueriesContext(connection) as queries:
+            Notification.delete_many(self.receiver.notification_set.all())
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('UPDATE')]), 1)
+        self.assertEqual(get_unread_notification_count(self.receiver), 0)
+        self.assertEqual(UnreadNotificationCount.objects.get(user=self.receiver).count, 0)
+
+    def create_post_with_comments(self, count):
+        post = Post.objects.create(author=self.receiver.author, title=f'post_with_{count}_comments', content='test_content')
+        for i in range(count):
+            comment = Comment.objects.create(post=post, commenter=self.sender, text=f'comment_{i}')
+            Notification.objects.create(content=comment, user=self.receiver, type=NotificationType.get(name='new_comment_on_post'))
+            CommentVote.objects.create(comment=comment, user=self.receiver, type='u')
+        return post
+
+    def test_cascaded_delete_costs_the_same_for_any_number_of_comments(self):
+        other_post = self.create_post_with_comments(20)
+        ContentType.objects.get_for_models(Comment, Post)
+        with self.assertNumQueries(11):
+            self.post.delete()
+        self.assertEqual(get_unread_notification_count(self.receiver), 21)
+        with self.assertNumQueries(11):
+            other_post.delete()
+        self.assertEqual(get_unread_notification_count(self.receiver), 1)
+        self.assertFalse(Notification.objects.filter(content_type=ContentType.objects.get_for_model(Comment)).exists())
+        self.assertFalse(CommentVote.objects.exists())
+        self.assertTrue(Notification.objects.filter(pk=self.message_notification.pk).exists())
+
+    def test_deleting_a_private_message_clears_its_notification(self):
+        self.message.delete()
+        self.assertFalse(Notification.objects.filter(pk=self.message_notification.pk).exists())
+        self.assertEqual(Notification.objects.filter(content_type=ContentType.objects.get_for_model(Comment)).count(), 5)
+
+class PruneNotificationsTest(TestCase):
+
+    def setUp(self):
+        self.sender = User.objects.create(username='sender_username', password='test')
+        self.receiver = User.objects.create(username='receiver_username', password='test')
+        self.messages = [PrivateMessage.objects.create(text=f'message_{i}', sender=self.sender, receiver=self.receiver) for i in range(4)]
+        self.notifications = [Notification.objects.create(content=message, user=self.receiver, type=NotificationType.get(name='private_message')) for message in self.messages]
+        #Old and seen, old and unseen, new and seen, new and unseen
+        Notification.objects.filter(pk__in=[self.notifications[0].pk, self.notifications[1].pk]).update(created_on=timezone.now() - timedelta(days=60))
+        Notification.objects.filter(pk__in=[self.notifications[0].pk, self.notifications[2].pk]).update(seen=True)
+
+    def prune(self, *args):
+        out = StringIO()
+        call_command('prunenotifications', *args, stdout=out)
+        return out.getvalue()
+
+    def test_prune_requires_a_retention_period(self):
+        self.assertRaises(CommandError, self.prune)
+
+    @override_settings(NOTIFICATIONS_RETENTION_DAYS=30)
+    def test_prune_deletes_only_old_seen_notifications(self):
+        self.assertIn('Deleted 1 notification(s)', self.prune('--chunk-size', '1', '--pause', '0'))
+        self.assertEqual(set(self.receiver.notification_set.values_list('pk', flat=True)), {notification.pk for notification in self.notifications[1:]})
+        self.assertFalse(ArchivedNotification.objects.exists())
+
+    @override_settings(NOTIFICATIONS_ARCHIVE=True)
+    def test_prune_can_archive_notifications(self):
+        self.assertIn('Archived 2 notification(s)', self.prune('--days', '0'))
+        archived = ArchivedNotification.objects.order_by('created_on')
+        self.assertEqual([notification.content for notification in archived], [self.messages[0], self.messages[2]])
+        self.assertEqual(archived[0].created_on, Notification.objects.get(pk=self.notifications[1].pk).created_on)
+
+    @override_settings(NOTIFICATIONS_ARCHIVE=True)
+    def test_notification_index_pages_into_the_archive(self):
+        self.prune('--days', '30')
+        self.client.force_login(self.receiver)
+        resp = self.client.get(reverse('notifications:notification_index'))
+        self.assertNotIn(self.messages[0], [notification.content for notification in resp.context['notification_list']])
+        self.assertContains(resp, '?archived=on')
+        resp = self.client.get(reverse('notifications:notification_index'), data={'archived': 'on'})
+        self.assertEqual([notification.content for notification in resp.context['notification_list']], [self.messages[0]])
+        self.assertContains(resp, 'message_0')
+        self.assertNotContains(resp, reverse('notifications:notification_delete', kwargs={'pk': resp.context['notification_list'][0].pk}))
+
+    @override_settings(NOTIFICATIONS_ARCHIVE=True)
+    def test_deleting_content_clears_its_archived_notifications(self):
+        self.prune('--days', '0')
+        self.messages[0].delete()
+        self.assertEqual([notification.content for notification in ArchivedNotification.objects.all()], [self.messages[2]])
+
+@override_settings(NOTIFICATIONS_WELCOME_MESSAGE='welcome_message_text')
+class SystemBroadcastTest(TestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create(username=f'user_{i}', password='test') for i in range(2)]
+        run_pending_jobs()
+
+    def test_welcome_message_is_stored_once(self):
+        broadcast = SystemBroadcast.objects.get()
+        self.assertEqual(broadcast.text, 'welcome_message_text')
+        self.assertFalse(PrivateMessage.objects.exists())
+        for user in self.users:
+            self.assertEqual(user.notification_set.get().content, broadcast)
+
+    def test_system_inbox_delivers_the_message_once(self):
+        self.client.force_login(self.users[0])
+        resp = self.client.get(reverse('notifications:privatemessage_system_detail'))
+        self.assertContains(resp, 'welcome_message_text')
+        self.client.get(reverse('notifications:privatemessage_system_detail'))
+        message = PrivateMessage.objects.get()
+        self.assertEqual((message.receiver, message.text, message.get_text()), (self.users[0], '', 'welcome_message_text'))
+        self.assertEqual(message.created_on, self.users[0].welcomemessage.created_on)
+
+    def test_messages_are_delivered_after_their_notifications_are_gone(self):
+        broadcast = SystemBroadcast.objects.create(text='broadcast_text')
+        broadcast.start()
+        broadcast.send_chunk(1)
+        Notification.objects.filter(user=self.users[0]).delete()
+        self.assertEqual(SystemBroadcast.deliver(self.users[0]), 2)
+        self.assertEqual(SystemBroadcast.deliver(self.users[1]), 1)
+        self.assertEqual(self.users[0].user_reciever.get(broadcast=broadcast).created_on, broadcast.started_on)
+        broadcast.send_chunk(1)
+        self.assertEqual(SystemBroadcast.deliver(self.users[1]), 1)
+        self.assertEqual(PrivateMessage.objects.count(), 4)
+
+    def test_nothing_left_to_deliver_takes_one_query(self):
+        SystemBroadcast.deliver(self.users[0])
+        with self.assertNumQueries(1):
+            self.assertEqual(SystemBroadcast.deliver(self.users[0]), 0)
+
+    def test_message_index_delivers_and_searches_broadcasts(self):
+        self.client.force_login(self.users[1])
+        resp = self.client.get(reverse('notifications:privatemessage_index'), data={'search': 'welcome_message'})
+        self.assertEqual(resp.context['system_message'].get_text(), 'welcome_message_text')
+        resp = self.client.get(reverse('notifications:privatemessage_index'), data={'search': 'no_match'})
+        self.assertIsNone(resp.context['system_message'])
+
+    def test_notification_index_renders_broadcasts(self):
+        self.client.force_login(self.users[0])
+        resp = self.client.get(reverse('notifications:notification_index'))
+        self.assertContains(resp, 'New message from system')
+        self.assertContains(resp, 'welcome_message_text')
+
+class BroadcastTest(TestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create(username=f'user_{i}', password='test') for i in range(4)]
+        self.users.append(User.objects.create_superuser(username='admin_user', password='test'))
+        run_pending_jobs()
+        Notification.objects.all().delete()
+        UnreadNotificationCount.objects.update(count=0)
+
+    def call_broadcast(self, *args):
+        out = StringIO()
+        call_command('broadcast', '--rate', '1000000', *args, stdout=out)
+        return out.getvalue()
+
+    def assertNotifiedOnce(self, broadcast):
+        for user in self.users:
+            self.assertEqual(list(user.notification_set.values_list('object_id', flat=True)), [broadcast.pk])
+            self.assertEqual(UnreadNotificationCount.get(user), 1)
+
+    def test_broadcast_command_notifies_every_user_in_chunks(self):
+        with CaptureQueriesContext(connection) as queries:
+            out = self.call_broadcast('--text', 'broadcast_text', '--chunk-size', '2')
+        broadcast = SystemBroadcast.objects.get(text='broadcast_text')
+        self.assertNotifiedOnce(broadcast)
+        self.assertEqual(broadcast.sent_to, 5)
+        self.assertIsNotNone(broadcast.finished_on)
+        self.assertIn('Sent to 4 user(s)', out)
+        self.assertIn(f'Broadcast {broadcast.pk} sent to 5 user(s)', out)
+        #A few queries per chunk, not per user
+        self.assertLess(len(queries), 60)
+
+    def test_broadcast_command_resumes_where_it_stopped(self):
+        broadcast = SystemBroadcast.objects.create(text='broadcast_text')
+        broadcast.start()
+        self.assertEqual(broadcast.send_chunk(3), 3)
+        User.objects.create(username='late_user', password='test')
+        self.call_broadcast('--resume', str(broadcast.pk))
+        broadcast.refresh_from_db()
+        self.assertNotifiedOnce(broadcast)
+        self.assertEqual(broadcast.sent_to, 5)
+        self.assertFalse(Notification.objects.filter(user__username='late_user', object_id=broadcast.pk).exists())
+        self.assertIn('already sent', self.call_broadcast('--resume', str(broadcast.pk)))
+        self.assertEqual(Notification.objects.count(), 5)
+
+    def test_broadcast_command_requires_text(self):
+        with self.assertRaises(CommandError):
+            self.call_broadcast()
+        with self.assertRaises(CommandError):
+            self.call_broadcast('--resume', '0')
+
+    def test_admin_action_sends_with_jobs(self):
+        broadcast = SystemBroadcast.objects.create(text='broadcast_text')
+        self.client.force_login(self.users[-1])
+        self.client.post(reverse('admin:notifications_systembroadcast_changelist'), {'action': 'send_to_all_users', '_selected_action': [broadcast.pk]})
+        with override_settings(NOTIFICATIONS_BROADCAST_CHUNK_SIZE=2, NOTIFICATIONS_BROADCAST_RATE=1000000):
+            for i in range(5):
+                run_pending_jobs()
+        broadcast.refresh_from_db()
+        self.assertNotifiedOnce(broadcast)
+        self.assertIsNotNone(broadcast.finished_on)
+
+    def test_welcome_messages_are_not_sent_to_all_users(self):
+        welcome_message = SystemBroadcast.get_welcome_message('welcome_message_text')
+        self.client.force_login(self.users[-1])
+        resp = self.client.post(reverse('admin:notifications_systembroadcast_changelist'), {'action': 'send_to_all_users', '_selected_action': [welcome_message.pk]}, follow=True)
+        self.assertContains(resp, 'Skipped 1 welcome message(s)')
+        run_pending_jobs()
+        welcome_message.refresh_from_db()
+        self.assertIsNone(welcome_message.started_on)
+        self.assertFalse(Notification.objects.exists())
+        with self.assertRaises(CommandError):
+            self.call_broadcast('--resume', str(welcome_message.pk))
+
 class NotificationDeleteViewTest(TestCase):
 
     def setUp(self):
@@ -167,8 +715,11 @@ class PrivateMessageCreateViewTest(TestCase):
         post_data = {'text': 'new_privatemessage'}
         resp = self.client.post(reverse('notifications:privatemessage_create', kwargs={'pk': self.receiver.pk}), data=post_data)
         message = PrivateMessage.objects.all()[0]
-        self.assertEqual(Notification.objects.count(), 1)
-        notification = Notification.objects.all()[0]
+        #Created by a background job, along with the welcome messages of both users
+        self.assertEqual(Notification.objects.count(), 0)
+        run_pending_jobs()
+        notification = Notification.objects.get(content_type=ContentType.objects.get_for_model(PrivateMessage), object_id=message.pk)
+        self.assertEqual(notification.user, self.receiver)
         self.assertEqual(notification.type.name, 'private_message')
         self.assertEqual(notification.content, message)
         
@@ -185,42 +736,124 @@ class PrivateMessageIndexViewTest(TestCase):
         self.sender_messages = [PrivateMessage.objects.create(text=f'sender_test_message_{i}', sender=self.receiver, receiver=self.sender) for i in range(3)]
         self.other_sender_messages = [PrivateMessage.objects.create(text=f'other_sender_test_message_{i}', sender=self.other_receiver, receiver=self.sender) for i in range(3)]
     
-    def test_private_message_index_view_returns_users_recieved_messages(self):
+    def get_other_users(self, resp):
+        return [member.other_user for member in resp.context['conversation_list']]
+
+    def test_private_message_index_view_returns_users_conversations(self):
         self.client.force_login(self.receiver)
         resp = self.client.get(reverse('notifications:privatemessage_index'))
-        for message in self.messages:
-            self.assertIn(message, resp.context['privatemessage_list'])
-        for message in self.messages_matching_text_search:
-            self.assertIn(message, resp.context['privatemessage_list'])
-        for message in self.messages_matching_username_search :
-            self.assertIn(message, resp.context['privatemessage_list'])
+        #Most recently active first, with the latest message and the unread count of each
+        self.assertEqual(self.get_other_users(resp), [self.sender, self.sender_matching_username_search])
+        self.assertEqual([member.conversation.last_message for member in resp.context['conversation_list']], [self.sender_messages[-1], self.messages_matching_username_search[-1]])
+        self.assertEqual([member.unread for member in resp.context['conversation_list']], [6, 3])
 
-        for message in self.sender_messages:
-            self.assertNotIn(message, resp.context['privatemessage_list'])
-        for message in self.other_sender_messages:
-            self.assertNotIn(message, resp.context['privatemessage_list'])
+        self.client.force_login(self.sender)
+        resp = self.client.get(reverse('notifications:privatemessage_index'))
+        self.assertEqual(self.get_other_users(resp), [self.other_receiver, self.receiver])
 
     def test_private_message_index_searches_by_message_text(self):
         self.client.force_login(self.receiver)
         resp = self.client.get(reverse('notifications:privatemessage_index'), data={'search': 'text_keyword'})
-        for message in self.messages_matching_text_search:
-            self.assertIn(message, resp.context['privatemessage_list'])
-
-        for message in self.messages:
-            self.assertNotIn(message, resp.context['privatemessage_list'])
-        for message in self.messages_matching_username_search:
-            self.assertNotIn(message, resp.context['privatemessage_list'])
+        self.assertEqual(self.get_other_users(resp), [self.sender])
 
     def test_private_message_index_searches_by_sender_username(self):
         self.client.force_login(self.receiver)
         resp = self.client.get(reverse('notifications:privatemessage_index'), data={'search': 'user_keyword'})
-        for message in self.messages_matching_username_search:
-            self.assertIn(message, resp.context['privatemessage_list'])
+        self.assertEqual(self.get_other_users(resp), [self.sender_matching_username_search])
 
-        for message in self.messages:
-            self.assertNotIn(message, resp.context['privatemessage_list'])
-        for message in self.messages_matching_text_search:
-            self.assertNotIn(message, resp.context['privatemessage_list'])
+class ConversationTest(TestCase):
+
+    def setUp(self):
+        self.sender = User.objects.create(username='sender_username', password='test')
+        self.receiver = User.objects.create(username='receiver_username', password='test')
+        self.messages = [PrivateMessage.objects.create(text=f'receiver_test_message_{i}', sender=self.sender, receiver=self.receiver) for i in range(3)]
+        self.replies = [PrivateMessage.objects.create(text=f'sender_test_message_{i}', sender=self.receiver, receiver=self.sender) for i in range(2)]
+        self.conversation = Conversation.get(self.receiver.pk, self.sender.pk)
+
+    def get_unread(self, user):
+        return ConversationMember.objects.get(conversation=self.conversation, user=user).unread
+
+    def test_messages_both_ways_share_one_conversation(self):
+        self.assertEqual(Conversation.objects.count(), 1)
+        self.assertEqual((self.conversation.user_low, self.conversation.user_high), (self.sender, self.receiver))
+        self.assertEqual(list(self.conversation.messages.all()), list(reversed(self.messages + self.replies)))
+        self.assertEqual(self.conversation.last_message, self.replies[-1])
+        self.assertEqual((self.get_unread(self.receiver), self.get_unread(self.sender)), (3, 2))
+
+    def test_system_messages_have_no_conversation(self):
+        message = PrivateMessage.objects.create(text='system_message', receiver=self.receiver)
+        self.assertIsNone(message.conversation)
+        self.assertEqual(Conversation.objects.count(), 1)
+
+    def test_viewing_the_conversation_marks_it_read(self):
+        self.client.force_login(self.receiver)
+        resp = self.client.get(reverse('notifications:privatemessage_user_detail', kwargs={'pk': self.sender.id}))
+        self.assertEqual(len(resp.context['privatemessage_list']), 5)
+        self.assertEqual((self.get_unread(self.receiver), self.get_unread(self.sender)), (0, 2))
+
+    def test_deleting_messages_updates_the_conversation(self):
+        self.replies[-1].delete()
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message, self.replies[0])
+        self.assertEqual(self.get_unread(self.sender), 1)
+        #Messages the receiver already read don't change their unread count
+        self.conversation.mark_read(self.receiver)
+        self.messages[0].delete()
+        self.assertEqual(self.get_unread(self.receiver), 0)
+        PrivateMessage.objects.create(text='new_message', sender=self.sender, receiver=self.receiver)
+        self.messages[1].delete()
+        self.assertEqual(self.get_unread(self.receiver), 1)
+
+class PrivateMessageSearchTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='user_username', password='test')
+        self.friend = User.objects.create(username='friend_username', password='test')
+        self.other = User.objects.create(username='other_username', password='test')
+        self.messages = [
+            PrivateMessage.objects.create(text='the meeting is moved to friday', sender=self.user, receiver=self.friend),
+            PrivateMessage.objects.create(text='meeting notes: meeting went well, another meeting friday', sender=self.friend, receiver=self.user),
+            PrivateMessage.objects.create(text='lunch on monday?', sender=self.friend, receiver=self.user),
+        ]
+        self.other_message = PrivateMessage.objects.create(text='meeting with someone else', sender=self.other, receiver=self.friend)
+
+    def test_get_terms_splits_words(self):
+        self.assertEqual(get_terms(' Meet-ing, fri_day! '), ['meet', 'ing', 'fri', 'day'])
+        self.assertEqual(get_terms('  ?! '), [])
+
+    def test_native_backend_is_used_when_available(self):
+        self.assertEqual(get_backend().name, get_available_backends()[0])
+        self.assertIn('icontains', get_available_backends())
+        with override_settings(NOTIFICATIONS_SEARCH_BACKEND='unknown'):
+            with self.assertRaises(ImproperlyConfigured):
+                get_backend()
+
+    def test_backends_match_prefixes_of_every_term_in_the_users_conversations(self):
+        for name in get_available_backends():
+            backend = BACKENDS[name]()
+            with self.subTest(backend=name):
+                self.assertEqual(set(backend.get_messages(self.user, ['meet'])), set(self.messages[:2]))
+                self.assertEqual(set(backend.get_messages(self.user, ['meet', 'fri'])), set(self.messages[:2]))
+                self.assertEqual(list(backend.get_messages(self.user, ['lunch', 'mon'])), [self.messages[2]])
+                self.assertEqual(set(backend.get_messages(self.friend, ['meeting'])), set(self.messages[:2] + [self.other_message]))
+                self.assertFalse(backend.get_messages(self.user, ['else']).exists())
+
+    def test_fts_backend_ranks_and_follows_deletes(self):
+        if 'fts5' not in get_available_backends():
+            self.skipTest('SQLite was built without FTS5')
+        backend = BACKENDS['fts5']()
+        self.assertEqual(backend.get_ranked(self.user, ['meeting'], 10), [self.messages[1], self.messages[0]])
+        self.messages[1].delete()
+        self.assertEqual(backend.get_ranked(self.user, ['meeting'], 10), [self.messages[0]])
+        self.other.delete()
+        self.assertFalse(backend.get_messages(self.friend, ['else']).exists())
+
+    def test_index_view_shows_best_matching_messages_and_their_conversations(self):
+        self.client.force_login(self.friend)
+        resp = self.client.get(reverse('notifications:privatemessage_index'), data={'search': 'lunch'})
+        self.assertEqual(resp.context['message_results'], [self.messages[2]])
+        self.assertEqual([member.other_user for member in resp.context['conversation_list']], [self.user])
+        self.assertContains(resp, 'Sent to user_username')
 
 class PrivateMessageDeleteViewTest(TestCase):
 
@@ -5,6 +5,7 @@ app_name='notifications'
 urlpatterns = [
     path('', views.NotificationIndexView.as_view(), name='notification_index'),
     path('<int:pk>/delete', views.NotificationDeleteView.as_view(), name='notification_delete'),
+    path('poll', views.notification_poll_view, name='notification_poll'),
     path('messages/', views.PrivateMessageIndexView.as_view(), name='privatemessage_index'),
     path('messages/<int:pk>', views.PrivateMessageUserDetailView.as_view(), name='privatemessage_user_detail'),
     path('messages/system', views.PrivateMessageUserDetailView.as_view(), name='privatemessage_system_detail'),
@@ -1,20 +1,68 @@
 from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import DEFAULT_DB_ALIAS
 
-def create_notification_types():
-        for model in apps.get_models():
-            from notifications.models import NotificationType
-            model_notification_meta = getattr(model, 'NotificationsMeta', None)
-            if model_notification_meta:
-                model_notification_types = getattr(model_notification_meta, 'notifications', None)
-                if model_notification_types:
-                    for notification_type_parms in model_notification_types:
-                        name = notification_type_parms[0]
-                        label = notification_type_parms[1] if len(notification_type_parms) > 1 else name
-                        description = notification_type_parms[2] if len(notification_type_parms) > 2 else label
-                        
-                        notification_type, created = NotificationType.objects.get_or_create(name=name)
-                        if label != notification_type.label or description != notification_type.description:
-                            notification_type.label = label
-                            notification_type.description = description
+#{name: (label, description)} for every notification type declared in a models NotificationsMeta
+def get_declared_notification_types():
+    declared = {}
+    for model in apps.get_models():
+        model_notification_meta = getattr(model, 'NotificationsMeta', None)
+        for notification_type_parms in getattr(model_notification_meta, 'notifications', None) or []:
+            name = notification_type_parms[0]
+            label = notification_type_parms[1] if len(notification_type_parms) > 1 else name
+            description = notification_type_parms[2] if len(notification_type_parms) > 2 else label
+            declared[name] = (label, description)
+    return declared
 
-                            notification_type.save()
\ No newline at end of file
+#Make the NotificationType table match the declarations. Runs at startup and after every migrate
+def create_notification_types(using=DEFAULT_DB_ALIAS):
+    from notifications.models import NotificationType
+    from notifications import registry
+    declared = get_declared_notification_types()
+    existing = NotificationType.objects.using(using).in_bulk(list(declared), field_name='name')
+    NotificationType.objects.using(using).bulk_create([
+        NotificationType(name=name, label=label, description=description)
+        for name, (label, description) in declared.items() if name not in existing
+    ], ignore_conflicts=True)
+    changed = []
+    for name, notification_type in existing.items():
+        if declared[name] != (notification_type.label, notification_type.description):
+            notification_type.label, notification_type.description = declared[name]
+            changed.append(notification_type)
+    NotificationType.objects.using(using).bulk_update(changed, ['label', 'description'])
+    registry.invalidate()
+
+def sync_notification_types(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    create_notification_types(using)
+
+def has_notification_relation(model):
+    from notifications.fields import NotificationRelation
+    return any(isinstance(field, NotificationRelation) for field in model._meta.private_fields)
+
+#Only models that can be the content of a notification need their notifications cleared when deleted
+def connect_notification_cleanup():
+    from django.db.models.signals import pre_delete, post_delete
+    from notifications.models import Notification
+    for model in apps.get_models():
+        if getattr(model, 'NotificationsMeta', None) and not has_notification_relation(model):
+            pre_delete.connect(Notification.delete_for_content, sender=model, dispatch_uid=f'notifications_cleanup_{model._meta.label_lower}')
+        elif getattr(model, 'NotificationsMeta', None):
+            post_delete.connect(Notification.finish_content_delete, sender=model, dispatch_uid=f'notifications_cleanup_{model._meta.label_lower}')
+
+#Caches only the process that wrote to them can see, so changes made by other web processes or runworker never reach them
+def is_process_local_cache(cache):
+    return isinstance(cache, (LocMemCache, DummyCache))
+
+#Live updates hold a request open per browser tab and learn about notifications created by other processes through
+#NOTIFICATIONS_CACHE_ALIAS, so they only work served over ASGI with a cache every process shares
+def check_live_updates(asgi=True):
+    if not getattr(settings, 'NOTIFICATIONS_LIVE_UPDATES', False):
+        return
+    if is_process_local_cache(caches[getattr(settings, 'NOTIFICATIONS_CACHE_ALIAS', 'default')]):
+        raise ImproperlyConfigured('NOTIFICATIONS_LIVE_UPDATES needs NOTIFICATIONS_CACHE_ALIAS to be a cache shared between processes')
+    if not asgi:
+        raise ImproperlyConfigured('NOTIFICATIONS_LIVE_UPDATES needs the site served over ASGI (blog_project.asgi), not WSGI')
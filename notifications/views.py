@@ -2,47 +2,66 @@ from django.dispatch.dispatcher import receiver
 from django.shortcuts import render
 from django.urls import reverse
 from django.views.generic.edit import CreateView
-from .models import Notification, NotificationType, PrivateMessage
+from .models import Conversation, ConversationMember, Notification, NotificationType, PrivateMessage, SystemBroadcast, UnreadNotificationCount
+from .broker import broker
+from .search import get_backend, get_terms
 from django.views.generic import ListView, DeleteView
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.contrib.auth.models import User
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, JsonResponse, Http404
+from django.template.loader import render_to_string
+from asgiref.sync import sync_to_async
+from datetime import datetime, timezone
+import asyncio
 from django.shortcuts import get_object_or_404
 from django.db.models import Q, Count
+from django.conf import settings
+from django.db import transaction
+from blog.pagination import CursorPaginationMixin
+from jobs.models import Job
 #from django.db.models.functions import Count
 
 # Create your views here.
 
-class NotificationIndexView(LoginRequiredMixin, ListView):
+class NotificationIndexView(LoginRequiredMixin, CursorPaginationMixin, ListView):
     paginate_by = 20
     template_name = 'blog/notification_index.html'
+    context_object_name = 'notification_list'
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        context['notification_list'] = Notification.prefetch_content(context['notification_list'])
         context["notificationtype_list"] = self.notificationtypes
         context["included_notificationtypes"] = self.included_notificationtypes
+        context['archived'] = self.archived
+        context['archive_enabled'] = getattr(settings, 'NOTIFICATIONS_ARCHIVE', False)
 
         return context
     
 
     def get(self, request):
         self.user = request.user
-        self.notificationtypes = NotificationType.objects.all()
+        self.notificationtypes = NotificationType.get_all()
         self.included_notificationtypes = []
         for notificationtype in self.notificationtypes:
             if notificationtype.name in request.GET and request.GET[notificationtype.name].lower() == 'on':
                 self.included_notificationtypes.append(notificationtype)
                 
+        #Notifications moved to the archive by prunenotifications are only read when asked for
+        self.archived = request.GET.get('archived', '').lower() == 'on'
         resp = super().get(request).render()
-        for notification in self.user.notification_set.all():
-            if not notification.seen:
-                notification.seen = True
-                notification.save()
+        if self.archived:
+            return resp
+        #Rendered first so the page still shows which notifications are new
+        if getattr(settings, 'NOTIFICATIONS_MARK_ALL_SEEN', False):
+            Notification.mark_seen(self.user)
+        else:
+            Notification.mark_seen(self.user, [notification.pk for notification in resp.context_data['notification_list']])
         return resp
 
     def get_queryset(self):
         user = self.request.user
-        query = user.notification_set.all()
+        query = user.archivednotification_set.all() if self.archived else user.notification_set.all()
         if len(self.included_notificationtypes) > 0:
             query = query.filter(type__in=self.included_notificationtypes)
         return query
@@ -75,13 +94,14 @@ class PrivateMessageCreateView(LoginRequiredMixin, CreateView):
     def form_valid(self, form):
         user = get_object_or_404(User, pk=self.kwargs['pk'])
         message = PrivateMessage(sender=self.request.user, receiver=user, text=form.cleaned_data['text'])
-        message.save()
-        user.notification_set.create(content=message, type=NotificationType.get('private_message'))
-        #user.notification_set.create(content=message)
+        #The receiver's notification is created by a background job, queued only if the message is saved
+        with transaction.atomic():
+            message.save()
+            Job.enqueue('notifications.notify_receiver', {'message_id': message.pk}, key=f'notifications.notify_receiver:{message.pk}')
         
         return HttpResponseRedirect(reverse('notifications:privatemessage_user_detail', kwargs={'pk':user.id}))
 
-class PrivateMessageUserDetailView(LoginRequiredMixin, ListView):
+class PrivateMessageUserDetailView(LoginRequiredMixin, CursorPaginationMixin, ListView):
     model = PrivateMessage
     template_name = 'notifications/privatemessage_user_detail.html'
     paginate_by = 20
@@ -99,26 +119,47 @@ class PrivateMessageUserDetailView(LoginRequiredMixin, ListView):
             self.target = get_object_or_404(User, pk=self.kwargs['pk'])
         
         if self.target:
-            return PrivateMessage.objects.filter(sender__isnull=False).filter((Q(sender=self.user, receiver=self.target)) | (Q(sender=self.target, receiver=self.user)))
+            conversation = Conversation.get(self.user.pk, self.target.pk)
+            if not conversation:
+                return PrivateMessage.objects.none()
+            conversation.mark_read(self.user)
+            return conversation.messages.all()
         else:
-            return PrivateMessage.objects.filter((Q(receiver=self.user, sender__isnull=True)))
+            SystemBroadcast.deliver(self.user)
+            return PrivateMessage.objects.filter((Q(receiver=self.user, sender__isnull=True))).select_related('broadcast')
 
-class PrivateMessageIndexView(LoginRequiredMixin, ListView):
-    model = PrivateMessage
+#Number of best matching messages shown above the conversations when searching
+SEARCH_RESULTS = 10
+
+#Lists the user's conversations, most recently active first, with the latest system message above them on the first page
+class PrivateMessageIndexView(LoginRequiredMixin, CursorPaginationMixin, ListView):
+    model = ConversationMember
+    context_object_name = 'conversation_list'
     template_name = 'notifications/privatemessage_index.html'
     paginate_by = 20
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context["search"] = getattr(self, 'search', '')
+        if context['page_obj'].number == 1 and context['search']:
+            terms = get_terms(context['search'])
+            context['message_results'] = get_backend().get_ranked(self.request.user, terms, SEARCH_RESULTS) if terms else []
+        if context['page_obj'].number == 1:
+            system_messages = PrivateMessage.objects.filter(receiver=self.request.user, sender__isnull=True).select_related('broadcast')
+            if context['search']:
+                system_messages = system_messages.filter(Q(text__icontains=context['search']) | Q(broadcast__text__icontains=context['search']))
+            context['system_message'] = system_messages.first()
         return context
 
 
     def get_queryset(self):
-        query = PrivateMessage.objects.filter(receiver=self.request.user)
+        SystemBroadcast.deliver(self.request.user)
+        query = self.request.user.conversations.select_related('other_user', 'conversation__last_message')
         if 'search' in self.request.GET and self.request.GET['search'] != '':
             self.search = self.request.GET['search']
-            query = query.filter(Q(text__icontains=self.search) | Q(sender__username__icontains=self.search))
+            terms = get_terms(self.search)
+            matching_messages = get_backend().get_messages(self.request.user, terms) if terms else PrivateMessage.objects.none()
+            query = query.filter(Q(other_user__username__icontains=self.search) | Q(conversation__in=matching_messages.values('conversation')))
         return query
 
 class PrivateMessageDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
@@ -134,4 +175,60 @@ class PrivateMessageDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteVi
 
     def get_success_url(self, *args, **kwargs):
         next = self.request.POST.get('next', None)
-        return next if next else reverse('notifications:privatemessage_index')
\ No newline at end of file
+        return next if next else reverse('notifications:privatemessage_index')
+
+#Longest a live notification request waits between checks of the cached change time, which is how changes made by
+#other processes are noticed. Changes made in this process wake it straight away through the broker
+POLL_CHECK_INTERVAL = 5
+POLL_NOTIFICATIONS = 20
+
+def get_logged_in_user(request):
+    return request.user if request.user.is_authenticated else None
+
+#The users unread count and the oldest POLL_NOTIFICATIONS of their notifications created (or folded into) after since,
+#shown newest first. since only ever moves to the creation time of the newest one returned, so the rest and ones
+#committed late are picked up by the next poll
+def get_poll_updates(request, user, since):
+    notifications = []
+    if since is not None:
+        notifications = list(user.notification_set.filter(created_on__gt=datetime.fromtimestamp(since, timezone.utc)).select_related('type').order_by('created_on', 'id')[:POLL_NOTIFICATIONS])
+        if notifications:
+            since = notifications[-1].created_on.timestamp()
+            notifications = Notification.prefetch_content(reversed(notifications))
+    return {
+        'count': UnreadNotificationCount.get(user),
+        'since': since if since is not None else datetime.now(timezone.utc).timestamp(),
+        'notifications': [{'id': notification.pk, 'html': render_to_string('notifications/live_notification.html', {'notification': notification}, request)} for notification in notifications],
+    }
+
+def get_float(request, name):
+    try:
+        return float(request.GET[name])
+    except (KeyError, ValueError):
+        return None
+
+#Long-poll endpoint behind NOTIFICATIONS_LIVE_UPDATES. Answers once the users unread count differs from ?count= or they
+#have notifications newer than ?since=, or after NOTIFICATIONS_POLL_TIMEOUT seconds. Without since it answers straight
+#away with the values to start from. Async so idle requests only hold a future (needs to be served over ASGI)
+async def notification_poll_view(request):
+    if not getattr(settings, 'NOTIFICATIONS_LIVE_UPDATES', False):
+        raise Http404
+    user = await sync_to_async(get_logged_in_user)(request)
+    if user is None:
+        return JsonResponse({'error': 'Login required'}, status=403)
+    since, count = get_float(request, 'since'), get_float(request, 'count')
+    if since is None:
+        return JsonResponse(await sync_to_async(get_poll_updates)(request, user, None))
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + getattr(settings, 'NOTIFICATIONS_POLL_TIMEOUT', 25)
+    checked = since
+    while True:
+        remaining = deadline - loop.time()
+        changed = await sync_to_async(Notification.get_last_change)(user.pk)
+        if remaining <= 0 or (changed is not None and changed > checked):
+            checked = max(checked, changed or checked)
+            updates = await sync_to_async(get_poll_updates)(request, user, since)
+            if remaining <= 0 or updates['notifications'] or updates['count'] != count:
+                return JsonResponse(updates)
+        await broker.wait(user.pk, min(POLL_CHECK_INTERVAL, remaining))